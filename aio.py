@@ -0,0 +1,118 @@
+# The asyncio runtime: timers, the pauses of scripts and the handlers of the chats run as callbacks
+# on one event loop, instead of on the JobQueue's scheduler threads and the dispatcher's workers.
+# Nothing blocks on the loop: a pause is a timer handle, the way asyncio.sleep waits, and messages
+# are handed to the outbox.
+import asyncio
+import datetime
+import threading
+
+from telegram.ext import CallbackContext, Dispatcher
+
+
+class AsyncJob:
+    # The part of telegram.ext.Job the bot uses.
+    __slots__ = ('callback', 'context', 'name', 'time_of_day', 'removed', '_queue', '_handle')
+
+    def __init__(self, queue: 'AsyncJobQueue', callback, context: object, name: str,
+                 time_of_day: datetime.time = None):
+        self.callback = callback
+        self.context = context
+        self.name = name
+        self.time_of_day = time_of_day  # Of a daily job.
+        self.removed = False
+        self._queue = queue
+        self._handle = None
+
+    def schedule_removal(self):
+        self.removed = True
+        self._queue.call_soon(self._cancel)
+
+    def _cancel(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+
+def seconds_until(time_of_day: datetime.time, min_sec: float = 0.0) -> float:
+    # Seconds until the next time of day at least min_sec away, in the time zone of time_of_day (UTC if naive).
+    tz = time_of_day.tzinfo or datetime.timezone.utc
+    now = datetime.datetime.now(tz)
+    day = now.date()
+    while True:
+        at = datetime.datetime.combine(day, time_of_day.replace(tzinfo=None))
+        at = tz.localize(at) if hasattr(tz, 'localize') else at.replace(tzinfo=tz)
+        remaining_sec = (at - now).total_seconds()
+        if remaining_sec > min_sec:
+            return remaining_sec
+        day += datetime.timedelta(days=1)
+
+
+class AsyncJobQueue:
+    # Stands in for telegram.ext.JobQueue. Jobs may be scheduled from any thread.
+    # Given the loop of another queue, the queue shares it: start and stop are left to the other one.
+    def __init__(self, loop: asyncio.AbstractEventLoop = None):
+        self.loop = loop or asyncio.new_event_loop()
+        self._owns_loop = loop is None
+        self._dispatcher = None
+        self._thread = None
+
+    def set_dispatcher(self, dispatcher: Dispatcher):
+        self._dispatcher = dispatcher
+
+    def start(self):
+        # Run the loop on a thread of its own, unless it is already running.
+        if not self._owns_loop or self._thread is not None or self.loop.is_running():
+            return
+        self._thread = threading.Thread(target=self._run_loop, name='asyncio', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self._thread = None
+
+    def call_soon(self, callback, *args):
+        if self._thread is threading.current_thread():
+            self.loop.call_soon(callback, *args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def run_once(self, callback, when: float, context: object = None, name: str = None) -> AsyncJob:
+        job = AsyncJob(self, callback, context, name)
+        self.call_soon(self._arm, job, self.loop.time() + when)
+        return job
+
+    def run_daily(self, callback, time: datetime.time, days: tuple = tuple(range(7)),
+                  context: object = None, name: str = None) -> AsyncJob:
+        job = AsyncJob(self, callback, context, name, time_of_day=time)
+        self.call_soon(self._arm, job, self.loop.time() + seconds_until(time))
+        return job
+
+    def run_async(self, func, *args, update: object = None, **kwargs):
+        # The same as Dispatcher.run_async, on the loop.
+        self.call_soon(self._call, func, args, kwargs, update)
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def _arm(self, job: AsyncJob, at: float):
+        if not job.removed:
+            job._handle = self.loop.call_at(at, self._fire, job)
+
+    def _fire(self, job: AsyncJob):
+        job._handle = None
+        if job.removed:
+            return
+        if job.time_of_day is not None:
+            # The loop may fire a little early: don't pick the same time of day again.
+            self._arm(job, self.loop.time() + seconds_until(job.time_of_day, min_sec=1.0))
+        self._call(job.callback, (CallbackContext.from_job(job, self._dispatcher),), {}, None)
+
+    def _call(self, func, args: tuple, kwargs: dict, update: object):
+        try:
+            func(*args, **kwargs)
+        except Exception as e:
+            self._dispatcher.dispatch_error(update, e)
@@ -0,0 +1,665 @@
+# Micro-benchmarks. Run `python benchmark.py [name ...]`.
+import argparse
+import os
+import queue
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import types
+
+import intent
+
+# Representative group chat traffic: mostly chit-chat, a few directions asked.
+SAMPLE_MESSAGES = (
+    '안녕하세요',
+    'ㅋㅋㅋㅋㅋ',
+    '오늘 날씨 좋네요',
+    '점심 뭐 먹지?',
+    '퇴근하고 싶다ㅠ',
+    '네 알겠습니다',
+    '지금 뭐해요?',
+    '사진 올렸어요',
+    '어제 너무 피곤했어ㅜ',
+    '다들 주말 잘 보내세요~',
+    '그거 얼마예요?',
+    '클리 얘기는 나중에',
+    '자위 몇 분 해도 돼요?',
+    '보지 얼마나 만져야 돼요ㅠ',
+    '5분 보지 털어도 돼요?',
+    '10분 동안 클리 만지면 돼요?',
+    '자위하고 싶어요ㅠ',
+    '자위 해도 돼요?',
+    '클리 살살 만져도 돼요?',
+    '보지 좀 비벼도 될까요?',
+)
+
+
+def _legacy_classify(text: str):
+    # The regular expressions interpret_message used to run on every message.
+    if re.search("(몇\\s?분|얼마).*요.?[?ㅜㅠ]$", text) and re.search("(보지|클리|자위)", text):
+        return intent.Intent(intent.INTENT_DURATION, None)
+    elif re.search("\\d.?분.{0,6}(보지|클리|자위).*[할도면털].*요.?[?ㅜㅠ]$", text):
+        return intent.Intent(intent.INTENT_TIMER, int(re.search(r'\d+', text).group()))
+    elif ((re.search("자위.*(하고.*싶.+|해도.+)[?ㅜㅠ]$", text) or
+           re.search("^(클리|보지).*\\s((만지|비비|쑤시|털)|(만져|비벼|쑤셔)).*요.?[?ㅜㅠ]$", text)) and
+          not re.search("(몇\\s?분|얼마)", text)):
+        return intent.Intent(intent.INTENT_POSTURE, None)
+    return None
+
+
+def _time_per_call(func, items, rounds: int) -> float:
+    # Return the mean seconds per call of func over the items.
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for item in items:
+            func(item)
+    return (time.perf_counter() - start) / (rounds * len(items))
+
+
+def bench_intent(args):
+    for text in SAMPLE_MESSAGES:
+        expected, actual = _legacy_classify(text), intent.classify(text)
+        if expected != actual:
+            raise AssertionError('{!r}: {} != {}'.format(text, actual, expected))
+
+    legacy = _time_per_call(_legacy_classify, SAMPLE_MESSAGES, args.rounds)
+    classified = _time_per_call(intent.classify, SAMPLE_MESSAGES, args.rounds)
+    matched = sum(1 for text in SAMPLE_MESSAGES if intent.classify(text))
+    print('intent: {:d} messages ({:d} intents)'.format(len(SAMPLE_MESSAGES), matched))
+    print('  legacy   {:8.0f} ns/message'.format(legacy * 1e9))
+    print('  classify {:8.0f} ns/message ({:.1f}x)'.format(classified * 1e9, legacy / classified))
+
+
+class _NullJob:
+    def schedule_removal(self):
+        pass
+
+
+class _NullJobQueue:
+    def __init__(self):
+        self.scheduled = 0
+
+    def run_once(self, callback, when, context=None, name=None):
+        self.scheduled += 1
+        return _NullJob()
+
+    def run_daily(self, callback, time, days=tuple(range(7)), context=None, name=None):
+        return _NullJob()
+
+
+def bench_corpus(args):
+    # Parsing the .pv files of the working directory against mapping their compiled bundle.
+    import common
+    import corpus
+
+    names = [name for name in sorted(os.listdir('.')) if name.endswith('.pv') and name not in corpus.NOT_PHRASES]
+    started = time.perf_counter()
+    for _ in range(args.rounds):
+        common.clear_corpus_cache()
+        for name in names:
+            common.build_tuple_of_tuples(name)
+    parsed = (time.perf_counter() - started) / args.rounds
+    texts = [common.build_tuple_of_tuples(name) for name in names]
+
+    with tempfile.TemporaryDirectory() as dir_path:
+        path = os.path.join(dir_path, 'corpus.bin')
+        bundle, errors = corpus.compile_corpus('.')
+        with open(path, 'wb') as f:
+            f.write(bundle)
+        started = time.perf_counter()
+        for _ in range(args.rounds):
+            common.load_bundle(path)
+        mapped = (time.perf_counter() - started) / args.rounds
+        bundled = [common.build_tuple_of_tuples(name) for name in names]
+        from_text = _time_per_call(random.choice, texts, args.rounds)
+        from_bundle = _time_per_call(random.choice, bundled, args.rounds)
+        common.unload_bundle()
+
+    print('corpus: {:d} files, {:d} bytes compiled, {:d} problems'.format(len(names), len(bundle), len(errors)))
+    print('  parse   {:8.1f} us'.format(parsed * 1e6))
+    print('  map     {:8.1f} us'.format(mapped * 1e6))
+    print('  choice  {:8.2f} us from text, {:.2f} us from bundle'.format(from_text * 1e6, from_bundle * 1e6))
+
+
+def bench_logging(args):
+    # An event logged through the queue, disabled by its level, and the print() it replaced.
+    import logging
+    import logs
+
+    logger = logging.getLogger('benchmark')
+    with open(os.devnull, 'w') as devnull:
+        def printed(text):
+            print('Bot: ' + text, file=devnull)
+
+        def logged(text):
+            logs.event(logger, logging.DEBUG, 'informed', chat_id=1, session=0, text=text)
+
+        logs.configure('DEBUG', logs.FORMAT_JSON, stream=devnull)
+        enabled = _time_per_call(logged, SAMPLE_MESSAGES, args.rounds)
+        logs.configure('INFO', logs.FORMAT_JSON, stream=devnull)
+        disabled = _time_per_call(logged, SAMPLE_MESSAGES, args.rounds)
+        logs.stop()
+        with_print = _time_per_call(printed, SAMPLE_MESSAGES, args.rounds)
+
+    print('logging: {:d} events'.format(args.rounds * len(SAMPLE_MESSAGES)))
+    print('  queued   {:8.3f} us'.format(enabled * 1e6))
+    print('  disabled {:8.3f} us'.format(disabled * 1e6))
+    print('  print    {:8.3f} us'.format(with_print * 1e6))
+
+
+def bench_media(args):
+    # Voice sends to a stub bot issuing file_ids: uploaded once, then by file_id, also after a restart.
+    import media
+    import outbound
+    import simulator
+
+    outbound.outbox = outbound.Outbox()  # Not started: sends immediately.
+    bot = simulator.FakeBot(simulator.VirtualClock())
+    with tempfile.TemporaryDirectory() as dir_path:
+        paths = []
+        for i in range(3):
+            paths.append(os.path.join(dir_path, '{:d}.ogg'.format(i)))
+            with open(paths[-1], 'wb') as f:
+                f.write(os.urandom(100 * 1024))
+        db_path = os.path.join(dir_path, 'media.db')
+        sends = args.rounds
+        for run in ('first', 'restart'):
+            registry = media.MediaRegistry(db_path)
+            started = time.perf_counter()
+            for _ in range(sends):
+                registry.send_voice(bot, 1, random.choice(paths))
+            elapsed = time.perf_counter() - started
+            stats = registry.stats()
+            registry.close()
+            naive = sum(os.path.getsize(path) for path in paths) / len(paths) * sends
+            print('media {:8s} {:d} sends, {:d} uploads, {:d} of ~{:.0f} bytes uploaded, {:6.1f} us/send'
+                  .format(run, sends, stats['uploads'], stats['uploaded_bytes'], naive, elapsed / sends * 1e6))
+
+
+def bench_metrics(args):
+    # Cost of a timed callback with the metrics disabled and enabled, and of a scrape after a simulated load.
+    import metrics
+    import simulator
+
+    def noop(item):
+        pass
+
+    disabled = _time_per_call(metrics.Metrics().timed(metrics.JOB_SECONDS, noop, job='noop'), SAMPLE_MESSAGES,
+                              args.rounds)
+    recorder = metrics.Metrics()
+    recorder.enable()
+    enabled = _time_per_call(recorder.timed(metrics.JOB_SECONDS, noop, job='noop'), SAMPLE_MESSAGES, args.rounds)
+
+    metrics.recorder = recorder
+    report = simulator.run_load(args.sessions // 10, seed=args.seed)
+    started = time.perf_counter()
+    text = recorder.render()
+    rendered = time.perf_counter() - started
+    metrics.recorder = metrics.Metrics()
+
+    print('metrics: {:d} chats simulated in {:.2f} s with metrics enabled'.format(report['chats'], report['wall_sec']))
+    print('  call     {:8.3f} us disabled, {:.3f} us enabled'.format(disabled * 1e6, enabled * 1e6))
+    print('  scrape   {:8.3f} ms for {:d} lines'.format(rendered * 1e3, text.count('\n')))
+
+
+def bench_recovery(args):
+    import csbt
+    import jobs
+    import persistence
+    import state
+
+    with tempfile.TemporaryDirectory() as dir_path:
+        path = os.path.join(dir_path, 'state.db')
+        now = time.time()
+        rows = {}
+        for chat_id in range(args.sessions):
+            session = state.Session(chat_id)
+            session.is_active = chat_id % 2 == 0
+            due_times = {csbt.Constants.JOB_ACTIVATE: now + 3600, csbt.Constants.JOB_TIMER: now + 60}
+            rows[chat_id] = (session.snapshot(), [3, 1, 5, 2], due_times)
+
+        store = persistence.Persistence(path, rows.get)
+        for chat_id in rows:
+            store.touch(chat_id)
+        started = time.perf_counter()
+        store.flush()
+        written = time.perf_counter() - started
+        store.close()
+
+        csbt.sessions = state.SessionStore()
+        jobs.registry = jobs.JobRegistry()
+        job_queue = _NullJobQueue()
+        started = time.perf_counter()
+        store = persistence.Persistence(path, csbt.snapshot_chat)
+        loaded = store.load()
+        csbt.restore_sessions(types.SimpleNamespace(job_queue=job_queue), loaded)
+        recovered = time.perf_counter() - started
+        store.close()
+
+    print('recovery: {:d} sessions, {:d} timers'.format(len(csbt.sessions), job_queue.scheduled))
+    print('  write   {:8.3f} s'.format(written))
+    print('  recover {:8.3f} s'.format(recovered))
+
+
+def bench_simulate(args):
+    import simulator
+
+    report = simulator.run_load(args.sessions // 10, seed=args.seed)
+    print('simulate: {chats:d} chats, {updates:d} updates, {jobs:d} jobs, {messages:d} messages, {errors:d} errors'
+          .format(**report))
+    print('  virtual  {:10.0f} s in {:.2f} s'.format(report['virtual_sec'], report['wall_sec']))
+    print('  sent     {:10.0f} messages/s'.format(report['messages_per_sec']))
+    print('  handler  {:10.1f} us avg, {:.1f} us p95'.format(report['handler_avg'] * 1e6, report['handler_p95'] * 1e6))
+    print('  job      {:10.1f} us avg, {:.1f} us p95'.format(report['job_avg'] * 1e6, report['job_p95'] * 1e6))
+    print('  memory   {:10.0f} bytes/session'.format(report['bytes_per_session']))
+
+
+def bench_startup(args):
+    # Cold start of the bot against a stub Bot API: from spawning the process to its first getUpdates.
+    # Also the import of csbt alone, as tools and shards pay it.
+    import shutil
+    import signal
+    import subprocess
+    import simulator
+
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    script = os.path.join(package_dir, 'csbt.py')
+    imports, polls = [], []
+    with tempfile.TemporaryDirectory() as dir_path:
+        for name in os.listdir('.'):
+            if name.endswith('.pv') and name not in ('token.pv', 'config.pv'):
+                shutil.copy(name, dir_path)
+        for _ in range(5):
+            started = time.monotonic()
+            subprocess.run([sys.executable, '-c', 'import csbt'], cwd=dir_path, check=True,
+                           env=dict(os.environ, PYTHONPATH=package_dir))
+            imports.append(time.monotonic() - started)
+
+        stub = simulator.StubBotApi()
+        with open(os.path.join(dir_path, 'token.pv'), 'w') as f:
+            f.write('123456:{}'.format('A' * 35))
+        with open(os.path.join(dir_path, 'config.pv'), 'w') as f:
+            f.write('base_url,{}\nlog_level,WARNING\ncorpus_reload_sec,0\n'.format(stub.base_url))
+        for _ in range(5):
+            stub.calls.clear()
+            started = time.monotonic()
+            process = subprocess.Popen([sys.executable, script], cwd=dir_path)
+            while stub.first_call('getUpdates') is None and process.poll() is None:
+                time.sleep(0.005)
+            polled = stub.first_call('getUpdates')
+            process.send_signal(signal.SIGINT)
+            process.wait()
+            if polled is None:
+                sys.exit('startup: the bot exited with {:d} before polling'.format(process.returncode))
+            polls.append(polled - started)
+        stub.close()
+
+    # A shard worker started, then restarted.
+    import multiprocessing
+    import shard
+
+    results = multiprocessing.get_context('spawn').Queue()
+    router = shard.ShardRouter(1, simulator._run_shard, args=(results, args.seed, 0.5))
+    started = time.monotonic()
+    router.start()
+    results.get()
+    spawned = time.monotonic() - started
+    restarts = []
+    for _ in range(5):
+        started = time.monotonic()
+        router.restart(0)
+        results.get()  # The report of the old worker.
+        results.get()
+        restarts.append(time.monotonic() - started)
+    router.stop()
+    results.get()
+
+    imports.sort()
+    polls.sort()
+    restarts.sort()
+    print('startup: 5 runs each, median (min)')
+    print('  import csbt      {:8.0f} ms ({:.0f} ms)'.format(imports[2] * 1e3, imports[0] * 1e3))
+    print('  to first poll    {:8.0f} ms ({:.0f} ms)'.format(polls[2] * 1e3, polls[0] * 1e3))
+    print('  shard start      {:8.0f} ms'.format(spawned * 1e3))
+    print('  shard restart    {:8.0f} ms ({:.0f} ms)'.format(restarts[2] * 1e3, restarts[0] * 1e3))
+
+
+def _process_status(pid: int) -> tuple:
+    # (resident KiB, threads) of the process, from Linux's /proc.
+    fields = {}
+    with open('/proc/{:d}/status'.format(pid)) as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            fields[key] = value.split()
+    return int(fields['VmRSS'][0]), int(fields['Threads'][0])
+
+
+def bench_tenants(args):
+    # --tenants bots against a stub Bot API, once polling: each in a process of its own, then all in one.
+    import shutil
+    import signal
+    import subprocess
+    import simulator
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'csbt.py')
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(script))
+    stub = simulator.StubBotApi()
+    config = 'base_url,{}\ncorpus_reload_sec,0\n'.format(stub.base_url)
+    logged = 'log_level,INFO\n'
+    started = threading.Semaphore(0)
+
+    def watch(stream):
+        # Count the bots started from the log of a process.
+        for line in stream:
+            if 'Started in' in line or 'started as' in line:
+                started.release()
+
+    def run(commands: list) -> tuple:
+        # Start the processes in (cwd, bots), measure them once every bot started, then stop them.
+        processes = [subprocess.Popen([sys.executable, script], cwd=cwd, env=env, stderr=subprocess.PIPE, text=True)
+                     for cwd, _ in commands]
+        for process in processes:
+            threading.Thread(target=watch, args=(process.stderr,), daemon=True).start()
+        for _ in range(sum(count for _, count in commands)):
+            if not started.acquire(timeout=60):
+                sys.exit('tenants: a bot did not start')
+        time.sleep(1)
+        statuses = [_process_status(process.pid) for process in processes]
+        for process in processes:
+            process.send_signal(signal.SIGINT)
+        for process in processes:
+            process.wait()
+        return sum(rss for rss, _ in statuses), sum(threads for _, threads in statuses)
+
+    with tempfile.TemporaryDirectory() as dir_path:
+        tenants_dir = os.path.join(dir_path, 'tenants')
+        for i in range(args.tenants):
+            tenant_dir = os.path.join(tenants_dir, str(i))
+            os.makedirs(tenant_dir)
+            for name in os.listdir('.'):
+                if name.endswith('.pv') and name not in ('token.pv', 'config.pv'):
+                    shutil.copy(name, tenant_dir)
+            with open(os.path.join(tenant_dir, 'token.pv'), 'w') as f:
+                f.write('{:d}:{}'.format(100000 + i, 'A' * 35))
+            with open(os.path.join(tenant_dir, 'config.pv'), 'w') as f:
+                f.write(config + logged)
+        separate = run([(os.path.join(tenants_dir, str(i)), 1) for i in range(args.tenants)])
+
+        for i in range(args.tenants):
+            with open(os.path.join(tenants_dir, str(i), 'config.pv'), 'w') as f:
+                f.write(config)
+        with open(os.path.join(dir_path, 'config.pv'), 'w') as f:
+            f.write(config + logged + 'tenants_dir,tenants\n')
+        shared = run([(dir_path, args.tenants)])
+    stub.close()
+
+    print('tenants: {:d} bots polling'.format(args.tenants))
+    for name, (rss, threads) in (('processes', separate), ('one process', shared)):
+        print('  {:12s} {:8.1f} MiB resident, {:4d} threads'.format(name, rss / 1024, threads))
+
+
+def bench_transport(args):
+    # --rounds sends from the dispatcher's and the outbox's threads while one polls, against a stub Bot API
+    # as far as Telegram: with the pool of a bare Bot, of the Updater, and of transport.py.
+    import logging
+    import telegram
+    from telegram.utils.request import Request
+    import outbound
+    import simulator
+    import transport
+
+    # Not a warning for every connection closed by a full pool.
+    logging.getLogger('telegram.vendor.ptb_urllib3.urllib3.connectionpool').setLevel(logging.ERROR)
+    threads = args.workers + outbound.outbox.workers
+    print('transport: {:d} sends from {:d} threads while polling, 20 ms round trips, 60 ms handshakes'
+          .format(args.rounds, threads))
+    for name, size in (('bot', 1), ('updater', args.workers + 4), ('sized', transport.pool_size(args.workers))):
+        stub = simulator.StubBotApi(poll_sec=0.5, latency_sec=0.02, handshake_sec=0.06)
+        request = Request(con_pool_size=size)
+        bot = telegram.Bot('100000:' + 'A' * 35, base_url=stub.base_url, request=request)
+        sends = queue.SimpleQueue()
+        for _ in range(args.rounds):
+            sends.put(1)
+        stopped = threading.Event()
+
+        def poll():
+            while not stopped.is_set():
+                bot.get_updates(timeout=0)
+
+        def send():
+            while True:
+                try:
+                    sends.get_nowait()
+                except queue.Empty:
+                    return
+                bot.send_message(1, 'ㅋㅋㅋ')
+                time.sleep(random.random() * 0.02)  # Paced, or handling the next update.
+
+        poller = threading.Thread(target=poll, daemon=True)
+        poller.start()
+        senders = [threading.Thread(target=send) for _ in range(threads)]
+        started = time.perf_counter()
+        for thread in senders:
+            thread.start()
+        for thread in senders:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        stopped.set()
+        poller.join()
+        stats = transport.stats(request)
+        stub.close()
+        print('  {:8s} pool {:3d}: {:8.0f} sends/s, {:5d} connections for {:5d} requests, {:5.1f}% reused'
+              .format(name, size, args.rounds / elapsed, stats['connections'], stats['requests'],
+                      100.0 * stats['reused'] / max(1, stats['requests'])))
+
+
+def bench_stress(args):
+    import simulator
+
+    report = simulator.run_stress(args.sessions // 10, workers=args.workers, seed=args.seed)
+    print('stress: {chats:d} chats, {updates:d} updates, {errors:d} errors'.format(**report))
+    print('  handled  {:10.0f} updates/s in {:.2f} s'.format(report['updates_per_sec'], report['wall_sec']))
+    print('  out of order {:d}, wrongly accepted {:d}, lost denials {:d}'
+          .format(report['out_of_order'], report['wrongly_accepted'], report['lost_denials']))
+    if report['errors'] or report['out_of_order'] or report['wrongly_accepted'] or report['lost_denials']:
+        sys.exit('stress: concurrent updates corrupted the sessions')
+
+
+def bench_admission(args):
+    # One chat flooding the bot ahead of the others, with every update reaching its lane, then admitted.
+    import simulator
+
+    chats = args.sessions // 10
+    print('admission: {:d} updates of one chat, each delivered twice, ahead of {:d} chats'.format(args.rounds, chats))
+    for name, admit in (('all', False), ('admitted', True)):
+        report = simulator.run_flood(chats, flood=args.rounds, workers=args.workers, admit=admit)
+        print('  {:8s} others served in {:7.3f} s, all in {:7.3f} s, {:6d} handler calls, dropped {}, {:d} notified'
+              .format(name, report['quiet_sec'], report['wall_sec'], report['handled'], report['dropped'],
+                      report['notified']))
+        if report['errors']:
+            sys.exit('admission: {:d} errors'.format(report['errors']))
+
+
+def bench_shards(args):
+    # The simulated load on one worker process, then spread over --shards of them.
+    import simulator
+
+    chats = args.sessions // 10
+    print('shards: {:d} chats, {:d} CPUs'.format(chats, os.cpu_count()))
+    baseline = None
+    for shards in sorted({1, args.shards}):
+        report = simulator.run_sharded(chats, shards, seed=args.seed)
+        baseline = baseline or report['messages_per_sec']
+        print('  {:2d} shard(s) {:8.0f} messages/s in {:.2f} s ({:.1f}x), {:d} errors, chats {}'
+              .format(shards, report['messages_per_sec'], report['wall_sec'], report['messages_per_sec'] / baseline,
+                      report['errors'], report['chats_per_shard']))
+
+
+class _NullBot:
+    id = 1
+    username = 'csbt_bot'
+    defaults = None
+
+    def send_message(self, chat_id, text: str, **kwargs):
+        pass
+
+
+def _run_conversations(job_queue, conversations: int, steps: int) -> dict:
+    # Start the paced conversations at once on the job queue and wait until every step ran.
+    from telegram.ext import CallbackContext, Dispatcher
+    import jobs
+    import outbound
+    import pacing
+
+    jobs.registry = jobs.JobRegistry()
+    outbound.outbox = outbound.Outbox()  # Not started: sends immediately.
+    dispatcher = Dispatcher(_NullBot(), queue.Queue(), workers=1, job_queue=job_queue)
+    job_queue.set_dispatcher(dispatcher)
+    context = CallbackContext(dispatcher)
+    lateness = []
+    finished = threading.Event()
+    total = conversations * steps
+
+    def step(job_context: CallbackContext, planned: float):
+        pacing._send_message(job_context, job_context.job.context[0].chat_id, 'step')
+        lateness.append(time.monotonic() - planned)
+        if len(lateness) == total:
+            finished.set()
+
+    job_queue.start()
+    started = time.monotonic()
+    for chat_id in range(conversations):
+        script = pacing.Script(chat_id)
+        planned = time.monotonic()
+        for _ in range(steps):
+            gap_sec = random.uniform(0.05, 0.5)
+            planned += gap_sec
+            script.wait(gap_sec).call(step, planned)
+        script.start(context)
+
+    threads = threading.active_count()
+    while not finished.wait(0.05):
+        threads = max(threads, threading.active_count())
+    elapsed = time.monotonic() - started
+    job_queue.stop()
+    lateness.sort()
+    return {'wall_sec': elapsed,
+            'steps_per_sec': total / elapsed,
+            'late_avg': sum(lateness) / total,
+            'late_p95': lateness[int(total * 0.95)],
+            'threads': threads}
+
+
+def _legacy_menu(filename: str) -> str:
+    # The loop command_help and ask_sf used to run on every call.
+    import common
+
+    menu_str = ''
+    for command, desc in common.build_tuple_of_tuples(filename):
+        menu_str += '/{}\t{}\n'.format(command, desc)
+    return menu_str.strip()
+
+
+def bench_replay(args):
+    # The simulated load of a tenth of --sessions chats, recorded, then each chat replayed from its recording.
+    import recording
+    import replay
+    import simulator
+
+    with tempfile.TemporaryDirectory() as dir_path:
+        path = os.path.join(dir_path, 'recording.jsonl')
+        simulator.run_load(args.sessions // 10, seed=args.seed, record_path=path)
+        events = recording.read(path)
+    started = time.perf_counter()
+    reports = [replay.replay(chat_id, chat_events) for chat_id, chat_events in events.items()]
+    elapsed = time.perf_counter() - started
+    identical = sum(1 for report in reports if replay.is_identical(report))
+    virtual_sec = sum(report['virtual_sec'] for report in reports)
+    print('replay: {:d} chats, {:d} identical, {:d} messages, timing off by up to {:.3f} s'
+          .format(len(reports), identical, sum(report['replayed'] for report in reports),
+                  max((report['max_delta'] for report in reports), default=0.0)))
+    print('  {:.0f} s of sessions replayed in {:.2f} s, {:.0f}x'.format(virtual_sec, elapsed, virtual_sec / elapsed))
+    if identical < len(reports):
+        sys.exit('replay: {:d} chats replayed differently'.format(len(reports) - identical))
+
+
+def bench_render(args):
+    # Menus and informative messages rendered on every call against looked up.
+    import render
+
+    for filename in ('help.pv', 'duration_sf.pv'):
+        if render.menu(filename) != _legacy_menu(filename):
+            raise AssertionError('{}: the menus differ'.format(filename))
+    filenames = ('help.pv', 'duration_sf.pv')
+    legacy_menu = _time_per_call(_legacy_menu, filenames, args.rounds)
+    cached_menu = _time_per_call(render.menu, filenames, args.rounds)
+    templates = [('{:d}분 남았습니다.', (1,)), ('설정된 타이머 시간에 도달했습니다.', ()),
+                 ('(설정된 타이머 시간에 도달했습니다.)\n{:d}분 뒤 재개: {:d}세트 중 {:d}세트 완료', (5, 3, 1))]
+    legacy_informative = _time_per_call(lambda item: '`({})`'.format(item[0].format(*item[1])), templates, args.rounds)
+    cached_informative = _time_per_call(lambda item: render.informative(*item), templates, args.rounds)
+    print('render:')
+    print('  menu        {:8.0f} ns built, {:8.0f} ns cached'.format(legacy_menu * 1e9, cached_menu * 1e9))
+    print('  informative {:8.0f} ns built, {:8.0f} ns cached and escaped'
+          .format(legacy_informative * 1e9, cached_informative * 1e9))
+
+
+def bench_runtime(args):
+    # The same paced conversations on the thread-based JobQueue and on the asyncio runtime.
+    from telegram.ext import JobQueue
+    import aio
+
+    conversations, steps = args.sessions, 5
+    print('runtime: {:d} conversations of {:d} paced steps'.format(conversations, steps))
+    for name, job_queue in (('threads', JobQueue()), ('asyncio', aio.AsyncJobQueue())):
+        random.seed(args.seed)
+        report = _run_conversations(job_queue, conversations, steps)
+        print('  {:8s} {:8.0f} steps/s, late {:8.1f} ms avg, {:8.1f} ms p95, {:d} threads'
+              .format(name, report['steps_per_sec'], report['late_avg'] * 1e3, report['late_p95'] * 1e3,
+                      report['threads']))
+
+
+BENCHMARKS = {
+    'admission': bench_admission,
+    'corpus': bench_corpus,
+    'intent': bench_intent,
+    'logging': bench_logging,
+    'media': bench_media,
+    'metrics': bench_metrics,
+    'recovery': bench_recovery,
+    'render': bench_render,
+    'replay': bench_replay,
+    'runtime': bench_runtime,
+    'shards': bench_shards,
+    'simulate': bench_simulate,
+    'startup': bench_startup,
+    'stress': bench_stress,
+    'tenants': bench_tenants,
+    'transport': bench_transport,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run benchmarks.')
+    parser.add_argument('names', nargs='*', metavar='name',
+                        help='Benchmarks to run, out of {} (default: all)'.format(', '.join(sorted(BENCHMARKS))))
+    parser.add_argument('--rounds', type=int, default=2000, help='Repetitions of each measured loop')
+    parser.add_argument('--sessions', type=int, default=10000,
+                        help='Number of persisted sessions; a tenth of it for simulated chats')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random module')
+    parser.add_argument('--workers', type=int, default=8, help='Worker threads of the stress, admission and transport tests')
+    parser.add_argument('--shards', type=int, default=4, help='Worker processes of the sharded simulation')
+    parser.add_argument('--tenants', type=int, default=4, help='Bots of the multi-tenant comparison')
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark: {}'.format(name))
+
+    for name in args.names or sorted(BENCHMARKS):
+        BENCHMARKS[name](args)
+
+
+if __name__ == '__main__':
+    main()
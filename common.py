@@ -1,14 +1,54 @@
+import mmap
 import random
+import re
+import struct
 import time
 import os
+import threading
 
+# Seconds between mtime/size checks of a cached file. 0 checks on every access.
+CORPUS_CHECK_INTERVAL_SEC = 1.0
 
-def sleep_random_seconds(min_sec: float = 1.8, max_sec: float = 2.4):
-    time.sleep(random.uniform(min_sec, max_sec))
+# Directory of the .pv files. Each tenant's copy of this module reads its own, see tenant.py.
+CORPUS_DIR = '.'
 
+# path -> [checked_at, mtime_ns, size, lines, rows]
+_corpus_cache = {}
+_corpus_lock = threading.Lock()
+corpus_stats = {'hits': 0, 'misses': 0}
 
-def get_random_bool(threshold: float = 0.5) -> bool:
-    return True if random.uniform(0, 1) <= threshold else False
+# In the .pv files, a comma written as "\," is part of the cell instead of separating cells.
+_ESCAPED_COMMA = '\\,'
+_UNESCAPED_COMMA = re.compile(r'(?<!\\),')
+
+# The compiled corpus, see corpus.py. Little-endian:
+#   magic, u32 file count, u32 offset of the text,
+#   per file: u32 name offset, u32 name length, u32 offset of its line table, u32 line count,
+#   per file: u32 offsets of its lines into the text, one more than the lines,
+#   the text: UTF-8 lines whose cells are separated by CELL_SEPARATOR.
+BUNDLE_MAGIC = b'CSBTPV01'
+BUNDLE_HEADER = struct.Struct('<8sII')
+BUNDLE_ENTRY = struct.Struct('<IIII')
+BUNDLE_OFFSET = struct.Struct('<I')
+CELL_SEPARATOR = '\x1f'
+
+# filename -> (lines, rows) served instead of the .pv files: the mapped bundle, or the version last published
+# by corpus.CorpusWatcher. Replaced as a whole and never changed in place, so a reader sees one version.
+_published = {}
+_corpus_version = 0
+
+
+# The draws take the generator to draw from: the random module, or the random.Random of a session.
+def random_seconds(min_sec: float = 1.8, max_sec: float = 2.4, rng=random) -> float:
+    return rng.uniform(min_sec, max_sec)
+
+
+def sleep_random_seconds(min_sec: float = 1.8, max_sec: float = 2.4, rng=random):
+    time.sleep(random_seconds(min_sec, max_sec, rng))
+
+
+def get_random_bool(threshold: float = 0.5, rng=random) -> bool:
+    return True if rng.uniform(0, 1) <= threshold else False
 
 
 def check_dir_exists(dir_path: str):
@@ -24,14 +64,165 @@ def read_from_file(path: str):
         return f.read().strip('\n')
 
 
+def read_config(path: str) -> dict:
+    # Rows of "key,value". A missing file leaves every option at its default.
+    if not os.path.exists(path):
+        return {}
+    config = {}
+    for row in build_tuple_of_tuples(path):
+        if row[0].strip():
+            config[row[0].strip()] = ','.join(row[1:]).strip()
+    return config
+
+
+def corpus_path(filename: str) -> str:
+    # Path of a file of the corpus directory.
+    return filename if CORPUS_DIR == '.' else os.path.join(CORPUS_DIR, filename)
+
+
+def _load_corpus(path: str) -> list:
+    # Return the cache entry of the file, (re)loading it only if it has changed.
+    now = time.monotonic()
+    entry = _corpus_cache.get(path)
+    if entry and now - entry[0] < CORPUS_CHECK_INTERVAL_SEC:
+        corpus_stats['hits'] += 1
+        return entry
+
+    stat = os.stat(path)
+    with _corpus_lock:
+        entry = _corpus_cache.get(path)
+        if entry and entry[1] == stat.st_mtime_ns and entry[2] == stat.st_size:
+            entry[0] = now
+            corpus_stats['hits'] += 1
+            return entry
+
+        lines, rows = parse_corpus(read_from_file(path))
+        entry = [now, stat.st_mtime_ns, stat.st_size, lines, rows]
+        _corpus_cache[path] = entry
+        corpus_stats['misses'] += 1
+        return entry
+
+
+def split_row(line: str) -> tuple:
+    if '\\' not in line:
+        return tuple(line.split(','))
+    return tuple(cell.replace(_ESCAPED_COMMA, ',') for cell in _UNESCAPED_COMMA.split(line))
+
+
+def parse_corpus(text: str) -> tuple:
+    # Return (lines, rows) of the content of a .pv file.
+    lines = text.split('\n')
+    rows = tuple(split_row(line) for line in lines)
+    return tuple(line.replace(_ESCAPED_COMMA, ',') for line in lines), rows
+
+
 def build_tuple(path: str):
-    content = read_from_file(path)
-    return tuple(content.split('\n'))
+    published = _published.get(path)
+    if published is not None:
+        return published[0]
+    return _load_corpus(corpus_path(path))[3]
 
 
 def build_tuple_of_tuples(path: str):
-    lines = build_tuple(path)
-    info = []
-    for line in lines:
-        info.append(tuple(line.split(',')))
-    return tuple(info)
+    published = _published.get(path)
+    if published is not None:
+        return published[1]
+    return _load_corpus(corpus_path(path))[4]
+
+
+def publish_corpus(files: dict) -> int:
+    # Serve the files {filename: (lines, rows)} from now on instead of the previous version. Returns its number.
+    global _published, _corpus_version
+    with _corpus_lock:
+        _published = dict(files)
+        _corpus_version += 1
+        return _corpus_version
+
+
+def get_published_corpus() -> dict:
+    return _published
+
+
+def get_corpus_version() -> int:
+    # 0 until a version is published.
+    return _corpus_version
+
+
+class BundledLines:
+    # Lines of a file in the mapped bundle, decoded on access. A read-only sequence like the tuples
+    # of build_tuple (or of build_tuple_of_tuples if as_rows), so random.choice picks without parsing.
+    __slots__ = ('_buffer', '_table', '_count', '_text', '_as_rows')
+
+    def __init__(self, buffer, table: int, count: int, text: int, as_rows: bool):
+        self._buffer = buffer
+        self._table = table
+        self._count = count
+        self._text = text
+        self._as_rows = as_rows
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(self[i] for i in range(*index.indices(self._count)))
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError('line index out of range')
+        offset = self._table + index * BUNDLE_OFFSET.size
+        start, = BUNDLE_OFFSET.unpack_from(self._buffer, offset)
+        end, = BUNDLE_OFFSET.unpack_from(self._buffer, offset + BUNDLE_OFFSET.size)
+        line = str(self._buffer[self._text + start:self._text + end], 'utf-8')
+        if self._as_rows:
+            return tuple(line.split(CELL_SEPARATOR))
+        return line.replace(CELL_SEPARATOR, ',')
+
+
+def read_bundle(buffer) -> dict:
+    # Return {filename: (line count, offset of its line table, offset of the text)} of the bundle in the buffer.
+    magic, count, text = BUNDLE_HEADER.unpack_from(buffer, 0)
+    if magic != BUNDLE_MAGIC:
+        raise ValueError('not a corpus bundle')
+    entries = {}
+    for i in range(count):
+        name_offset, name_length, table, lines = BUNDLE_ENTRY.unpack_from(buffer, BUNDLE_HEADER.size + i * BUNDLE_ENTRY.size)
+        entries[str(buffer[name_offset:name_offset + name_length], 'utf-8')] = (lines, table, text)
+    return entries
+
+
+def load_bundle(path: str) -> int:
+    # Map the compiled corpus and serve its files from it. Returns the number of files.
+    # The pages are shared by every process mapping the same bundle.
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    loaded = {}
+    for name, (lines, table, text) in read_bundle(buffer).items():
+        loaded[name] = (BundledLines(buffer, table, lines, text, as_rows=False),
+                        BundledLines(buffer, table, lines, text, as_rows=True))
+    publish_corpus(loaded)
+    return len(loaded)
+
+
+def unload_bundle():
+    # Serve every file from the .pv files again.
+    publish_corpus({})
+
+
+def preload_corpus(dir_path: str = None, extension: str = '.pv'):
+    # Load every phrase file in the directory, CORPUS_DIR by default, into the cache.
+    dir_path = dir_path or CORPUS_DIR
+    for filename in sorted(os.listdir(dir_path)):
+        if filename.endswith(extension) and filename != 'token.pv' and filename not in _published:
+            path = filename if dir_path == '.' else os.path.join(dir_path, filename)
+            _load_corpus(path)
+
+
+def get_corpus_stats() -> dict:
+    return {'hits': corpus_stats['hits'], 'misses': corpus_stats['misses'], 'files': len(_corpus_cache),
+            'published': len(_published), 'version': _corpus_version}
+
+
+def clear_corpus_cache():
+    with _corpus_lock:
+        _corpus_cache.clear()
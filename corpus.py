@@ -0,0 +1,267 @@
+# Validates the .pv phrase files, compiles them into one bundle for common.load_bundle
+# and watches them for changes while the bot runs.
+# Run `python corpus.py [directory]` after editing the phrases; `--check` only validates.
+import argparse
+import logging
+import os
+import re
+import string
+import sys
+import threading
+
+import common
+
+# Seconds between two scans of the directory by CorpusWatcher.
+WATCH_INTERVAL_SEC = 1.0
+
+# Files read whole or holding settings rather than phrases.
+NOT_PHRASES = ('token.pv', 'config.pv', 'contact.pv', 'orientation.pv')
+
+COLUMN_COMMAND = 'command'
+COLUMN_COUNT = 'count'
+COLUMN_TEXT = 'text'
+
+# The cells every row of these files must have. Rows of the other files have any number of text cells.
+COLUMNS = {
+    'help.pv': (COLUMN_COMMAND, COLUMN_TEXT),
+    'duration_sf.pv': (COLUMN_COMMAND, COLUMN_TEXT),
+    '02-0-1.pv': (COLUMN_COUNT, COLUMN_COUNT, COLUMN_COUNT),  # Rubbing minutes, pause minutes, sets.
+}
+
+# Rows the handlers index directly: the two orders of help.pv, success and failure of duration_sf.pv.
+MIN_ROWS = {
+    'help.pv': 2,
+    'duration_sf.pv': 2,
+}
+
+# Cells containing the marker are formatted with that many arguments: filename -> (marker, arguments).
+# A placeholder in any other cell would be sent as it is.
+FORMATTED = {
+    '02-0-3.pv': ('세트', 1),  # The number of sets done.
+}
+
+_COMMAND = re.compile(r'^[\da-z_]{1,32}$', re.IGNORECASE)  # As telegram.ext.CommandHandler accepts.
+_formatter = string.Formatter()
+
+logger = logging.getLogger(__name__)
+
+
+def _is_phrase_file(filename: str) -> bool:
+    return filename.endswith('.pv') and filename not in NOT_PHRASES
+
+
+def _check_cell(filename: str, kind: str, cell: str):
+    # Return what is wrong with the cell, or None.
+    if not cell.strip():
+        return 'empty cell'
+    if kind == COLUMN_COUNT:
+        return None if cell.strip().isdigit() and int(cell) > 0 else '{!r} is not a positive integer'.format(cell)
+    if kind == COLUMN_COMMAND:
+        return None if _COMMAND.match(cell) else '{!r} is not a valid command'.format(cell)
+
+    marker, arguments = FORMATTED.get(filename, (None, 0))
+    if marker and marker in cell:
+        try:
+            cell.format(*range(arguments))
+        except (IndexError, KeyError, ValueError) as e:
+            return '{!r} does not format with {:d} argument(s): {}'.format(cell, arguments, e)
+        return None
+    try:
+        fields = [field for _, field, _, _ in _formatter.parse(cell) if field is not None]
+    except ValueError:
+        fields = []
+    return '{!r} has a placeholder that is never filled'.format(cell) if fields else None
+
+
+def validate(filename: str, lines: tuple) -> list:
+    # Return [(line number, message)] of the problems in the lines of the file.
+    errors = []
+    columns = COLUMNS.get(filename)
+    for number, line in enumerate(lines, 1):
+        if common.CELL_SEPARATOR in line:
+            errors.append((number, 'contains the control character \\x1f'))
+            continue
+        cells = common.split_row(line)
+        if columns and len(cells) != len(columns):
+            errors.append((number, '{:d} cell(s), expected {:d}; write a comma inside a cell as \\,'
+                           .format(len(cells), len(columns))))
+            continue
+        for i, cell in enumerate(cells):
+            problem = _check_cell(filename, columns[i] if columns else COLUMN_TEXT, cell)
+            if problem:
+                errors.append((number, 'cell {:d}: {}'.format(i + 1, problem)))
+    if len(lines) < MIN_ROWS.get(filename, 1):
+        errors.append((len(lines), '{:d} row(s), expected at least {:d}'.format(len(lines), MIN_ROWS[filename])))
+    return errors
+
+
+def build_bundle(files: dict) -> bytes:
+    # files: {filename: rows}. See common.BUNDLE_MAGIC for the layout.
+    names = sorted(files)
+    encoded_names = [name.encode('utf-8') for name in names]
+    names_start = common.BUNDLE_HEADER.size + len(names) * common.BUNDLE_ENTRY.size
+    tables_start = names_start + sum(len(name) for name in encoded_names)
+    text_start = tables_start + sum(len(files[name]) + 1 for name in names) * common.BUNDLE_OFFSET.size
+
+    entries, tables, text = [], [], []
+    name_offset, table_offset, text_offset = names_start, tables_start, 0
+    for name, encoded_name in zip(names, encoded_names):
+        rows = files[name]
+        entries.append(common.BUNDLE_ENTRY.pack(name_offset, len(encoded_name), table_offset, len(rows)))
+        name_offset += len(encoded_name)
+        table_offset += (len(rows) + 1) * common.BUNDLE_OFFSET.size
+        tables.append(common.BUNDLE_OFFSET.pack(text_offset))
+        for row in rows:
+            encoded = common.CELL_SEPARATOR.join(row).encode('utf-8')
+            text.append(encoded)
+            text_offset += len(encoded)
+            tables.append(common.BUNDLE_OFFSET.pack(text_offset))
+
+    header = common.BUNDLE_HEADER.pack(common.BUNDLE_MAGIC, len(names), text_start)
+    return b''.join([header] + entries + encoded_names + tables + text)
+
+
+def compile_corpus(dir_path: str) -> tuple:
+    # Return (bundle, [(path, line number, message)]) of the phrase files in the directory.
+    files, errors = {}, []
+    for filename in sorted(os.listdir(dir_path)):
+        if not _is_phrase_file(filename):
+            continue
+        path = os.path.join(dir_path, filename)
+        lines = tuple(common.read_from_file(path).split('\n'))
+        errors.extend((path, number, message) for number, message in validate(filename, lines))
+        files[filename] = tuple(common.split_row(line) for line in lines)
+    return build_bundle(files), errors
+
+
+class CorpusWatcher:
+    # Polls the directory of the phrase files and publishes a new corpus version when they change.
+    # A changed file is only taken once it stayed the same over two scans, and a version is only
+    # published if every changed file validates, so a half-written file is never served.
+    def __init__(self, dir_path: str = '.', interval: float = WATCH_INTERVAL_SEC):
+        self.dir_path = dir_path
+        self.interval = interval
+        self.listeners = []  # Called with (version, changed filenames) on the watcher's thread.
+        self._seen = {}  # filename -> (mtime_ns, size) the published version was read at.
+        self._pending = {}  # filename -> (mtime_ns, size), or None if deleted, at the last scan.
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def scan(self) -> dict:
+        # Return {filename: (mtime_ns, size)} of the phrase files.
+        stats = {}
+        for entry in os.scandir(self.dir_path):
+            if _is_phrase_file(entry.name):
+                stat = entry.stat()
+                stats[entry.name] = (stat.st_mtime_ns, stat.st_size)
+        return stats
+
+    def load(self) -> list:
+        # Read and publish every phrase file now. Returns the problems found, as compile_corpus does.
+        stats = self.scan()
+        files, errors = self._read(stats, common.get_published_corpus())
+        self._seen = stats
+        common.publish_corpus(files)
+        return errors
+
+    def is_newer_than(self, bundle_path: str) -> bool:
+        # Whether the phrase files changed since the bundle was compiled: one was written after it, added or removed.
+        stats = self.scan()
+        with open(bundle_path, 'rb') as f:
+            mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+            names = common.read_bundle(f.read())
+        return set(names) != set(stats) or any(stat[0] > mtime_ns for stat in stats.values())
+
+    def assume_loaded(self):
+        # The published version, e.g. a bundle, was compiled from the files as they are now.
+        self._seen = self.scan()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='corpus', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+
+    def poll(self) -> int:
+        # Scan once and publish the settled changes. Returns the new version, or None.
+        current = self.scan()
+        changed = {name for name in set(current) | set(self._seen) if current.get(name) != self._seen.get(name)}
+        settled = {name for name in changed if name in self._pending and self._pending[name] == current.get(name)}
+        self._pending = {name: current.get(name) for name in changed}
+        if not changed or settled != changed:
+            return None
+
+        stats = {name: current.get(name) for name in changed}
+        files, errors = self._read(stats, common.get_published_corpus())
+        self._pending = {}
+        for name in changed:
+            self._seen.pop(name, None)
+            if current.get(name):
+                self._seen[name] = current[name]
+        if errors:
+            for path, number, message in errors:
+                logger.warning('{}:{:d}: {}'.format(path, number, message))
+            logger.warning('Corpus not reloaded: {} kept at version {:d}'
+                           .format(', '.join(sorted(changed)), common.get_corpus_version()))
+            return None
+
+        version = common.publish_corpus(files)
+        logger.info('Corpus version {:d}: {} reloaded'.format(version, ', '.join(sorted(changed))))
+        for listener in self.listeners:
+            listener(version, changed)
+        return version
+
+    def _read(self, stats: dict, published: dict) -> tuple:
+        # Return (published files with those of the stats read again, problems found).
+        files, errors = dict(published), []
+        for name, stat in stats.items():
+            if stat is None:
+                files.pop(name, None)
+                continue
+            path = os.path.join(self.dir_path, name)
+            try:
+                text = common.read_from_file(path)
+            except OSError as e:
+                errors.append((path, 0, str(e)))
+                continue
+            errors.extend((path, number, message) for number, message in validate(name, tuple(text.split('\n'))))
+            files[name] = common.parse_corpus(text)
+        return files, errors
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.poll()
+            except OSError as e:
+                logger.warning('Failed to scan the corpus: {}'.format(e))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Validate the .pv phrase files and compile them into a bundle.')
+    parser.add_argument('directory', nargs='?', default='.', help='Directory of the .pv files')
+    parser.add_argument('--output', default='corpus.bin', help='Path of the bundle to write')
+    parser.add_argument('--check', action='store_true', help='Only validate the files')
+    args = parser.parse_args()
+
+    bundle, errors = compile_corpus(args.directory)
+    for path, number, message in errors:
+        print('{}:{:d}: {}'.format(path, number, message), file=sys.stderr)
+    if errors:
+        sys.exit(1)
+    if args.check:
+        return
+
+    # Replace the file rather than rewrite it, as running bots may have the old one mapped.
+    temp_path = args.output + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(bundle)
+    os.replace(temp_path, args.output)
+    files = len(common.read_bundle(bundle))
+    print('{:d} files compiled into {} ({:d} bytes).'.format(files, args.output, len(bundle)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,93 +1,246 @@
 # https://python-telegram-bot.readthedocs.io/en/stable/
-import time
 import datetime
+import functools
+import json
+import os
+import signal
+import threading
+import time
+import zlib
 
-import schedule
-from threading import Thread
-import random
+import pytz
 import re
 import telegram
 from telegram import Update
-from telegram.ext import Updater, CommandHandler, CallbackContext, MessageHandler, Filters
+from telegram.ext import (Updater, CommandHandler, CallbackContext, MessageHandler, Filters, TypeHandler,
+                          DispatcherHandlerStop)
+import aio
 import common
+import corpus
+import inbound
+import intent
+import jobs
+import logs
+import media
+import metrics
+import outbound
+import pacing
+import persistence
+import recording
+import render
+import shard
+import state
+import tenant
+import transport
+import webhook
 import logging
 
 
 class Constants:
-    BOT_TOKEN = common.read_from_file('token.pv')
+    TOKEN_PATH = 'token.pv'
+    CONFIG_PATH = 'config.pv'
+    CORPUS_BUNDLE_PATH = 'corpus.bin'
+    MEDIA_DB_PATH = 'media.db'
+    STATE_DB_PATH = 'state.db'
 
     PROBABILITY_ALLOWED = 1.1  # Decrease below 1 later.(1 => 100% allowed)
+    DEFAULT_TIMEZONE = 'Asia/Seoul'
+    WORKERS = 8  # Threads running the handlers of different chats in parallel.
+    RENEWAL_TIME = datetime.time(9, 0)  # Local time of a chat to renew allowing rubbing.
+    RENEWAL_SPREAD_SEC = 600  # Renewals of the chats are spread over this period after RENEWAL_TIME.
     SEC_SESSION_COOLDOWN = 3600
     LITTLE_TIME_MIN = 1
 
+    # Chances to play a recording of media.VOICE_DIR along with the lines.
+    VOICE_OCCASIONALLY = 0.2
+    VOICE_FREQUENTLY = 0.7
+    VOICE_GO = 'go'
+    VOICE_DONT = 'dont'
+    VOICE_SUCCESSFUL = 's'
+    VOICE_FAILED = 'f'
+
     JOB_TIMER = 'timer'
     JOB_LITTLE_LEFT = 'little_left'
     JOB_ACTIVATE = 'activate'
-    JOB_INFORM_CYCLE_STATUS = 'inform_cycle_status'
-    JOB_DECLARE_START = 'declare_start'
+    JOB_CYCLE = 'cycle'
     JOB_ASK_SF = 'ask_sf'
+    JOB_RENEW = 'renew'
+    SESSION_JOBS = (JOB_TIMER, JOB_LITTLE_LEFT, JOB_CYCLE, JOB_ASK_SF, JOB_ACTIVATE)
 
 
-# Whether to allow rubbing or not: refreshed daily.
-is_allowed: bool = True
-denial_count: int = 0
+# Per-chat session state, keyed by chat_id.
+sessions = state.SessionStore()
 
-# Specifying behavior of rubbing
-is_direction_given: bool = False
-is_to_suppress: bool = True
-is_sup_inter_recording: bool = False
+# CommandHandlers of the commands named in the corpus, by role as in corpus_command_names.
+corpus_command_handlers = {}
 
-# Activity sf handlers
-is_s_listening: bool = False
-is_f_listening: bool = False
-is_duration_successful: bool = False
+# Snapshots of the sessions on disk. None if not persisting.
+state_store: persistence.Persistence = None
 
-# Activity of a session
-is_active: bool = True
-reactivated_time: datetime = datetime.datetime.now()
+logger = logging.getLogger(__name__)
 
-rubbing_min: int = 0
-pause_min: int = 0
-repeat: int = 0
-cycle_number: int = 0
 
-# Enable logging.
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
-logger = logging.getLogger(__name__)
+def get_session(chat_id) -> state.Session:
+    return sessions.get(chat_id)
+
+
+def chat_lock(chat_id):
+    # Serializes the handlers and jobs of a chat. Reentrant, as a handler may run job callbacks inline.
+    return get_session(chat_id).lock
+
+
+def touch(chat_id) -> None:
+    # Mark the chat's session as changed, to be persisted in the next batch.
+    if state_store is not None:
+        state_store.touch(chat_id)
+
+
+def snapshot_chat(chat_id):
+    if chat_id not in sessions:
+        return None, None, {}
+    with chat_lock(chat_id):
+        plan = jobs.registry.get_plan(chat_id)
+        return (get_session(chat_id).snapshot(), plan.snapshot() if plan else None,
+                jobs.registry.due_times(chat_id, Constants.SESSION_JOBS))
+
+
+def restore_sessions(context: CallbackContext, loaded: list) -> None:
+    # Restore the persisted sessions and re-arm their timers with the time remaining.
+    callbacks = {Constants.JOB_TIMER: go_off, Constants.JOB_LITTLE_LEFT: has_little_left,
+                 Constants.JOB_CYCLE: advance_cycle, Constants.JOB_ASK_SF: ask_sf,
+                 Constants.JOB_ACTIVATE: activate_session}
+    now = jobs.registry.now()
+    for chat_id, data, plan, due_times in loaded:
+        session = get_session(chat_id)
+        session.restore(data)
+        if plan:
+            jobs.registry.set_plan(chat_id, jobs.CyclePlan(*plan))
+        for kind, due in due_times.items():
+            if kind in callbacks:
+                jobs.registry.run_once(context, callbacks[kind], max(0.0, due - now), chat_id, kind)
+        if session.is_direction_given and not any(kind in callbacks for kind in due_times):
+            # The scripts are not persisted: the one that was to give the rest of the direction, and unlock it, is lost.
+            unlock_ordering(session)
+        schedule_renewal(chat_id, context)
+        if recording.recorder.is_recording:
+            recording.recorder.session(chat_id, recording.SESSION_RESTORED, (session.snapshot(), plan, due_times))
+
+
+def tracked(callback):
+    # Wrap a handler callback to run in the chat's lane holding the chat's lock,
+    # keep the daily renewal of the chat and persist its session after it ran.
+    timed_callback = metrics.recorder.timed(metrics.HANDLER_SECONDS, callback, handler=callback.__name__)
+
+    def run(update: Update, context: CallbackContext):
+        chat_id = update.effective_chat.id
+        started = time.perf_counter()
+        with chat_lock(chat_id):
+            if not jobs.registry.get(chat_id, Constants.JOB_RENEW):
+                schedule_renewal(chat_id, context)
+            try:
+                timed_callback(update, context)
+            finally:
+                touch(chat_id)
+                logs.event(logger, logging.DEBUG, 'handled', chat_id=chat_id, session=get_session(chat_id).serial,
+                           handler=callback.__name__, elapsed_ms=logs.elapsed_ms(started))
+
+    @functools.wraps(callback)
+    def wrapper(update: Update, context: CallbackContext):
+        chat = update.effective_chat
+        if chat is None:
+            return callback(update, context)
+        inbound.lanes.submit(chat.id, run, update, context)
+    return wrapper
+
+
+def intent_of(update: Update):
+    # What the update asks for, to coalesce repeats: the command, or the intent of a message. None if nothing.
+    message = update.effective_message
+    if message is None or not message.text:
+        return None
+    if message.text.startswith('/'):
+        return message.text.split(None, 1)[0].split('@', 1)[0].lower()
+    return intent.classify(message.text)
+
+
+def admit(update: Update, context: CallbackContext) -> None:
+    # The first handler of every update: stops those refused by inbound.admission before they reach a lane.
+    chat = update.effective_chat
+    chat_id = chat.id if chat else None
+    verdict = inbound.admission.admit(update.update_id, chat_id, intent_of(update))
+    if verdict == inbound.DROPPED_DUPLICATE:
+        logs.event(logger, logging.INFO, 'update_dropped', chat_id=chat_id, update_id=update.update_id, reason=verdict)
+        raise DispatcherHandlerStop()
+    if state_store is not None:
+        state_store.set_value('last_update_id', update.update_id)
+    if verdict == inbound.ADMITTED:
+        if recording.recorder.is_recording and chat_id is not None:
+            record_update(chat_id, update)
+        return
+
+    logs.event(logger, logging.DEBUG, 'update_dropped', chat_id=chat_id, update_id=update.update_id, reason=verdict)
+    if verdict == inbound.DROPPED_OVERFLOW and inbound.admission.take_notice(chat_id):
+        send_informative_message(chat_id, context, '메시지가 너무 많아 잠시 일부를 건너뜁니다.')
+    raise DispatcherHandlerStop()
+
+
+def record_update(chat_id, update: Update) -> None:
+    # Record the session of the chat the first time, as it is before the update. Then the update.
+    if not recording.recorder.has_session(chat_id):
+        kind = recording.SESSION_RESTORED if chat_id in sessions else recording.SESSION_NEW
+        get_session(chat_id)
+        recording.recorder.session(chat_id, kind, snapshot_chat(chat_id))
+    recording.recorder.update(chat_id, update.to_dict())
 
 
 def command_help(update: Update, context: CallbackContext):
-    commands = common.build_tuple_of_tuples('help.pv')
-    command_help_str = ''
-    for help_item in commands:
-        command, desc = help_item
-        command_help_str += '/{}\t{}\n'.format(command, desc)
-
     # Reply to the command.
-    update.effective_message.reply_text(str.strip(command_help_str))
+    reply(context, update.effective_message, render.menu('help.pv'))
 
     # Send a confirmation message occasionally.
-    confirmation = random.choice(common.build_tuple('help_additional.pv'))
+    chat_id = update.effective_message.chat_id
+    rng = get_session(chat_id).rng
+    confirmation = rng.choice(common.build_tuple('help_additional.pv'))
 
     # Append the confirmation message.
-    if common.get_random_bool(0.1):
-        common.sleep_random_seconds(2, 4)
-        context.bot.send_message(chat_id=update.effective_message.chat_id, text=confirmation)
+    if common.get_random_bool(0.1, rng):
+        script = pacing.Script(chat_id, rng)
+        script.pause(2, 4).send(confirmation)
+        script.start(context)
 
 
-def schedule_checker():
-    while True:
-        # Check pending jobs.
-        schedule.run_pending()
-        common.sleep_random_seconds(3000, 4200)
+def renew_allowing_rubbing(context: CallbackContext):
+    session = get_session(context.job.context)
+    session.is_allowed = common.get_random_bool(Constants.PROBABILITY_ALLOWED, session.rng)
+    session.denial_count = 0
+    touch(session.chat_id)
+    logs.event(logger, logging.INFO, 'renewed', chat_id=session.chat_id, session=session.serial,
+               is_allowed=session.is_allowed)
 
 
-def renew_allowing_rubbing():
-    global is_allowed
-    global denial_count
-    is_allowed = common.get_random_bool(Constants.PROBABILITY_ALLOWED)
-    print('is_allowed: {}'.format(str(is_allowed)))
-    denial_count = 0
+def schedule_renewal(chat_id, context: CallbackContext) -> None:
+    # Renew daily at RENEWAL_TIME in the chat's time zone, offset by a fixed amount per chat
+    # so that the chats don't all renew at the same moment.
+    remove_job_if_exists(chat_id, Constants.JOB_RENEW)
+    offset_sec = zlib.crc32(str(chat_id).encode()) % Constants.RENEWAL_SPREAD_SEC
+    renewal = datetime.datetime.combine(datetime.date.today(), Constants.RENEWAL_TIME)
+    renewal += datetime.timedelta(seconds=offset_sec)
+    time_of_day = renewal.time().replace(tzinfo=pytz.timezone(get_session(chat_id).timezone))
+    jobs.registry.run_daily(context, renew_allowing_rubbing, time_of_day, chat_id, Constants.JOB_RENEW)
+
+
+def set_timezone(update: Update, context: CallbackContext):
+    message = update.effective_message
+    chat_id = message.chat_id
+    if not context.args:
+        text, args = '현재 시간대는 {}입니다.', (get_session(chat_id).timezone,)
+    elif context.args[0] in pytz.all_timezones_set:
+        get_session(chat_id).timezone = context.args[0]
+        schedule_renewal(chat_id, context)
+        text, args = '시간대가 {}로 설정되었습니다.', (context.args[0],)
+    else:
+        text, args = '알 수 없는 시간대입니다.', ()
+    send_informative_message(chat_id, context, text, replied_message=message, args=args)
 
 
 def go_off(context: CallbackContext) -> None:
@@ -97,115 +250,115 @@ def go_off(context: CallbackContext) -> None:
 
 def has_little_left(context: CallbackContext) -> None:
     chat_id = context.job.context
-    send_informative_message(chat_id, context, '{:d}분 남았습니다.'.format(Constants.LITTLE_TIME_MIN))
+    send_informative_message(chat_id, context, '{:d}분 남았습니다.', args=(Constants.LITTLE_TIME_MIN,))
 
 
-def remove_job_if_exists(name: str, context: CallbackContext) -> bool:
-    # Remove job with given name. Returns whether job was removed.
+def remove_job_if_exists(chat_id, kind: str) -> bool:
+    # Remove the chat's jobs of the kind. Returns whether job was removed.
     # https://github.com/python-telegram-bot/python-telegram-bot/blob/master/examples/timerbot.py
-    current_jobs = context.job_queue.get_jobs_by_name(name)
-    if not current_jobs:
+    if not jobs.registry.remove(chat_id, kind):
         return False
-    for job in current_jobs:
-        job.schedule_removal()
-        print("{} job removed.".format(name))
+    logs.event(logger, logging.DEBUG, 'job_removed', chat_id=chat_id, kind=kind)
     return True
 
 
-def unlock_ordering() -> None:
-    global is_direction_given
-    if is_direction_given:
-        is_direction_given = False
-        print("Direction unlocked: new directions can be given.")
-    else:
-        print("Direction already unlocked. Don't change the state.")
+def cancel_session_jobs(chat_id) -> None:
+    # Remove the timers and cycles of the chat, e.g. when the session is reset.
+    removed = jobs.registry.cancel(chat_id, Constants.SESSION_JOBS)
+    jobs.registry.pop_plan(chat_id)
+    if removed:
+        logs.event(logger, logging.DEBUG, 'jobs_cancelled', chat_id=chat_id, count=removed)
 
 
-def lock_giving_direction() -> None:
-    global is_direction_given
-    if not is_direction_given:
-        is_direction_given = True
-        print("Direction locked: new directions won't be given.")
-    else:
-        print("Direction already locked. Don't change the state.")
+def unlock_ordering(session: state.Session) -> None:
+    logs.event(logger, logging.DEBUG, 'direction_unlocked', chat_id=session.chat_id, session=session.serial,
+               was_locked=session.is_direction_given)
+    session.is_direction_given = False
 
 
-def interpret_message(update: Update, context: CallbackContext) -> None:
-    global is_direction_given
+def lock_giving_direction(session: state.Session) -> None:
+    logs.event(logger, logging.DEBUG, 'direction_locked', chat_id=session.chat_id, session=session.serial,
+               was_locked=session.is_direction_given)
+    session.is_direction_given = True
+
 
+def interpret_message(update: Update, context: CallbackContext) -> None:
     message = update.effective_message
-    message_content = message.text
     chat_id = message.chat_id
     try:
-        if re.search("(몇\s?분|얼마).*요.?[?ㅜㅠ]$", message_content) and re.search("(보지|클리|자위)", message_content):
-            # A message about duration. Equivalent to /2.
+        found = intent.classify(message.text)
+        if found is None:
+            return
+        if found.kind == intent.INTENT_DURATION:
             give_2(update, context)
-        elif re.search("\d.?분.{0,6}(보지|클리|자위).*[할도면털].*요.?[?ㅜㅠ]$", message_content):
-            # A message about simple directions
-            duration_min = int(re.search(r'\d+', message_content).group())
-            common.sleep_random_seconds(2.8, 3.2)
-            send_go(context, chat_id)
-            common.sleep_random_seconds()
-            set_termination_timer(message, context, duration_min)
-        elif ((re.search("자위.*(하고.*싶.+|해도.+)[?ㅜㅠ]$", message_content) or
-               re.search("^(클리|보지).*\s((만지|비비|쑤시|털)|(만져|비벼|쑤셔)).*요.?[?ㅜㅠ]$", message_content)) and
-              not re.search("(몇\s?분|얼마)", message_content)):
-            # A message about posture. Equivalent to /1.
+        elif found.kind == intent.INTENT_TIMER:
+            script = pacing.Script(chat_id, get_session(chat_id).rng)
+            script.pause(2.8, 3.2)
+            send_go(script)
+            script.pause()
+            script.call(lambda job_context: set_termination_timer(message, job_context, found.duration_min))
+            script.start(context)
+        elif found.kind == intent.INTENT_POSTURE:
             give_1(update, context)
     except (IndexError, ValueError):
-        contact = common.read_from_file('contact.pv')
-        update.effective_message.reply_text('메시지를 처리할 수 없습니다. {}로 문제를 보고하고 문제가 해결될 때까지 기다리세요.'.format(contact))
+        contact = common.read_from_file(common.corpus_path('contact.pv'))
+        reply(context, update.effective_message, '메시지를 처리할 수 없습니다. {}로 문제를 보고하고 문제가 해결될 때까지 기다리세요.'.format(contact))
 
 
-def send_random_lines(chat_id, context: CallbackContext, filename: str, msg_before: str = None):
-    phrase = random.choice(common.build_tuple_of_tuples(filename))
+def send_random_lines(script: pacing.Script, filename: str, msg_before: str = None):
+    phrase = script.rng.choice(common.build_tuple_of_tuples(filename))
     for i, line in enumerate(phrase):
-        common.sleep_random_seconds()
+        script.pause()
         if i == 0 and msg_before:  # The first line and a message to add before the first line
-            context.bot.send_message(chat_id=chat_id, text=msg_before + line)
+            script.send(msg_before + line)
         else:
-            context.bot.send_message(chat_id=chat_id, text=line)
+            script.send(line)
+
+
+def play_voice(script: pacing.Script, kind: str, probability: float) -> None:
+    # Now and then, play one of the recordings of the kind, if there are any.
+    path = media.pick_voice(kind, probability, script.rng)
+    if path:
+        script.pause()
+        script.send_voice(path)
 
 
-def give_permission_to_start(message: telegram.Message, context: CallbackContext,
+def give_permission_to_start(script: pacing.Script, message: telegram.Message,
                              timer_min: int = 0, go_line: str = None):
     chat_id = message.chat_id
 
-    common.sleep_random_seconds(2.8, 3.2)
+    script.pause(2.8, 3.2)
     if go_line:
-        context.bot.send_message(chat_id=chat_id, text=go_line)
+        script.send(go_line)
     else:
-        send_go(context, chat_id)
+        send_go(script)
 
     if timer_min:
-        set_termination_timer(message, context, timer_min)
+        script.call(lambda context: set_termination_timer(message, context, timer_min))
     else:
-        inactivate(chat_id, context)
+        script.call(lambda context: inactivate(chat_id, context))
 
 
 def inactivate(chat_id, context: CallbackContext, duration_sec: int = Constants.SEC_SESSION_COOLDOWN):
-    global is_active, reactivated_time
+    session = get_session(chat_id)
 
     # Update reactivating time.
-    reactivated_time = datetime.datetime.now() + datetime.timedelta(seconds=duration_sec)
+    session.reactivated_time = datetime.datetime.fromtimestamp(jobs.registry.now() + duration_sec)
 
-    unlock_ordering()  # The past directions is no longer valid.
-    is_active = False  # Instead, the session is now inactive.
-    print('Session inactive for {:d} minutes.'.format(int(duration_sec / 60)))
-    context.job_queue.run_once(activate_session, Constants.SEC_SESSION_COOLDOWN,
-                               context=chat_id, name=Constants.JOB_ACTIVATE)
+    unlock_ordering(session)  # The past directions is no longer valid.
+    session.is_active = False  # Instead, the session is now inactive.
+    logs.event(logger, logging.INFO, 'inactivated', chat_id=chat_id, session=session.serial,
+               minutes=int(duration_sec / 60))
+    jobs.registry.run_once(context, activate_session, Constants.SEC_SESSION_COOLDOWN, chat_id, Constants.JOB_ACTIVATE)
 
 
-def send_go(context, chat_id):
-    # bot.send_voice(file_id)
-    # https://python-telegram-bot.readthedocs.io/en/stable/telegram.bot.html#telegram.Bot.send_voice
-    # https://rdrr.io/cran/telegram.bot/man/sendVoice.html
-    # TODO: Play recorded voice occasionally.
+def send_go(script: pacing.Script):
     # Give the start direction.
     go_line = '시작'
-    if common.get_random_bool():
+    if common.get_random_bool(rng=script.rng):
         go_line += '해'
-    context.bot.send_message(chat_id=chat_id, text=go_line)
+    script.send(go_line)
+    play_voice(script, Constants.VOICE_GO, Constants.VOICE_OCCASIONALLY)
 
 
 def send_incomplete_msg(update: Update, context: CallbackContext):
@@ -215,129 +368,152 @@ def send_incomplete_msg(update: Update, context: CallbackContext):
 
 
 def send_inactive_msg(update: Update, context: CallbackContext):
-    global reactivated_time
+    chat_id = update.effective_message.chat_id
+    reactivated_time = get_session(chat_id).reactivated_time
 
     hour = reactivated_time.strftime("%-H")
     minute = (reactivated_time + datetime.timedelta(minutes=1)).strftime("%-M")
 
-    text = '비활성화 상태입니다. {}시 {}분에 다시 활성화됩니다.'.format(hour, minute)
-    chat_id = update.effective_message.chat_id
-    send_informative_message(chat_id, context, text)
+    send_informative_message(chat_id, context, '비활성화 상태입니다. {}시 {}분에 다시 활성화됩니다.', args=(hour, minute))
 
 
 def inform_cycle_status(context: CallbackContext):
-    global pause_min, repeat, cycle_number
-    global is_sup_inter_recording
     chat_id = context.job.context
+    session = get_session(chat_id)
 
-    cycle_number += 1
-    send_informative_message(chat_id, context, '(설정된 타이머 시간에 도달했습니다.)\n{:d}분 뒤 재개: {:d}세트 중 {:d}세트 완료'
-                             .format(pause_min, repeat, cycle_number), is_parenthesis=False)
-    common.sleep_random_seconds()
+    session.cycle_number += 1
+    send_informative_message(chat_id, context, '(설정된 타이머 시간에 도달했습니다.)\n{:d}분 뒤 재개: {:d}세트 중 {:d}세트 완료',
+                             args=(session.pause_min, session.repeat, session.cycle_number), is_parenthesis=False)
+    script = pacing.Script(chat_id, session.rng)
+    script.pause()
 
     stop_line = common.build_tuple('02-1-3.pv')[0]
-    context.bot.send_message(chat_id=chat_id, text=stop_line)
+    script.send(stop_line)
 
-    if is_sup_inter_recording:
-        common.sleep_random_seconds()
-        phrase = random.choice(common.build_tuple_of_tuples('02-0-3.pv'))
+    if session.is_sup_inter_recording:
+        script.pause()
+        phrase = session.rng.choice(common.build_tuple_of_tuples('02-0-3.pv'))
         for line in phrase:
             if '세트' in line:
-                context.bot.send_message(chat_id=chat_id, text=line.format(cycle_number))
+                script.send(line.format(session.cycle_number))
             else:
-                context.bot.send_message(chat_id=chat_id, text=line)
-            common.sleep_random_seconds()
+                script.send(line)
+            script.pause()
     else:
-        send_random_lines(chat_id, context, 'conditioning.pv')
+        send_random_lines(script, 'conditioning.pv')
+    script.start(context)
 
 
 def declare_start(context: CallbackContext):
-    global rubbing_min
-    message = context.job.context
-    if isinstance(message, telegram.Message):
-        chat_id = message.chat_id
-        send_informative_message(chat_id, context, '{}분 타이머가 설정되었습니다.'.format(rubbing_min))
-        common.sleep_random_seconds(0.8, 1.2)
-        send_go(context, chat_id)
-
+    chat_id = context.job.context
+    rubbing_min = get_session(chat_id).rubbing_min
+    send_informative_message(chat_id, context, '{}분 타이머가 설정되었습니다.', args=(rubbing_min,))
+    script = pacing.Script(chat_id, get_session(chat_id).rng)
+    script.pause(0.8, 1.2)
+    send_go(script)
+    script.start(context)
 
-def ask_sf(context: CallbackContext):
-    remove_job_if_exists(Constants.JOB_INFORM_CYCLE_STATUS, context)
-    remove_job_if_exists(Constants.JOB_DECLARE_START, context)
-    remove_job_if_exists(Constants.JOB_TIMER, context)
-    remove_job_if_exists(Constants.JOB_LITTLE_LEFT, context)
 
-    global is_to_suppress
+def advance_cycle(context: CallbackContext):
+    # Fire the current transition of the chat's cycle plan and schedule only the next one.
     chat_id = context.job.context
+    plan = jobs.registry.get_plan(chat_id)
+    if plan is None:
+        return
+    current = plan.step(plan.step_index)
+    if current is None:
+        return
+
+    step = current[0]
+    delay_sec = plan.advance()
+    if delay_sec is not None:
+        jobs.registry.run_once(context, advance_cycle, delay_sec, chat_id, Constants.JOB_CYCLE)
+
+    if step == jobs.STEP_START:
+        declare_start(context)
+    elif step == jobs.STEP_PAUSE:
+        inform_cycle_status(context)
+    else:
+        ask_sf(context)
+
 
-    if is_to_suppress:
-        global repeat
-        send_informative_message(chat_id, context, '(설정된 타이머 시간에 도달했습니다.)\n{:d}세트 중 {:d}세트 완료.'.format(repeat, repeat),
-                                 is_parenthesis=False)
-        time.sleep(0.8)
+def ask_sf(context: CallbackContext):
+    chat_id = context.job.context
+    jobs.registry.cancel(chat_id, (Constants.JOB_CYCLE, Constants.JOB_TIMER, Constants.JOB_LITTLE_LEFT))
+    jobs.registry.pop_plan(chat_id)
+    session = get_session(chat_id)
+    script = pacing.Script(chat_id, session.rng)
+
+    if session.is_to_suppress:
+        repeat = session.repeat
+        send_informative_message(chat_id, context, '(설정된 타이머 시간에 도달했습니다.)\n{:d}세트 중 {:d}세트 완료.',
+                                 args=(repeat, repeat), is_parenthesis=False)
+        script.wait(0.8)
     else:
-        send_random_lines(chat_id, context, '02-1-3.pv')
-        common.sleep_random_seconds(1.2, 1.8)
-
-    global is_f_listening, is_s_listening
-    is_f_listening = True  # Activate all the handlers.
-    is_s_listening = True
-    commands = common.build_tuple_of_tuples('duration_sf.pv')
-    sup_commands_str = ''
-    for command in commands:
-        command, desc = command
-        sup_commands_str += '/{}\t{}\n'.format(command, desc)
-    context.bot.send_message(context.job.context, text=sup_commands_str)
-
-
-def give_1(update: Update, context: CallbackContext, nested: bool = False):
-    global is_direction_given
-    global is_active, reactivated_time
-    global is_to_suppress, is_duration_successful
+        send_random_lines(script, '02-1-3.pv')
+        script.pause(1.2, 1.8)
+
+    script.call(start_receiving_sf, session)
+    script.send(render.menu('duration_sf.pv'))
+    script.start(context)
+
+
+def start_receiving_sf(context: CallbackContext, session: state.Session):
+    session.is_f_listening = True  # Activate all the handlers.
+    session.is_s_listening = True
+
+
+def give_1(update: Update, context: CallbackContext, nested: bool = False, script: pacing.Script = None):
+    # When nested, the caller passes its script and starts it after appending the rest of the directions.
     message = update.effective_message
     chat_id = message.chat_id
-
-    if is_allowed:
-        if is_direction_given:
+    session = get_session(chat_id)
+    is_duration_successful = session.is_duration_successful
+    rng = session.rng
+    if script is None:
+        script = pacing.Script(chat_id, rng)
+
+    if session.is_allowed:
+        if session.is_direction_given:
             send_incomplete_msg(update, context)
-        elif not is_active:
+        elif not session.is_active:
             send_inactive_msg(update, context)
         else:
-            lock_giving_direction()  # Prevent generating another direction.
+            lock_giving_direction(session)  # Prevent generating another direction.
             if is_duration_successful:
                 # if successful, the naked status has been already given.
                 is_naked = False
             else:
-                is_naked = common.get_random_bool(0.33)
+                is_naked = common.get_random_bool(0.33, rng)
 
             if not is_duration_successful:  # if successful, the user has already been merged into the process.
-                pause_sec = random.uniform(8, 13)
-                send_informative_message(chat_id, context, '명령어 생성을 시작합니다.\n(예상 소요시간: {:.2f}초)'.format(pause_sec),
-                                         replied_message=message, is_parenthesis=False)
+                pause_sec = rng.uniform(8, 13)
+                inform(script, '명령어 생성을 시작합니다.\n(예상 소요시간: {:.2f}초)', args=(pause_sec,),
+                       replied_message=message, is_parenthesis=False)
 
-                fluctuated_pause_sec = pause_sec * random.uniform(0.95, 1.005)
-                time.sleep(fluctuated_pause_sec)
-                send_informative_message(chat_id, context, '명령어 생성이 완료되었습니다.\n({:.2f}초)'.format(fluctuated_pause_sec),
-                                         is_parenthesis=False)
-                common.sleep_random_seconds()
+                fluctuated_pause_sec = pause_sec * rng.uniform(0.95, 1.005)
+                script.wait(fluctuated_pause_sec)
+                inform(script, '명령어 생성이 완료되었습니다.\n({:.2f}초)', args=(fluctuated_pause_sec,),
+                       is_parenthesis=False)
+                script.pause()
 
             if is_naked:
-                nudity_direction = random.choice(common.build_tuple('01-0.pv'))
-                context.bot.send_message(chat_id=chat_id, text=nudity_direction)
-                common.sleep_random_seconds(1.6, 2.4)
+                nudity_direction = rng.choice(common.build_tuple('01-0.pv'))
+                script.send(nudity_direction)
+                script.pause(1.6, 2.4)
 
             # TODO: 자세 공모 후 /credits 에 제안자 명시. 단, 넣고 빼는 것은 나의 선택. 넣는 경우 명시해주겠다는 것.
             if is_naked:
-                send_random_lines(chat_id, context, filename='01-1.pv', msg_before='그리고 다 벗었으면 ')
+                send_random_lines(script, filename='01-1.pv', msg_before='그리고 다 벗었으면 ')
             else:
-                send_random_lines(chat_id, context, filename='01-1.pv')
+                send_random_lines(script, filename='01-1.pv')
 
             if nested:  # The duration is going to be given. Therefore, don't give start permission at this stage.
                 # Set time to prepare.
                 if is_naked:
-                    additional_sec = 10 * random.randint(2, 5)
+                    additional_sec = 10 * rng.randint(2, 5)
                 else:
-                    additional_sec = 10 * random.randint(0, 1)
+                    additional_sec = 10 * rng.randint(0, 1)
                 pause_sec = 60 + additional_sec
 
                 # Compose the message text.
@@ -351,122 +527,122 @@ def give_1(update: Update, context: CallbackContext, nested: bool = False):
                     text = '1분{} 줄 테니까 자세 준비해'.format(sec_str)
 
                 # Send the message.
-                common.sleep_random_seconds(1.6, 2.4)
-                context.bot.send_message(chat_id=chat_id, text=text)
+                script.pause(1.6, 2.4)
+                script.send(text)
                 # TODO: Timer messages should reply to the messages that define the timer.
 
-                common.sleep_random_seconds()
-                set_timer(message, context, pause_sec)
-                send_random_lines(chat_id, context, 'conditioning.pv', msg_before='준비 끝났으면 ')
-                common.sleep_random_seconds()
-                time.sleep(pause_sec)
+                script.pause()
+                script.call(lambda job_context: set_timer(message, job_context, pause_sec))
+                send_random_lines(script, 'conditioning.pv', msg_before='준비 끝났으면 ')
+                script.pause()
+                script.wait(pause_sec)
+                return  # The caller starts the script.
             else:  # The duration is not going to be given. Start the session once ready.
                 # Give a direction sometimes.
-                if common.get_random_bool(0.7):
-                    send_random_lines(chat_id, context, '01-2.pv')
+                if common.get_random_bool(0.7, rng):
+                    send_random_lines(script, '01-2.pv')
 
                 if is_duration_successful:  # If called from ask_sf, the following direction has already been given.
                     pass
                 else:  # Give the post process direction at this stage, if the give_1 was called.
-                    send_random_lines(chat_id, context, '01-3.pv')
+                    send_random_lines(script, '01-3.pv')
 
-                common.sleep_random_seconds(1.6, 2.4)
-                go_line = '자세 다 잡았으면 ' + random.choice(common.build_tuple('01-4.pv')) + ' 시작해'
-                give_permission_to_start(message, context, go_line=go_line)
+                script.pause(1.6, 2.4)
+                go_line = '자세 다 잡았으면 ' + rng.choice(common.build_tuple('01-4.pv')) + ' 시작해'
+                give_permission_to_start(script, message, go_line=go_line)
     else:
         # Not allowed, but asked the command.
-        global denial_count
-        last_count = denial_count
-        denial_count += 1
-        print('New denial count: {:d}'.format(denial_count))
+        last_count = session.denial_count
+        session.denial_count += 1
+        logs.event(logger, logging.INFO, 'denied', chat_id=chat_id, session=session.serial,
+                   denial_count=session.denial_count)
 
         if last_count == 0:
-            common.sleep_random_seconds(0.4, 1.2)
-            context.bot.send_message(chat_id=chat_id, text='안돼')
-
-            # TODO: Play recorded voice occasionally.
-            send_random_lines(chat_id, context, 'dont-0.pv')
+            script.pause(0.4, 1.2)
+            script.send('안돼')
+            play_voice(script, Constants.VOICE_DONT, Constants.VOICE_OCCASIONALLY)
+            send_random_lines(script, 'dont-0.pv')
         elif last_count == 1:
-            send_random_lines(chat_id, context, 'dont-1.pv')
+            send_random_lines(script, 'dont-1.pv')
         else:
-            send_informative_message(chat_id, context, '데이터 수신을 차단합니다.')
-            blocked_sec = random.randint(3600 * 7, 3600 * 9)
-            inactivate(chat_id, context, blocked_sec)
+            inform(script, '데이터 수신을 차단합니다.')
+            blocked_sec = rng.randint(3600 * 7, 3600 * 9)
+            script.call(lambda job_context: inactivate(chat_id, job_context, blocked_sec))
+
+    if not nested:
+        script.start(context)
 
 
 def give_2(update: Update, context: CallbackContext):
-    global is_direction_given, is_active
-    global is_to_suppress
     message = update.effective_message
     chat_id = message.chat_id
+    session = get_session(chat_id)
 
-    if is_direction_given:
+    if session.is_direction_given:
         send_incomplete_msg(update, context)
-    elif not is_active:
+    elif not session.is_active:
         send_inactive_msg(update, context)
     else:
-        give_1(update, context, True)
+        script = pacing.Script(chat_id, session.rng)
+        give_1(update, context, True, script)
 
-        opening_str = random.choice(('오늘은 ', '이번엔 ', ''))
-        if is_to_suppress:  # Suppressing
-            global rubbing_min, pause_min, repeat, cycle_number
-            cycle_number = 0
+        opening_str = session.rng.choice(('오늘은 ', '이번엔 ', ''))
+        if session.is_to_suppress:  # Suppressing
+            session.cycle_number = 0
 
-            common.sleep_random_seconds(0.8, 1.2)  # Just after time's up. A longer delay is confusing.
-            send_random_lines(chat_id, context, '02-0-0.pv', msg_before=opening_str)
+            script.pause(0.8, 1.2)  # Just after time's up. A longer delay is confusing.
+            send_random_lines(script, '02-0-0.pv', msg_before=opening_str)
 
             # TODO: Give directions to maintain a temperature.
-            strings = random.choice(common.build_tuple_of_tuples('02-0-1.pv'))
+            strings = session.rng.choice(common.build_tuple_of_tuples('02-0-1.pv'))
             integers = []
             for value in strings:
                 integers.append(int(value))
             rubbing_min, pause_min, repeat = integers
+            session.rubbing_min, session.pause_min, session.repeat = integers
             duration_str = '{:d}분 동안 보지 털고 {:d}분 쉬기 {:d}세트 하고'.format(rubbing_min, pause_min, repeat)
-            context.bot.send_message(chat_id=chat_id, text=duration_str)
-            common.sleep_random_seconds()
-
-            send_random_lines(chat_id, context, '02-0-2.pv')
-            common.sleep_random_seconds()
-
-            # Configure variables for cycling.
-            global is_f_listening
-            is_f_listening = True  # Activate handler to receive a failure report.
-
-            # To demand recordings between pauses or not, determining messages in inform_cycle_status
-            global is_sup_inter_recording
-
-            unit_interval = (rubbing_min + pause_min) * 60
-            for i in range(repeat):
-                firing_time = unit_interval * i
-                context.job_queue.run_once(declare_start, firing_time,
-                                           context=message, name=Constants.JOB_DECLARE_START)
-                if i < repeat - 1:  # Other than the last cycle.
-                    context.job_queue.run_once(inform_cycle_status, rubbing_min * 60 + firing_time,
-                                               context=chat_id, name=Constants.JOB_INFORM_CYCLE_STATUS)
-                    # context (object, optional) – Additional data needed for the callback function.
-                    # https://python-telegram-bot.readthedocs.io/en/stable/telegram.ext.jobqueue.html#telegram.ext.JobQueue.run_monthly
-            overall_duration = unit_interval * repeat - pause_min * 60 + 3
-            context.job_queue.run_once(ask_sf, overall_duration, context=chat_id, name=Constants.JOB_ASK_SF)
+            script.send(duration_str)
+            script.pause()
+
+            send_random_lines(script, '02-0-2.pv')
+            script.pause()
+            script.call(start_cycles, chat_id)
         else:  # Rushing
-            send_random_lines(chat_id, context, '02-1-0.pv', msg_before=opening_str)
-            common.sleep_random_seconds(1.6, 2.4)  # Suspending
+            send_random_lines(script, '02-1-0.pv', msg_before=opening_str)
+            script.pause(1.6, 2.4)  # Suspending
 
             # TODO: Give a direction not to reach a temperature.
-            duration_str = random.choice(common.build_tuple('02-1-1.pv'))
-            context.bot.send_message(chat_id=chat_id, text=duration_str)
+            duration_str = session.rng.choice(common.build_tuple('02-1-1.pv'))
+            script.send(duration_str)
 
-            send_random_lines(chat_id, context, '02-1-2.pv')
-            global is_s_listening
-            is_s_listening = True  # Add handler to receive a success report.
+            send_random_lines(script, '02-1-2.pv')
+            script.call(start_receiving_s, session)  # Add handler to receive a success report.
 
             if duration_str[0].isdigit():
                 timer_min = int(re.search(r'\d+', duration_str).group())
             else:
                 timer_min = 2
 
-            give_permission_to_start(message, context, timer_min)
-            context.job_queue.run_once(ask_sf, timer_min * 60,
-                                       context=chat_id, name=Constants.JOB_ASK_SF)
+            give_permission_to_start(script, message, timer_min)
+            script.call(lambda job_context: jobs.registry.run_once(job_context, ask_sf, timer_min * 60,
+                                                                   chat_id, Constants.JOB_ASK_SF))
+        script.start(context)
+
+
+def start_receiving_s(context: CallbackContext, session: state.Session):
+    session.is_s_listening = True
+
+
+def start_cycles(context: CallbackContext, chat_id):
+    session = get_session(chat_id)
+    plan = jobs.CyclePlan(session.rubbing_min, session.pause_min, session.repeat)
+    jobs.registry.set_plan(chat_id, plan)
+
+    # Configure variables for cycling.
+    session.is_f_listening = True  # Activate handler to receive a failure report.
+
+    # A single job walks through the sets, scheduling the next transition when it fires.
+    jobs.registry.run_once(context, advance_cycle, plan.step(0)[2], chat_id, Constants.JOB_CYCLE)
 
 
 def set_timer(message: telegram.Message, context: CallbackContext, duration_sec: int):
@@ -482,9 +658,9 @@ def set_timer(message: telegram.Message, context: CallbackContext, duration_sec:
     send_informative_message(chat_id, context, duration_str)
 
     # Add a timer.
-    remove_job_if_exists(Constants.JOB_TIMER, context)
-    context.job_queue.run_once(go_off, duration_sec, context=chat_id, name=Constants.JOB_TIMER)
-    print('Timer set for {}\"'.format(duration_sec))
+    remove_job_if_exists(chat_id, Constants.JOB_TIMER)
+    jobs.registry.run_once(context, go_off, duration_sec, chat_id, Constants.JOB_TIMER)
+    logs.event(logger, logging.DEBUG, 'timer_set', chat_id=chat_id, seconds=duration_sec)
 
 
 def set_termination_timer(message: telegram.Message, context: CallbackContext, duration_min: int) -> None:
@@ -493,42 +669,61 @@ def set_termination_timer(message: telegram.Message, context: CallbackContext, d
     seconds = duration_min * 60
 
     # Send an alert before the timer goes off.
-    remove_job_if_exists(Constants.JOB_LITTLE_LEFT, context)
-    context.job_queue.run_once(has_little_left, seconds - Constants.LITTLE_TIME_MIN * 60,
-                               context=chat_id, name=Constants.JOB_LITTLE_LEFT)
+    remove_job_if_exists(chat_id, Constants.JOB_LITTLE_LEFT)
+    jobs.registry.run_once(context, has_little_left, seconds - Constants.LITTLE_TIME_MIN * 60,
+                           chat_id, Constants.JOB_LITTLE_LEFT)
 
-    common.sleep_random_seconds(0.8, 1.2)
-    set_timer(message, context, seconds)
+    script = pacing.Script(chat_id, get_session(chat_id).rng)
+    script.pause(0.8, 1.2)
+    script.call(lambda job_context: set_timer(message, job_context, seconds))
     # The alarm goes off and the session will be terminated.
-    inactivate(chat_id, context)
+    script.call(lambda job_context: inactivate(chat_id, job_context))
+    script.start(context)
 
 
-def send_informative_message(chat_id, context: CallbackContext, text: str,
-                             replied_message: telegram.Message = None, is_parenthesis: bool = True):
-    print("Bot: " + text)
-    template = '`({})`' if is_parenthesis else '`{}`'
+def send_informative_message(chat_id, context: CallbackContext, text: str, replied_message: telegram.Message = None,
+                             is_parenthesis: bool = True, args: tuple = ()):
+    # With args, the text is a template formatted with them. See render.informative.
+    logs.event(logger, logging.DEBUG, 'informed', chat_id=chat_id, text=text, text_args=args)
+    rendered = render.informative(text, args, is_parenthesis)
     if replied_message:
-        replied_message.reply_text(text=template.format(text), parse_mode=telegram.ParseMode.MARKDOWN_V2)
+        reply(context, replied_message, rendered, parse_mode=telegram.ParseMode.MARKDOWN_V2)
     else:
-        context.bot.send_message(chat_id=chat_id, text=template.format(text), parse_mode=telegram.ParseMode.MARKDOWN_V2)
+        outbound.send_message(context.bot, chat_id, text=rendered, parse_mode=telegram.ParseMode.MARKDOWN_V2)
+
+
+def reply(context: CallbackContext, message: telegram.Message, text: str, **kwargs):
+    # The same as message.reply_text, but through the outbox.
+    if message.chat.type != telegram.Chat.PRIVATE:
+        kwargs['reply_to_message_id'] = message.message_id
+    outbound.send_message(context.bot, message.chat_id, text=text, **kwargs)
+
+
+def inform(script: pacing.Script, text: str, replied_message: telegram.Message = None,
+           is_parenthesis: bool = True, args: tuple = ()):
+    # Append send_informative_message to the script.
+    script.call(lambda context: send_informative_message(script.chat_id, context, text, replied_message=replied_message,
+                                                         is_parenthesis=is_parenthesis, args=args))
 
 
 def cancel_timer(update: Update, context: CallbackContext) -> None:
     message = update.effective_message
-    job_removed = remove_job_if_exists(Constants.JOB_TIMER, context)
+    job_removed = remove_job_if_exists(message.chat_id, Constants.JOB_TIMER)
     text = '타이머가 취소되었습니다.' if job_removed else '활성화된 타이머가 없습니다.'
     send_informative_message(message.chat_id, context, text, replied_message=message)
 
 
 def give_orientation(update: Update, context: CallbackContext) -> None:
-    msg = common.read_from_file('orientation.pv')
-    context.bot.send_message(chat_id=update.effective_message.chat_id, disable_web_page_preview=True,
-                             text=msg, parse_mode=telegram.ParseMode.MARKDOWN_V2)
+    msg = common.read_from_file(common.corpus_path('orientation.pv'))
+    outbound.send_message(context.bot, update.effective_message.chat_id, disable_web_page_preview=True,
+                          text=msg, parse_mode=telegram.ParseMode.MARKDOWN_V2)
 
 
 def error(update: Updater, context: CallbackContext):
     # Log Errors caused by Updates
-    logger.warning('Update {} caused error {}'.format(update, context.error))
+    chat = update.effective_chat if isinstance(update, Update) else None
+    logs.event(logger, logging.WARNING, 'update_error', chat_id=chat.id if chat else None,
+               update_id=getattr(update, 'update_id', None), error=repr(context.error))
 
 
 def order_1(update: Update, context: CallbackContext):
@@ -539,162 +734,440 @@ def order_2(update: Update, context: CallbackContext):
     give_2(update, context)
 
 
-def stop_receiving_sf(context: CallbackContext):
+def stop_receiving_sf(session: state.Session, context: CallbackContext):
     # Reset the job queue.
-    remove_job_if_exists(Constants.JOB_TIMER, context)
-    remove_job_if_exists(Constants.JOB_LITTLE_LEFT, context)
-    remove_job_if_exists(Constants.JOB_INFORM_CYCLE_STATUS, context)
-    remove_job_if_exists(Constants.JOB_DECLARE_START, context)
-    remove_job_if_exists(Constants.JOB_ASK_SF, context)
-    remove_job_if_exists(Constants.JOB_ACTIVATE, context)
+    cancel_session_jobs(session.chat_id)
 
-    global is_s_listening, is_f_listening
-    is_s_listening = False
-    is_f_listening = False
+    session.is_s_listening = False
+    session.is_f_listening = False
 
 
 def duration_successful(update: Update, context: CallbackContext):
-    global is_s_listening, is_duration_successful
-    if is_s_listening:
-        stop_receiving_sf(context)
-        is_duration_successful = True
-        # TODO: Play recorded voice FREQUENTLY.
-        global is_to_suppress
-        chat_id = update.effective_message.chat_id
-
-        if is_to_suppress:
-            send_random_lines(chat_id, context, '02-0-s-0.pv')
+    chat_id = update.effective_message.chat_id
+    session = get_session(chat_id)
+    if session.is_s_listening:
+        stop_receiving_sf(session, context)
+        session.is_duration_successful = True
+
+        script = pacing.Script(chat_id, session.rng)
+        play_voice(script, Constants.VOICE_SUCCESSFUL, Constants.VOICE_FREQUENTLY)
+        if session.is_to_suppress:
+            send_random_lines(script, '02-0-s-0.pv')
         else:
-            send_random_lines(chat_id, context, '02-1-s-0.pv')
-        unlock_ordering()  # To receive new asking.
+            send_random_lines(script, '02-1-s-0.pv')
+        script.call(lambda job_context: unlock_ordering(session))  # To receive new asking.
+        script.start(context)
 
 
 def duration_failed(update: Update, context: CallbackContext):
-    # TODO: Play recorded voice occasionally.
-    global is_to_suppress, is_f_listening
-    if is_f_listening:
-        stop_receiving_sf(context)
-        chat_id = update.effective_message.chat_id
-        if is_to_suppress:
-            send_random_lines(chat_id, context, '02-0-f-0.pv')
+    chat_id = update.effective_message.chat_id
+    session = get_session(chat_id)
+    if session.is_f_listening:
+        stop_receiving_sf(session, context)
+        script = pacing.Script(chat_id, session.rng)
+        play_voice(script, Constants.VOICE_FAILED, Constants.VOICE_OCCASIONALLY)
+        if session.is_to_suppress:
+            send_random_lines(script, '02-0-f-0.pv')
         else:
-            send_random_lines(chat_id, context, '02-1-f-0.pv')
+            send_random_lines(script, '02-1-f-0.pv')
 
         # A common direction: clean and take pictures
-        common.sleep_random_seconds(3.2, 4)
-        send_random_lines(chat_id, context, '02-0-f-1.pv')
+        script.pause(3.2, 4)
+        send_random_lines(script, '02-0-f-1.pv')
 
-        time.sleep(2.8)
-        send_informative_message(chat_id, context, '데이터 수신을 차단합니다.')
-        global is_active, reactivated_time
-        blocked_sec = random.randint(3600 * 7, 3600 * 9)
-        inactivate(chat_id, context, blocked_sec)
+        script.wait(2.8)
+        inform(script, '데이터 수신을 차단합니다.')
+        blocked_sec = session.rng.randint(3600 * 7, 3600 * 9)
+        script.call(lambda job_context: inactivate(chat_id, job_context, blocked_sec))
+        script.start(context)
 
 
 def activate_session(context: CallbackContext):
-    # TODO: Remove global variables to run multiple bot threads.
-    #  (https://python-telegram-bot.readthedocs.io/en/stable/telegram.ext.callbackcontext.html#telegram.ext.CallbackContext.chat_data)
+    reset_session(context.job.context, context)
 
-    # Reset all the global variables.
-    global is_active  # Especially, this one.
-    is_active = True
 
-    global is_allowed, denial_count
-    is_allowed = True
-    denial_count = 0
+def reset_session(chat_id, context: CallbackContext):
+    # Reset the session of the chat.
+    session = get_session(chat_id)
+    session.is_active = True  # Especially, this one.
 
-    global is_direction_given, is_to_suppress, is_sup_inter_recording
-    is_direction_given = False
-    is_to_suppress = common.get_random_bool(0.9)  # i.e. 100% in the first session, 90% afterwards.
-    is_sup_inter_recording = common.get_random_bool()  # i.e. 0% in the first session, 50% afterwards.
+    session.is_allowed = True
+    session.denial_count = 0
 
-    global is_s_listening, is_f_listening, is_duration_successful
-    is_s_listening = False
-    is_f_listening = False
-    is_duration_successful = False
+    session.is_direction_given = False
+    session.is_to_suppress = common.get_random_bool(0.9, session.rng)  # i.e. 100% in the first session, 90% afterwards.
+    session.is_sup_inter_recording = common.get_random_bool(rng=session.rng)  # i.e. 0% in the first session, 50% afterwards.
 
-    global reactivated_time
-    reactivated_time = datetime.datetime.now()
-
-    global rubbing_min, pause_min, repeat, cycle_number
-    rubbing_min = 0
-    pause_min = 0
-    repeat = 0
-    cycle_number = 0
+    session.reactivated_time = datetime.datetime.fromtimestamp(jobs.registry.now())
+    session.reset_activity()
 
     # Reset the job queue.
-    remove_job_if_exists(Constants.JOB_TIMER, context)
-    remove_job_if_exists(Constants.JOB_LITTLE_LEFT, context)
-    remove_job_if_exists(Constants.JOB_INFORM_CYCLE_STATUS, context)
-    remove_job_if_exists(Constants.JOB_DECLARE_START, context)
-    remove_job_if_exists(Constants.JOB_ASK_SF, context)
-    remove_job_if_exists(Constants.JOB_ACTIVATE, context)
-    print('Session activated.')
+    cancel_session_jobs(session.chat_id)
+    session.serial += 1
+
+    # The new session draws from a seed of its own. Drawn by the previous one, so that a replay goes on
+    # through the sessions of the chat.
+    session.reseed(session.rng.getrandbits(64))
+    if recording.recorder.is_recording:
+        recording.recorder.session(chat_id, recording.SESSION_RESET, snapshot_chat(chat_id))
+    logs.event(logger, logging.INFO, 'activated', chat_id=chat_id, session=session.serial, seed=session.seed)
 
 
 def cheat_session(update: Update, context: CallbackContext):
     chat_id = update.effective_message.chat_id
-    activate_session(context)
-    text = random.choice(('For Adun!', 'En taro Adun.', 'En taro Tassadar.', 'Power overwhelming.'))
+    reset_session(chat_id, context)
+    text = get_session(chat_id).rng.choice(('For Adun!', 'En taro Adun.', 'En taro Tassadar.', 'Power overwhelming.'))
     send_informative_message(chat_id, context, text)
 
 
 def add_command_handlers(dp: Updater.dispatcher):
-    dp.add_handler(CommandHandler('start', give_orientation))
-    dp.add_handler(CommandHandler('cancel', cancel_timer))
-    dp.add_handler(CommandHandler('poweroverwhelming', cheat_session))
+    # Admit the updates before any other handler sees them.
+    dp.add_handler(TypeHandler(Update, admit), group=-1)
 
-    help_handler = CommandHandler('help', command_help)
+    dp.add_handler(CommandHandler('start', tracked(give_orientation)))
+    dp.add_handler(CommandHandler('cancel', tracked(cancel_timer)))
+    dp.add_handler(CommandHandler('poweroverwhelming', tracked(cheat_session)))
+    dp.add_handler(CommandHandler('timezone', tracked(set_timezone)))
+
+    help_handler = CommandHandler('help', tracked(command_help))
     dp.add_handler(help_handler)
 
     # Note: Disable privacy mode by /setprivacy to read "normal" messages.
     # (https://stackoverflow.com/a/67163946/17198283)
-    response_handler = MessageHandler(Filters.text & (~ Filters.command), interpret_message)
+    response_handler = MessageHandler(Filters.text & (~ Filters.command), tracked(interpret_message))
     dp.add_handler(response_handler)
 
-    commands = common.build_tuple_of_tuples('help.pv')
-    for number, help_item in enumerate(commands):
-        command, desc = help_item
-        if number == 0:
-            order_1_handler = CommandHandler(command, order_1)
-            dp.add_handler(order_1_handler)
-        if number == 1:
-            order_2_handler = CommandHandler(command, order_2)
-            dp.add_handler(order_2_handler)
-
-    # Add sf handlers.
-    sup_command = common.build_tuple_of_tuples('duration_sf.pv')[1][0]
-    duration_f_handler = CommandHandler(sup_command, duration_failed)
-    dp.add_handler(duration_f_handler)
+    # Add the order and sf handlers.
+    callbacks = {'1': order_1, '2': order_2, 's': duration_successful, 'f': duration_failed}
+    for role, command in corpus_command_names().items():
+        handler = CommandHandler(command, tracked(callbacks[role]))
+        corpus_command_handlers[role] = handler
+        dp.add_handler(handler)
+
+
+def corpus_command_names() -> dict:
+    # The orders of help.pv ('1', '2') and the reports of duration_sf.pv ('s', 'f').
+    helps = common.build_tuple_of_tuples('help.pv')
+    sfs = common.build_tuple_of_tuples('duration_sf.pv')
+    return {'1': helps[0][0], '2': helps[1][0], 's': sfs[0][0], 'f': sfs[1][0]}
+
+
+def rename_corpus_commands(version: int, changed: set) -> None:
+    # Follow commands renamed in a new corpus version without restarting.
+    # The handlers are renamed in place: the dispatcher walks its handler lists without a lock.
+    if not {'help.pv', 'duration_sf.pv'} & changed:
+        return
+    for role, command in corpus_command_names().items():
+        handler = corpus_command_handlers.get(role)
+        if handler is not None and handler.command != [command.lower()]:
+            logger.info('Command /{} renamed to /{} in corpus version {:d}'.format(handler.command[0], command, version))
+            handler.command = [command.lower()]
+
+
+def collect_metrics() -> list:
+    # Gauges and counters read when the metrics are scraped.
+    active = sum(1 for session in sessions if session.is_active)
+    outbox_stats = outbound.outbox.stats()
+    samples = [('csbt_sessions', 'gauge', 'Sessions by state.', {'state': 'active'}, active),
+               ('csbt_sessions', 'gauge', 'Sessions by state.', {'state': 'inactive'}, len(sessions) - active),
+               ('csbt_outbox_depth', 'gauge', 'Messages waiting in the outbox.', {}, outbox_stats['depth']),
+               ('csbt_messages_sent_total', 'counter', 'Messages sent.', {}, outbox_stats['sent']),
+               ('csbt_messages_failed_total', 'counter', 'Messages dropped.', {}, outbox_stats['failed']),
+               ('csbt_messages_retried_total', 'counter', 'Retried sends.', {}, outbox_stats['retried']),
+               ('csbt_updates_pending', 'gauge', 'Updates waiting in the chat lanes.', {}, inbound.lanes.stats()['pending']),
+               ('csbt_corpus_version', 'gauge', 'Active corpus version.', {}, common.get_corpus_version())]
+    for verdict, count in inbound.admission.stats().items():
+        if verdict != inbound.ADMITTED:
+            samples.append(('csbt_updates_dropped_total', 'counter', 'Updates dropped by admission.',
+                            {'reason': verdict}, count))
+    for kind, count in jobs.registry.count_by_kind().items():
+        samples.append(('csbt_jobs', 'gauge', 'Scheduled jobs by kind.', {'kind': kind}, count))
+    return samples
+
+
+def read_token() -> str:
+    # Read when the bot is created, so that tools can import this module without the token.
+    return common.read_from_file(Constants.TOKEN_PATH).strip()
+
+
+def create_updater(config: dict, workers: int, shared: tenant.Shared = None) -> Updater:
+    # Get the dispatcher to register handlers. The bot of a tenant uses what the tenants share.
+    request = shared.request if shared is not None else transport.create_request(config, workers)
+    kwargs = {'use_context': True, 'workers': workers,
+              'bot': telegram.Bot(read_token(), base_url=config.get('base_url') or None, request=request)}
+    if config.get('mode', 'polling') == 'webhook':
+        updater = webhook.WebhookUpdater(secret_token=config.get('webhook_secret') or None, **kwargs)
+    else:
+        updater = Updater(**kwargs)
+    updater.dispatcher.add_error_handler(error)
+
+    # With the asyncio runtime, timers, script pauses and handlers are callbacks on one event loop.
+    if config.get('runtime', 'threads') == 'asyncio':
+        job_queue = aio.AsyncJobQueue(shared.runtime.loop if shared is not None else None)
+        job_queue.set_dispatcher(updater.dispatcher)
+        updater.job_queue = updater.dispatcher.job_queue = job_queue
+    elif shared is not None:
+        updater.job_queue.scheduler = shared.scheduler
+    return updater
+
+
+def start_services(config: dict, dispatcher, shard_index: int = None) -> corpus.CorpusWatcher:
+    # Load the corpus and the sessions, add the handlers and start what runs beside the dispatcher.
+    # A shard keeps its sessions in a database of its own and serves its metrics on a port of its own.
+    # Returns the watcher of the corpus, to stop with stop_services.
+
+    # Record and serve the metrics if a port is given. Otherwise they cost nothing.
+    metrics_port = config.get('metrics_port')
+    if metrics_port:
+        metrics.recorder.enable()
+        metrics.recorder.add_collector(collect_metrics)
+        metrics.recorder.add_collector(lambda: transport.collect_metrics(dispatcher.bot.request))
+        port = int(metrics_port) + (1 + shard_index if shard_index is not None else 0)
+        metrics.recorder.serve(config.get('metrics_listen', '127.0.0.1'), port)
+
+    # Map the phrases compiled by corpus.py if there are, and parse the other files once.
+    # Later reads are served from the bundle or the cache.
+    # The phrase files are then watched, and changes are published as new corpus versions.
+    watcher = corpus.CorpusWatcher(common.CORPUS_DIR,
+                                   interval=float(config.get('corpus_reload_sec', corpus.WATCH_INTERVAL_SEC)))
+    bundle_path = config.get('corpus_bundle', Constants.CORPUS_BUNDLE_PATH)
+    is_bundled = bool(bundle_path) and os.path.exists(bundle_path)
+    if is_bundled and watcher.is_newer_than(bundle_path):
+        logger.warning('{} is older than the phrase files: reading them instead. Run corpus.py to compile them again.'
+                       .format(bundle_path))
+        is_bundled = False
+    if is_bundled:
+        common.load_bundle(bundle_path)
+        watcher.assume_loaded()
+    else:
+        for path, number, message in watcher.load():
+            logger.warning('{}:{:d}: {}'.format(path, number, message))
+    common.preload_corpus()
+    logger.info('Corpus loaded: {}'.format(common.get_corpus_stats()))
 
-    sup_command = common.build_tuple_of_tuples('duration_sf.pv')[0][0]
-    duration_s_handler = CommandHandler(sup_command, duration_successful)
-    dp.add_handler(duration_s_handler)
+    sessions.timezone = config.get('timezone', Constants.DEFAULT_TIMEZONE)
 
+    # Add handlers.
+    add_command_handlers(dispatcher)
 
-def main():
-    # Create the job in schedule.(https://stackoverflow.com/a/60867438/17198283)
-    schedule.every().day.at("09:00").do(renew_allowing_rubbing)
-    renew_allowing_thread = Thread(target=schedule_checker)
-    renew_allowing_thread.daemon = True  # https://stackoverflow.com/a/11816038/17198283
-    renew_allowing_thread.start()
-
-    # Get the dispatcher to register handlers.
-    updater = Updater(Constants.BOT_TOKEN, use_context=True)
+    # Drop redelivered updates, coalesce repeated intents and bound the updates waiting per chat.
+    max_pending = int(config.get('max_pending_updates', inbound.MAX_PENDING))
+    inbound.admission = inbound.Admission(coalesce_sec=float(config.get('coalesce_sec', inbound.COALESCE_SEC)),
+                                          max_pending=max_pending if max_pending > 0 else None,
+                                          notify=config.get('overflow_policy', 'notify') == 'notify')
+
+    # Record the sessions to replay them, see replay.py.
+    record_path = config.get('record_path')
+    if record_path:
+        if shard_index is not None:
+            record_path = '{}.{:d}'.format(record_path, shard_index)
+        recording.recorder.start(record_path)
+        outbound.outbox.listener = recording.recorder.sent
+
+    # Restore the sessions and timers from the last run, then persist changes in the background.
+    global state_store
+    state_db_path = config.get('state_db', Constants.STATE_DB_PATH)
+    if state_db_path:
+        if shard_index is not None:
+            state_db_path = '{}.{:d}'.format(state_db_path, shard_index)
+        state_store = persistence.Persistence(state_db_path, snapshot_chat)
+        started = time.perf_counter()
+        loaded = state_store.load()
+        restore_sessions(CallbackContext(dispatcher), loaded)
+        logger.info('{:d} sessions restored in {:.3f}s.'.format(len(loaded), time.perf_counter() - started))
+        inbound.admission.restore(state_store.get_value('last_update_id'))  # Redelivered after a crash.
+        jobs.registry.listener = touch
+        state_store.start()
+    jobs.registry.guard = chat_lock
+
+    # Send the recordings by the file_ids of their first upload, shared by the shards.
+    media.registry = media.MediaRegistry(config.get('media_db', Constants.MEDIA_DB_PATH) or None,
+                                         voice_dir=config.get('voice_dir', media.VOICE_DIR))
+
+    # Run the handlers of different chats in parallel and those of a chat in order.
+    is_asyncio = isinstance(dispatcher.job_queue, aio.AsyncJobQueue)
+    inbound.lanes.start(dispatcher, spawn=dispatcher.job_queue.run_async if is_asyncio else None)
+
+    # Deliver messages from the rate-limited outbox.
+    outbound.outbox.start()
+
+    # Reload the phrases and commands when the files change.
+    watcher.listeners.append(rename_corpus_commands)
+    if watcher.interval > 0:
+        watcher.start()
+    return watcher
+
+
+def stop_services(watcher: corpus.CorpusWatcher) -> None:
+    watcher.stop()
+    inbound.lanes.stop()
+    if state_store is not None:
+        state_store.close()
+    outbound.outbox.stop()
+    recording.recorder.stop()
+    logger.info('Outbox: {}'.format(outbound.outbox.stats()))
+    logger.info('Media: {}'.format(media.registry.stats()))
+    logger.info('Admission: {}'.format(inbound.admission.stats()))
+    media.registry.close()
+
+
+def configure_logs(config: dict) -> None:
+    # Log through a queue, as text or JSON lines, sampling the events listed in log_sample.
+    logs.configure(config.get('log_level', 'INFO'), config.get('log_format', logs.FORMAT_TEXT),
+                   logs.parse_sampling(config.get('log_sample', '')))
+
+
+def run_shard(index: int, shards: int, connection) -> None:
+    # A worker process of a sharded deployment, started by shard.ShardRouter: runs the chats of the shard
+    # on the updates received from the ingress.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C reaches the whole group: the ingress stops the shards.
+    config = common.read_config(Constants.CONFIG_PATH)
+    configure_logs(config)
+    logger.info('Shard {:d} of {:d} starting.'.format(index, shards))
+    updater = create_updater(config, int(config.get('workers', Constants.WORKERS)))
     dispatcher = updater.dispatcher
-    dispatcher.add_error_handler(error)
+    watcher = start_services(config, dispatcher, shard_index=index)
+    updater.job_queue.start()
+    dispatcher_thread = threading.Thread(target=dispatcher.start, name='dispatcher')
+    dispatcher_thread.start()
+
+    for data in shard.receive(connection):
+        dispatcher.update_queue.put(Update.de_json(json.loads(data), updater.bot))
+
+    # Finish the updates received before stopping.
+    while not dispatcher.update_queue.empty() or inbound.lanes.stats()['done'] < inbound.lanes.stats()['submitted']:
+        time.sleep(0.05)
+    dispatcher.stop()
+    dispatcher_thread.join()
+    updater.job_queue.stop()
+    stop_services(watcher)
+    logs.stop()
+
+
+def run_ingress(config: dict, shards: int) -> None:
+    # Receive the updates and route them to the shards by chat_id. SIGUSR1 restarts the shards one by one.
+    router = shard.ShardRouter(shards, run_shard)
+    router.start()
+    updater = create_updater(config, workers=1)
+    updater.dispatcher.add_handler(TypeHandler(Update, router.handle))
+
+    metrics_port = config.get('metrics_port')
+    if metrics_port:
+        metrics.recorder.enable()
+        metrics.recorder.add_collector(router.collect_metrics)
+        metrics.recorder.add_collector(lambda: transport.collect_metrics(updater.bot.request))
+        metrics.recorder.serve(config.get('metrics_listen', '127.0.0.1'), int(metrics_port))
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: threading.Thread(target=router.restart_all).start())
+
+    start_updater(config, updater)
+    updater.idle()
+    router.stop()
+    logger.info('Shards: {}'.format(router.stats()))
+    logger.info('Transport: {}'.format(transport.stats(updater.bot.request)))
+
+
+def run_tenants(config: dict, tenants_dir: str) -> None:
+    # Run the bot of every tenant in tenants_dir, see tenant.py. A tenant that fails to start is left out,
+    # and the others run.
+    tenants = tenant.read_tenants(tenants_dir, config)
+    workers = int(config.get('workers', Constants.WORKERS))
+    shared = tenant.Shared(transport.create_request(config, workers, bots=len(tenants)),
+                           config.get('runtime', 'threads') == 'asyncio')
+    shared.start()
+
+    metrics_port = config.get('metrics_port')
+    if metrics_port:
+        metrics.recorder.enable()
+        metrics.recorder.add_collector(lambda: transport.collect_metrics(shared.request))
+        metrics.recorder.serve(config.get('metrics_listen', '127.0.0.1'), int(metrics_port))
+    # Until Ctrl-C, SIGTERM or SIGABRT, as Updater.idle, also while the tenants start. A flag, not an Event:
+    # the handler runs on the main thread, which may be waiting on the Event and holding its lock.
+    stopped = []
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+        signal.signal(signum, lambda signum, frame: stopped.append(signum))
+
+    running = []
+    for one in tenants:
+        if stopped:
+            break
+        if metrics_port:
+            one.metrics.enable()  # Before its handlers are wrapped to be timed.
+        try:
+            one.updater = one.bot.create_updater(one.config, workers, shared)
+            one.updater.bot.get_me()  # Fails on a wrong token here rather than in the dispatcher.
+            one.watcher = one.bot.start_services(one.config, one.updater.dispatcher)
+            one.bot.start_updater(one.config, one.updater)
+        except Exception:
+            logger.exception('Tenant {} failed to start.'.format(one.name))
+            if one.watcher is not None:
+                one.bot.stop_services(one.watcher)
+            continue
+        if metrics_port:
+            one.metrics.add_collector(one.bot.collect_metrics)
+            metrics.recorder.add_child(one.metrics)
+        running.append(one)
+        logger.info('Tenant {} started as @{}.'.format(one.name, one.updater.bot.username))
+    if not running:
+        logger.error('No tenant started.')
+    while running and not stopped:
+        time.sleep(1)
+    # The jobs first, as Updater.stop does. Then each updater waits for its polling and dispatcher
+    # to finish: stop them together.
+    shared.stop()
+    stopping = [threading.Thread(target=one.updater.stop) for one in running]
+    for thread in stopping:
+        thread.start()
+    for thread in stopping:
+        thread.join()
+    for one in running:
+        one.bot.stop_services(one.watcher)
+    logger.info('Transport: {}'.format(transport.stats(shared.request)))
+
+
+def start_updater(config: dict, updater: Updater) -> None:
+    if config.get('mode', 'polling') == 'webhook':
+        updater.start_webhook(listen=config.get('webhook_listen', '127.0.0.1'),
+                              port=int(config.get('webhook_port', 8443)),
+                              url_path=config.get('webhook_path', ''),
+                              webhook_url=config.get('webhook_url') or None)
+    else:
+        updater.start_polling()
 
-    # Add handlers.
-    add_command_handlers(dispatcher)
+
+def main():
+    started = time.perf_counter()
+    config = common.read_config(Constants.CONFIG_PATH)
+    configure_logs(config)
+
+    # With tenants, this process runs the bot of each of them.
+    tenants_dir = config.get('tenants_dir')
+    if tenants_dir:
+        run_tenants(config, tenants_dir)
+        logs.stop()
+        return
+
+    # With shards, this process only receives the updates, and each shard runs in a process of its own.
+    shards = int(config.get('shards', 1))
+    if shards > 1:
+        run_ingress(config, shards)
+        logs.stop()
+        return
+
+    updater = create_updater(config, int(config.get('workers', Constants.WORKERS)))
+    watcher = start_services(config, updater.dispatcher)
 
     # Start the Bot
-    updater.start_polling()
+    start_updater(config, updater)
+    logger.info('Started in {:.3f}s.'.format(time.perf_counter() - started))
 
     # Run the bot until you press Ctrl-C or the process receives SIGINT,
     # SIGTERM or SIGABRT. This should be used most of the time, since
-    # start_polling() is non-blocking and will stop the bot gracefully.
+    # start_polling() and start_webhook() are non-blocking and will stop the bot gracefully.
     updater.idle()
-
+    stop_services(watcher)
+    logger.info('Transport: {}'.format(transport.stats(updater.bot.request)))
+    logs.stop()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,189 @@
+import collections
+import threading
+import time
+
+from telegram import Update
+from telegram.ext import CallbackContext, Dispatcher
+
+# Admission of the updates: how long a repeated intent of a chat is coalesced into the first,
+# how many handler calls of a chat may wait, and how many update_ids are remembered.
+COALESCE_SEC = 2.0
+MAX_PENDING = 10
+MAX_SEEN = 10000
+NOTICE_INTERVAL_SEC = 60.0  # A chat whose updates are dropped is told at most this often.
+
+ADMITTED = 'admitted'
+DROPPED_DUPLICATE = 'duplicate'
+DROPPED_COALESCED = 'coalesced'
+DROPPED_OVERFLOW = 'overflow'
+
+
+class _Lane:
+    # Pending handler calls of a chat, run one at a time in arrival order.
+    __slots__ = ('queue', 'is_busy')
+
+    def __init__(self):
+        self.queue = collections.deque()
+        self.is_busy = False  # Being drained by a worker.
+
+
+class ChatLanes:
+    # Runs the handlers of different chats in parallel on the dispatcher's worker threads,
+    # and the handlers of the same chat one after another in the order the updates arrived.
+    # Until start() is called, handlers run immediately on the calling thread.
+    def __init__(self):
+        self._lanes = {}
+        self._lock = threading.Lock()
+        self._dispatcher = None
+        self._spawn = None
+        self._submitted = 0
+        self._done = 0
+
+    def start(self, dispatcher: Dispatcher, spawn=None):
+        # spawn(func, *args, update=update) runs a lane; Dispatcher.run_async by default.
+        self._spawn = spawn or dispatcher.run_async
+        self._dispatcher = dispatcher
+
+    def stop(self):
+        self._dispatcher = None
+
+    def submit(self, chat_id, callback, update: Update, context: CallbackContext):
+        dispatcher = self._dispatcher
+        with self._lock:
+            self._submitted += 1
+        if dispatcher is None:
+            try:
+                callback(update, context)
+            finally:
+                with self._lock:
+                    self._done += 1
+            return
+
+        with self._lock:
+            lane = self._lanes.get(chat_id)
+            if lane is None:
+                lane = _Lane()
+                self._lanes[chat_id] = lane
+            lane.queue.append((callback, update, context))
+            if lane.is_busy:
+                return
+            lane.is_busy = True
+        self._spawn(self._drain, dispatcher, chat_id, lane, update=update)
+
+    def pending(self, chat_id) -> int:
+        # Handler calls of the chat waiting for their turn.
+        with self._lock:
+            lane = self._lanes.get(chat_id)
+            return len(lane.queue) if lane is not None else 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'submitted': self._submitted,
+                    'done': self._done,
+                    'pending': sum(len(lane.queue) for lane in self._lanes.values()),
+                    'chats': len(self._lanes)}
+
+    def _drain(self, dispatcher: Dispatcher, chat_id, lane: _Lane):
+        while True:
+            with self._lock:
+                if not lane.queue:
+                    lane.is_busy = False
+                    del self._lanes[chat_id]
+                    return
+                callback, update, context = lane.queue.popleft()
+            try:
+                callback(update, context)
+            except Exception as e:
+                # The rest of the lane still runs; the error goes where a synchronous handler's would.
+                dispatcher.dispatch_error(update, e)
+            finally:
+                with self._lock:
+                    self._done += 1
+
+
+def _expire(times: collections.OrderedDict, before: float):
+    # Remove the keys added before the time, from the oldest.
+    while times:
+        key = next(iter(times))
+        if times[key] > before:
+            return
+        del times[key]
+
+
+class Admission:
+    # Decides which updates reach the handlers, before they take a place in a lane:
+    # - an update_id seen before is a redelivery, e.g. after a restart or a webhook retry;
+    # - the same intent of a chat again within coalesce_sec adds nothing to the first one;
+    # - a chat with max_pending handler calls waiting has its updates dropped until its lane drains,
+    #   so that one noisy chat doesn't hold the workers and the memory meant for the others.
+    # A coalesce_sec of 0 or a max_pending of None turns the check off. With notify, a chat is told
+    # its updates are dropped, at most every NOTICE_INTERVAL_SEC.
+    def __init__(self, coalesce_sec: float = COALESCE_SEC, max_pending: int = MAX_PENDING, notify: bool = True,
+                 max_seen: int = MAX_SEEN, clock=time.monotonic):
+        self.coalesce_sec = coalesce_sec
+        self.max_pending = max_pending
+        self.notify = notify
+        self._max_seen = max_seen
+        self._clock = clock
+        self._seen = set()
+        self._seen_order = collections.deque()
+        self._last_update_id = None  # The highest update_id admitted before the last restart.
+        self._recent = collections.OrderedDict()  # (chat_id, intent) -> admitted at, the oldest first.
+        self._noticed = collections.OrderedDict()  # chat_id -> told at, the oldest first.
+        self._counts = {ADMITTED: 0, DROPPED_DUPLICATE: 0, DROPPED_COALESCED: 0, DROPPED_OVERFLOW: 0}
+
+    def restore(self, last_update_id: int):
+        # Drop the updates up to last_update_id delivered again after a restart. Only the last max_seen
+        # of them: Telegram numbers the updates from a random id again after a week without any.
+        self._last_update_id = last_update_id
+
+    def admit(self, update_id: int, chat_id=None, intent=None) -> str:
+        # ADMITTED or the reason the update is dropped. Called by the dispatcher thread only.
+        verdict = self._judge(update_id, chat_id, intent)
+        self._counts[verdict] += 1
+        return verdict
+
+    def take_notice(self, chat_id) -> bool:
+        # Whether the chat is to be told its updates are dropped.
+        if not self.notify:
+            return False
+        now = self._clock()
+        _expire(self._noticed, now - NOTICE_INTERVAL_SEC)
+        if chat_id in self._noticed:
+            return False
+        self._noticed[chat_id] = now
+        return True
+
+    def stats(self) -> dict:
+        return dict(self._counts)
+
+    def _judge(self, update_id: int, chat_id, intent) -> str:
+        if update_id in self._seen or (self._last_update_id is not None and
+                                       self._last_update_id - self._max_seen < update_id <= self._last_update_id):
+            return DROPPED_DUPLICATE
+        self._seen.add(update_id)
+        self._seen_order.append(update_id)
+        if len(self._seen_order) > self._max_seen:
+            self._seen.discard(self._seen_order.popleft())
+        if chat_id is None:
+            return ADMITTED
+
+        if self.max_pending is not None:
+            if lanes.pending(chat_id) >= self.max_pending:
+                return DROPPED_OVERFLOW
+
+        if intent is not None and self.coalesce_sec > 0:
+            now = self._clock()
+            _expire(self._recent, now - self.coalesce_sec)
+            key = (chat_id, intent)
+            if key in self._recent:
+                return DROPPED_COALESCED
+            self._recent[key] = now
+        return ADMITTED
+
+
+# The lanes shared by the handlers.
+lanes = ChatLanes()
+
+# The admission of the updates to the lanes.
+admission = Admission()
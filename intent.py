@@ -0,0 +1,46 @@
+import re
+from collections import namedtuple
+
+# Kinds of intents found in a text message.
+INTENT_DURATION = 'duration'  # Asking for a duration. Equivalent to /2.
+INTENT_TIMER = 'timer'  # Asking to start with the given duration.
+INTENT_POSTURE = 'posture'  # Asking for a posture. Equivalent to /1.
+
+Intent = namedtuple('Intent', ('kind', 'duration_min'))
+
+# Every intent mentions one of the keywords and ends with one of the endings.
+_KEYWORDS = ('보지', '클리', '자위')
+_ENDINGS = ('?', 'ㅜ', 'ㅠ')
+
+_ASKING_DURATION = re.compile(r'(몇\s?분|얼마)')
+_DURATION_QUESTION = re.compile(r'(몇\s?분|얼마).*요.?[?ㅜㅠ]$')
+_TIMER_REQUEST = re.compile(r'\d.?분.{0,6}(보지|클리|자위).*[할도면털].*요.?[?ㅜㅠ]$')
+_MASTURBATION_REQUEST = re.compile(r'자위.*(하고.*싶.+|해도.+)[?ㅜㅠ]$')
+_RUBBING_REQUEST = re.compile(r'^(클리|보지).*\s((만지|비비|쑤시|털)|(만져|비벼|쑤셔)).*요.?[?ㅜㅠ]$')
+_DIGITS = re.compile(r'\d+')
+
+
+def _is_candidate(text: str) -> bool:
+    # `$` also matches before a trailing newline.
+    tail = text[:-1] if text.endswith('\n') else text
+    if not tail.endswith(_ENDINGS):
+        return False
+    for keyword in _KEYWORDS:
+        if keyword in text:
+            return True
+    return False
+
+
+def classify(text: str):
+    # Return the Intent of the message, or None if it doesn't ask for anything.
+    if not text or not _is_candidate(text):
+        return None
+
+    if _DURATION_QUESTION.search(text):
+        return Intent(INTENT_DURATION, None)
+    if _TIMER_REQUEST.search(text):
+        return Intent(INTENT_TIMER, int(_DIGITS.search(text).group()))
+    if ((_MASTURBATION_REQUEST.search(text) or _RUBBING_REQUEST.search(text)) and
+            not _ASKING_DURATION.search(text)):
+        return Intent(INTENT_POSTURE, None)
+    return None
@@ -0,0 +1,238 @@
+import datetime
+import threading
+import time
+
+from telegram.ext import CallbackContext, Job
+
+import metrics
+
+STEP_START = 'start'
+STEP_PAUSE = 'pause'
+STEP_ASK = 'ask'
+
+
+class CyclePlan:
+    # Timing of the suppression sets of a chat: rub, pause, rub, ... then ask for the result.
+    # The plan is a state machine; step_index is the transition to fire next.
+    __slots__ = ('rubbing_min', 'pause_min', 'repeat', 'step_index')
+
+    def __init__(self, rubbing_min: int, pause_min: int, repeat: int, step_index: int = 0):
+        self.rubbing_min = rubbing_min
+        self.pause_min = pause_min
+        self.repeat = repeat
+        self.step_index = step_index
+
+    @property
+    def unit_interval(self) -> int:
+        return (self.rubbing_min + self.pause_min) * 60
+
+    def start_sec(self, i: int) -> int:
+        # Seconds from the beginning of the plan to the start of the i-th set.
+        return self.unit_interval * i
+
+    def pause_sec(self, i: int) -> int:
+        # Seconds from the beginning of the plan to the pause after the i-th set.
+        return self.unit_interval * i + self.rubbing_min * 60
+
+    @property
+    def overall_sec(self) -> int:
+        return self.unit_interval * self.repeat - self.pause_min * 60 + 3
+
+    def step(self, index: int):
+        # Return (step, set index, seconds from the beginning) of the transition, or None after the last one.
+        i, is_pause = divmod(index, 2)
+        if i >= self.repeat:
+            return None
+        if not is_pause:
+            return STEP_START, i, self.start_sec(i)
+        if i < self.repeat - 1:
+            return STEP_PAUSE, i, self.pause_sec(i)
+        return STEP_ASK, i, self.overall_sec
+
+    def snapshot(self) -> list:
+        return [self.rubbing_min, self.pause_min, self.repeat, self.step_index]
+
+    def advance(self):
+        # Move on to the next transition. Return the seconds until it, or None if there is none.
+        current = self.step(self.step_index)
+        self.step_index += 1
+        following = self.step(self.step_index)
+        if current is None or following is None:
+            return None
+        return following[2] - current[2]
+
+
+class _Entry:
+    __slots__ = ('job', 'due')
+
+    def __init__(self, job: Job, due: float):
+        self.job = job  # None while the job is being scheduled.
+        self.due = due  # Epoch seconds at which the job fires. None for repeating jobs.
+
+
+class JobRegistry:
+    # Jobs indexed by chat and kind, so that a chat's jobs are found and cancelled without
+    # scanning the job queue, and one chat never touches the jobs of another.
+    def __init__(self, clock=time.time):
+        self._jobs = {}  # chat_id -> {kind: [_Entry]}
+        self._plans = {}  # chat_id -> CyclePlan
+        self._lock = threading.Lock()
+        self._clock = clock
+        self.listener = None  # Called with the chat_id whenever its jobs or plan may have changed.
+        self.guard = None  # Called with the chat_id for a lock held while its jobs run.
+
+    def now(self) -> float:
+        # Epoch seconds by the clock of the jobs, virtual in a simulation.
+        return self._clock()
+
+    def run_once(self, context: CallbackContext, callback, when: float, chat_id, kind: str,
+                 data: object = None) -> Job:
+        # Schedule the callback for the chat. The job context is data, or the chat_id if not given.
+        callback = metrics.recorder.timed(metrics.JOB_SECONDS, callback, job=kind)
+
+        def run(job_context: CallbackContext):
+            if not self._forget(chat_id, kind, entry):
+                return  # Cancelled while it was being scheduled.
+            try:
+                self._call(chat_id, callback, job_context)
+            finally:
+                self._notify(chat_id)
+
+        # Registered first: a job due at once may run before run_once returns.
+        entry = self._register(chat_id, kind, self._clock() + when)
+        job = self._schedule(chat_id, kind, entry, lambda: context.job_queue.run_once(
+            run, when, context=chat_id if data is None else data, name=kind))
+        self._notify(chat_id)
+        return job
+
+    def run_daily(self, context: CallbackContext, callback, time_of_day: datetime.time, chat_id, kind: str) -> Job:
+        # Schedule the callback for the chat every day at the time, in the time zone of time_of_day.
+        callback = metrics.recorder.timed(metrics.JOB_SECONDS, callback, job=kind)
+
+        def run(job_context: CallbackContext):
+            try:
+                self._call(chat_id, callback, job_context)
+            finally:
+                self._notify(chat_id)
+
+        entry = self._register(chat_id, kind, None)
+        return self._schedule(chat_id, kind, entry, lambda: context.job_queue.run_daily(
+            run, time_of_day, context=chat_id, name=kind))
+
+    def get(self, chat_id, kind: str) -> tuple:
+        return tuple(entry.job for entry in self._jobs.get(chat_id, {}).get(kind, ()) if entry.job is not None)
+
+    def due_times(self, chat_id, kinds) -> dict:
+        # Return {kind: epoch seconds} of the earliest job of each of the kinds.
+        with self._lock:
+            existing = self._jobs.get(chat_id, {})
+            return {kind: min(entry.due for entry in existing[kind]) for kind in kinds if existing.get(kind)}
+
+    def remove(self, chat_id, kind: str) -> bool:
+        # Remove the jobs of the kind. Returns whether any job was removed.
+        with self._lock:
+            kinds = self._jobs.get(chat_id)
+            entries = kinds.pop(kind, None) if kinds else None
+            if kinds is not None and not kinds:
+                del self._jobs[chat_id]
+        for entry in entries or ():
+            if entry.job is not None:  # Otherwise _schedule removes it.
+                entry.job.schedule_removal()
+        if entries:
+            self._notify(chat_id)
+        return bool(entries)
+
+    def cancel(self, chat_id, kinds=None) -> int:
+        # Remove the jobs of the given kinds, or all jobs and the plan of the chat. Returns the number removed.
+        with self._lock:
+            if kinds is None:
+                entries_by_kind = self._jobs.pop(chat_id, {})
+                self._plans.pop(chat_id, None)
+            else:
+                existing = self._jobs.get(chat_id, {})
+                entries_by_kind = {kind: existing.pop(kind) for kind in kinds if kind in existing}
+                if not existing:
+                    self._jobs.pop(chat_id, None)
+        count = 0
+        for entries in entries_by_kind.values():
+            for entry in entries:
+                if entry.job is not None:  # Otherwise _schedule removes it.
+                    entry.job.schedule_removal()
+                count += 1
+        self._notify(chat_id)
+        return count
+
+    def set_plan(self, chat_id, plan: CyclePlan):
+        self._plans[chat_id] = plan
+        self._notify(chat_id)
+
+    def get_plan(self, chat_id) -> CyclePlan:
+        return self._plans.get(chat_id)
+
+    def pop_plan(self, chat_id) -> CyclePlan:
+        plan = self._plans.pop(chat_id, None)
+        self._notify(chat_id)
+        return plan
+
+    def count(self) -> int:
+        with self._lock:
+            return sum(len(entries) for kinds in self._jobs.values() for entries in kinds.values())
+
+    def count_by_kind(self) -> dict:
+        counts = {}
+        with self._lock:
+            for kinds in self._jobs.values():
+                for kind, entries in kinds.items():
+                    counts[kind] = counts.get(kind, 0) + len(entries)
+        return counts
+
+    def _call(self, chat_id, callback, job_context: CallbackContext):
+        if self.guard is None:
+            callback(job_context)
+            return
+        with self.guard(chat_id):
+            callback(job_context)
+
+    def _notify(self, chat_id):
+        if self.listener is not None:
+            self.listener(chat_id)
+
+    def _register(self, chat_id, kind: str, due) -> _Entry:
+        entry = _Entry(None, due)
+        with self._lock:
+            self._jobs.setdefault(chat_id, {}).setdefault(kind, []).append(entry)
+        return entry
+
+    def _schedule(self, chat_id, kind: str, entry: _Entry, schedule) -> Job:
+        # Schedule the job of the registered entry. Unregister the entry if scheduling fails, and remove the
+        # job if the entry was cancelled meanwhile.
+        try:
+            job = schedule()
+        except Exception:
+            self._forget(chat_id, kind, entry)
+            raise
+        with self._lock:
+            entry.job = job
+            is_registered = entry in self._jobs.get(chat_id, {}).get(kind, ())
+        if not is_registered:
+            job.schedule_removal()
+        return job
+
+    def _forget(self, chat_id, kind: str, entry: _Entry) -> bool:
+        # Unregister the entry. Returns whether it was registered.
+        with self._lock:
+            kinds = self._jobs.get(chat_id)
+            if not kinds or entry not in kinds.get(kind, ()):
+                return False
+            entries = [other for other in kinds[kind] if other is not entry]
+            if entries:
+                kinds[kind] = entries
+            else:
+                del kinds[kind]
+                if not kinds:
+                    del self._jobs[chat_id]
+            return True
+
+
+# The registry shared by the handlers.
+registry = JobRegistry()
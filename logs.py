@@ -0,0 +1,135 @@
+# Structured logging. Records are put on a queue by the thread that logs them, then formatted and
+# written by a listener thread, so handlers never wait for the output. Events skip the logging
+# machinery on the calling thread altogether: their records are built by the listener.
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import time
+
+FORMAT_JSON = 'json'
+FORMAT_TEXT = 'text'
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Attributes of a record, not copied into a JSON line and not to be used as the fields of an event.
+_RESERVED = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+# event -> fraction of the events kept, 1 if not given.
+_sampling = {}
+_sampler = random.Random()  # Apart from the random module, not to disturb seeded runs.
+_listener = None
+_records = None  # The queue of the listener, once configured.
+
+
+class _EventMessage:
+    # The message of an event, built only when the record is formatted.
+    __slots__ = ('name', 'fields')
+
+    def __init__(self, name: str, fields: dict):
+        self.name = name
+        self.fields = fields
+
+    def __str__(self):
+        pairs = ' '.join('{}={}'.format(key, value) for key, value in self.fields.items() if key != 'event')
+        return '{} {}'.format(self.name, pairs) if pairs else self.name
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Leave the formatting to the listener thread.
+        return record
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    def prepare(self, item) -> logging.LogRecord:
+        # Build the record of an event queued as (created, level, logger name, fields).
+        if isinstance(item, logging.LogRecord):
+            return item
+        created, level, logger_name, fields = item
+        record = logging.LogRecord(logger_name, level, '', 0, _EventMessage(fields['event'], fields), None, None)
+        record.created = created
+        record.msecs = (created - int(created)) * 1000
+        record.__dict__.update(fields)
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line: ts, level, logger, event, message, then the fields of the event.
+    def format(self, record: logging.LogRecord) -> str:
+        data = {'ts': round(record.created, 6), 'level': record.levelname, 'logger': record.name,
+                'event': getattr(record, 'event', None), 'message': record.getMessage()}
+        for key, value in vars(record).items():
+            if key not in _RESERVED and key not in data:
+                data[key] = value
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def parse_sampling(value: str) -> dict:
+    # "event=fraction,..." -> {event: fraction}
+    sampling = {}
+    for item in value.split(','):
+        if '=' in item:
+            name, fraction = item.split('=', 1)
+            sampling[name.strip()] = float(fraction)
+    return sampling
+
+
+def configure(level: str = 'INFO', output_format: str = FORMAT_TEXT, sampling: dict = None, stream=None):
+    # Route every record through a queue to a listener thread writing to the stream (stderr by default).
+    global _listener, _records
+    stop()
+    _sampling.clear()
+    _sampling.update(sampling or {})
+
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(JsonFormatter() if output_format == FORMAT_JSON else logging.Formatter(TEXT_FORMAT))
+    records = queue.SimpleQueue()
+    _listener = _QueueListener(records, handler, respect_handler_level=True)
+    _listener.start()
+
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(_QueueHandler(records))
+    root.setLevel(level.upper())
+    _records = records
+
+
+def stop():
+    # Write the records left in the queue.
+    global _listener, _records
+    _records = None
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def event(logger: logging.Logger, level: int, name: str, chat_id=None, session=None, **fields):
+    # Log the event with its fields, unless the level is disabled or the event is sampled out.
+    if not logger.isEnabledFor(level):
+        return
+    if not _RESERVED.isdisjoint(fields):
+        # As logging does for the extra of a record: the listener would overwrite the attributes silently.
+        raise KeyError('Attempt to overwrite {} in LogRecord'.format(', '.join(sorted(_RESERVED & set(fields)))))
+    fraction = _sampling.get(name)
+    if fraction is not None and _sampler.random() >= fraction:
+        return
+    fields['event'] = name
+    if chat_id is not None:
+        fields['chat_id'] = chat_id
+    if session is not None:
+        fields['session'] = session
+    records = _records
+    if records is not None:
+        records.put((time.time(), level, logger.name, fields))
+    else:
+        logger.log(level, _EventMessage(name, fields), extra=fields)
+
+
+def elapsed_ms(started: float) -> float:
+    # Milliseconds since started, a time.perf_counter() value.
+    return round((time.perf_counter() - started) * 1e3, 3)
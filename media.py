@@ -0,0 +1,197 @@
+# Recorded voice, uploaded once. Telegram gives every uploaded file a file_id that later sends can
+# reference instead of the bytes, so the file_id of each voice file is kept by the SHA-256 of its
+# content, in SQLite across restarts. The bytes of the files not uploaded yet stay in a small LRU.
+import collections
+import hashlib
+import logging
+import os
+import random
+import sqlite3
+import threading
+
+from telegram.error import BadRequest
+
+import logs
+import outbound
+
+# Bytes of voice files kept in memory until they are uploaded.
+MAX_CACHED_BYTES = 8 * 1024 * 1024
+
+# Recordings are OGG/Opus files in a directory per kind under this one, e.g. voice/go/1.ogg.
+VOICE_DIR = 'voice'
+VOICE_EXTENSIONS = ('.ogg', '.oga', '.opus')
+
+logger = logging.getLogger(__name__)
+
+
+class _File:
+    # What is known of a file as it was at (mtime_ns, size).
+    __slots__ = ('stat', 'digest', 'data')
+
+    def __init__(self, stat: tuple, digest: str, data: bytes):
+        self.stat = stat
+        self.digest = digest
+        self.data = data  # None once uploaded or evicted.
+
+
+class MediaRegistry:
+    # Sends voice files through the outbox by file_id once uploaded. The file_ids are persisted
+    # in the SQLite database at path, or only kept in memory if path is None.
+    def __init__(self, path: str = None, voice_dir: str = VOICE_DIR, max_cached_bytes: int = MAX_CACHED_BYTES):
+        self.voice_dir = voice_dir
+        self._max_cached_bytes = max_cached_bytes
+        self._lock = threading.Lock()
+        self._file_ids = {}  # digest -> file_id
+        self._files = collections.OrderedDict()  # path -> _File, the least recently used first.
+        self._cached_bytes = 0
+        self._listings = {}  # directory -> (mtime_ns, paths)
+        self._uploads = 0
+        self._uploaded_bytes = 0
+        self._reused = 0
+
+        self._connection = None
+        if path:
+            # Shards share the database: wait for each other's writes.
+            self._connection = sqlite3.connect(path, timeout=10, check_same_thread=False)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            with self._connection:
+                self._connection.execute('CREATE TABLE IF NOT EXISTS media '
+                                         '(digest TEXT PRIMARY KEY, file_id TEXT NOT NULL)')
+            self._file_ids.update(self._connection.execute('SELECT digest, file_id FROM media'))
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def voice_files(self, dir_path: str) -> tuple:
+        # The voice files in the directory, listed again only when it changed. Empty if there is none.
+        try:
+            mtime_ns = os.stat(dir_path).st_mtime_ns
+        except OSError:
+            return ()
+        with self._lock:
+            listing = self._listings.get(dir_path)
+            if listing is not None and listing[0] == mtime_ns:
+                return listing[1]
+        paths = tuple(sorted(entry.path for entry in os.scandir(dir_path)
+                             if entry.is_file() and entry.name.lower().endswith(VOICE_EXTENSIONS)))
+        with self._lock:
+            self._listings[dir_path] = (mtime_ns, paths)
+        return paths
+
+    def send_voice(self, bot, chat_id, path: str, **kwargs):
+        # Queue the voice file in the outbox. Which of the file_id and the bytes is sent is decided
+        # when it is delivered, so that sends queued behind the first upload reuse its file_id.
+        outbound.outbox.send(bot, chat_id, self._send_voice, path=path, **kwargs)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'file_ids': len(self._file_ids),
+                    'uploads': self._uploads,
+                    'uploaded_bytes': self._uploaded_bytes,
+                    'reused': self._reused,
+                    'cached_bytes': self._cached_bytes}
+
+    def _send_voice(self, bot, path: str, **kwargs):
+        # A voice file that can't be read, e.g. removed since it was picked, is skipped: the script goes on without it.
+        try:
+            file = self._get_file(path)
+        except OSError as e:
+            logs.event(logger, logging.WARNING, 'voice_skipped', chat_id=kwargs.get('chat_id'), path=path, reason=str(e))
+            return None
+        file_id = self._file_ids.get(file.digest)
+        if file_id is not None:
+            try:
+                message = bot.send_voice(voice=file_id, **kwargs)
+            except BadRequest as e:
+                # The file_id went stale, e.g. the bot token changed: upload the file again.
+                logger.warning('Voice {} not sent by file_id: {}'.format(path, e))
+                self._forget(file.digest)
+            else:
+                with self._lock:
+                    self._reused += 1
+                return message
+
+        if file.data is not None:
+            data = file.data
+        else:
+            try:
+                data = self._read(path)[1]
+            except OSError as e:
+                logs.event(logger, logging.WARNING, 'voice_skipped', chat_id=kwargs.get('chat_id'), path=path,
+                           reason=str(e))
+                return None
+        message = bot.send_voice(voice=data, filename=os.path.basename(path), **kwargs)
+        self._remember(path, file.digest, message.voice.file_id, len(data))
+        return message
+
+    def _read(self, path: str) -> tuple:
+        # Return ((mtime_ns, size), content) of the file.
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            return (stat.st_mtime_ns, stat.st_size), f.read()
+
+    def _get_file(self, path: str) -> _File:
+        stat = os.stat(path)
+        with self._lock:
+            file = self._files.get(path)
+            if file is not None and file.stat == (stat.st_mtime_ns, stat.st_size):
+                self._files.move_to_end(path)
+                return file
+
+        file_stat, data = self._read(path)
+        file = _File(file_stat, hashlib.sha256(data).hexdigest(), data)
+        with self._lock:
+            self._evict(path)
+            if file.digest in self._file_ids:
+                file.data = None  # Already uploaded: the digest is enough.
+            self._files[path] = file
+            self._cached_bytes += len(file.data or b'')
+            while self._cached_bytes > self._max_cached_bytes and len(self._files) > 1:
+                oldest = next(iter(self._files))
+                self._evict(oldest)
+        return file
+
+    def _evict(self, path: str):
+        file = self._files.pop(path, None)
+        if file is not None:
+            self._cached_bytes -= len(file.data or b'')
+
+    def _remember(self, path: str, digest: str, file_id: str, size: int):
+        with self._lock:
+            self._file_ids[digest] = file_id
+            self._uploads += 1
+            self._uploaded_bytes += size
+            file = self._files.get(path)
+            if file is not None and file.digest == digest and file.data is not None:
+                self._cached_bytes -= len(file.data)
+                file.data = None
+            self._write('INSERT OR REPLACE INTO media VALUES (?, ?)', (digest, file_id))
+
+    def _forget(self, digest: str):
+        with self._lock:
+            self._file_ids.pop(digest, None)
+            self._write('DELETE FROM media WHERE digest = ?', (digest,))
+
+    def _write(self, statement: str, parameters: tuple):
+        # The voice was sent already: if the database fails, the file_id is only known until the bot restarts.
+        if self._connection is None:
+            return
+        try:
+            with self._connection:
+                self._connection.execute(statement, parameters)
+        except sqlite3.Error as e:
+            logs.event(logger, logging.WARNING, 'media_not_persisted', digest=parameters[0], reason=str(e))
+
+
+def pick_voice(kind: str, probability: float, rng=random):
+    # A random recording of the kind, with the probability, or None.
+    paths = registry.voice_files(os.path.join(registry.voice_dir, kind))
+    if paths and rng.random() < probability:
+        return rng.choice(paths)
+    return None
+
+
+# The registry shared by the handlers.
+registry = MediaRegistry()
@@ -0,0 +1,176 @@
+# Latency histograms, counters and gauges of the bot, served in the Prometheus text format.
+# Until enable() is called nothing is recorded and timed() returns the callbacks unwrapped.
+import bisect
+import functools
+import http.server
+import threading
+import time
+
+HANDLER_SECONDS = 'csbt_handler_seconds'
+JOB_SECONDS = 'csbt_job_seconds'
+SCRIPT_SECONDS = 'csbt_script_seconds'
+SEND_SECONDS = 'csbt_send_seconds'
+ERRORS = 'csbt_errors_total'
+
+# name -> (type, help) of the metrics recorded here. Collectors describe their own.
+DESCRIPTIONS = {
+    HANDLER_SECONDS: ('histogram', 'Time spent in an update handler.'),
+    JOB_SECONDS: ('histogram', 'Time spent in a job callback.'),
+    SCRIPT_SECONDS: ('histogram', 'Time from the start of a paced script to its last step.'),
+    SEND_SECONDS: ('histogram', 'Time from queueing a message to Telegram accepting it.'),
+    ERRORS: ('counter', 'Exceptions raised by handlers and jobs.'),
+}
+
+# Upper bounds of the histogram buckets, in seconds.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SCRIPT_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds: tuple):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # The last one is +Inf.
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _format_labels(labels: tuple, extra: str = '') -> str:
+    pairs = ['{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+             for key, value in labels]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metrics:
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._histograms = {}  # (name, labels) -> Histogram
+        self._counters = {}  # (name, labels) -> value
+        self._collectors = []
+        self._children = []
+        self.labels = {}  # Added to every sample, e.g. the tenant.
+
+    def enable(self):
+        self.enabled = True
+
+    def observe(self, name: str, value: float, **labels):
+        if self.enabled:
+            self._observe((name, tuple(sorted(labels.items()))), value)
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        if self.enabled:
+            self._inc((name, tuple(sorted(labels.items()))), amount)
+
+    def _observe(self, key: tuple, value: float):
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = Histogram(SCRIPT_BUCKETS if key[0] == SCRIPT_SECONDS else LATENCY_BUCKETS)
+                self._histograms[key] = histogram
+            histogram.observe(value)
+
+    def _inc(self, key: tuple, amount: float):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def timed(self, name: str, callback, **labels):
+        # Wrap the callback to record its latency and exceptions under the labels.
+        if not self.enabled:
+            return callback
+        labels = tuple(sorted(labels.items()))
+        latency_key, error_key = (name, labels), (ERRORS, labels)
+
+        @functools.wraps(callback)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return callback(*args, **kwargs)
+            except Exception:
+                self._inc(error_key, 1)
+                raise
+            finally:
+                self._observe(latency_key, time.perf_counter() - started)
+        return wrapper
+
+    def add_collector(self, collector):
+        # collector() returns [(name, type, help, {label: value}, value)] of values read when scraped.
+        self._collectors.append(collector)
+
+    def add_child(self, child: 'Metrics'):
+        # Render the samples of the child, e.g. the recorder of a tenant, with these.
+        self._children.append(child)
+
+    def render(self) -> str:
+        samples = {}  # name -> [(labels, suffix, value)]
+        types = dict(DESCRIPTIONS)
+        self._collect(samples, types)
+
+        lines = []
+        for name in sorted(samples):
+            kind, description = types.get(name, ('untyped', ''))
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, suffix, value in samples[name]:
+                lines.append('{}{}{} {}'.format(name, suffix, labels, value))
+        return '\n'.join(lines) + '\n'
+
+    def _collect(self, samples: dict, types: dict):
+        constant = tuple(sorted(self.labels.items()))
+        with self._lock:
+            for (name, labels), histogram in self._histograms.items():
+                labels = constant + labels
+                cumulative = 0
+                for bound, count in zip(histogram.bounds + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    samples.setdefault(name, []).append(
+                        (_format_labels(labels, 'le="{}"'.format(bound)), '_bucket', cumulative))
+                samples[name].append((_format_labels(labels), '_sum', histogram.sum))
+                samples[name].append((_format_labels(labels), '_count', histogram.count))
+            for (name, labels), value in self._counters.items():
+                samples.setdefault(name, []).append((_format_labels(constant + labels), '', value))
+        for collector in self._collectors:
+            for name, kind, description, labels, value in collector():
+                types[name] = (kind, description)
+                samples.setdefault(name, []).append(
+                    (_format_labels(tuple(sorted(dict(labels, **self.labels).items()))), '', value))
+        for child in self._children:
+            child._collect(samples, types)
+
+    def serve(self, host: str, port: int) -> http.server.HTTPServer:
+        # Serve GET /metrics on a thread of its own. Returns the server, to shut it down.
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        return server
+
+
+# The metrics shared by the handlers.
+recorder = Metrics()
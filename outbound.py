@@ -0,0 +1,269 @@
+import collections
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+
+import metrics
+
+# Telegram allows about 30 messages per second overall and about one per second in a chat.
+GLOBAL_RATE = 30
+GLOBAL_BURST = 30
+CHAT_RATE = 1
+CHAT_BURST = 3
+
+MAX_ATTEMPTS = 5
+BACKOFF_BASE_SEC = 1.0
+BACKOFF_MAX_SEC = 60.0
+
+# Seconds between two sweeps of the lanes of the chats that have nothing to send.
+SWEEP_INTERVAL_SEC = 60.0
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now: float) -> float:
+        # Consume a token and return 0, or return the seconds until one is available.
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def refund(self):
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+def _send_message(bot, **kwargs):
+    return bot.send_message(**kwargs)
+
+
+class _Outgoing:
+    __slots__ = ('bot', 'send', 'kwargs', 'enqueued', 'attempts')
+
+    def __init__(self, bot, send, kwargs: dict, enqueued: float):
+        self.bot = bot
+        self.send = send
+        self.kwargs = kwargs
+        self.enqueued = enqueued
+        self.attempts = 0
+
+
+class _Lane:
+    # Pending messages of a chat, delivered one at a time in order.
+    __slots__ = ('queue', 'bucket', 'is_busy')
+
+    def __init__(self, now: float):
+        self.queue = collections.deque()
+        self.bucket = TokenBucket(CHAT_RATE, CHAT_BURST, now)
+        self.is_busy = False  # Scheduled for or in the middle of a delivery.
+
+
+class Outbox:
+    # Central queue for outgoing messages, rate-limited per chat and overall.
+    # Until start() is called, messages are sent immediately on the calling thread.
+    def __init__(self, workers: int = 4, clock=time.monotonic):
+        self._workers = workers
+        self._clock = clock
+        self._cond = threading.Condition()
+        self._lanes = {}
+        self._ready = []  # (due, seq, chat_id) of lanes waiting for a delivery.
+        self._seq = itertools.count()
+        self._bucket = TokenBucket(GLOBAL_RATE, GLOBAL_BURST, clock())
+        self._next_sweep = clock() + SWEEP_INTERVAL_SEC
+        self._threads = []
+        self._is_running = False
+        self.listener = None  # Called with the chat_id and the kwargs of every send queued.
+
+        self._depth = 0
+        self._sent = 0
+        self._failed = 0
+        self._retried = 0
+        self._latency_sum = 0.0
+        self._latency_max = 0.0
+
+    @property
+    def workers(self) -> int:
+        return self._workers
+
+    def start(self):
+        with self._cond:
+            if self._is_running:
+                return
+            self._is_running = True
+        for i in range(self._workers):
+            thread = threading.Thread(target=self._work, name='outbox-{:d}'.format(i), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float = 10):
+        # Deliver what is left, then stop the workers.
+        with self._cond:
+            self._is_running = False
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def send_message(self, bot, chat_id, **kwargs):
+        self.send(bot, chat_id, _send_message, **kwargs)
+
+    def send(self, bot, chat_id, send, **kwargs):
+        # Queue send(bot, chat_id=chat_id, **kwargs), which calls the Bot API, in the chat's lane.
+        kwargs['chat_id'] = chat_id
+        if self.listener is not None:
+            self.listener(chat_id, kwargs)
+        now = self._clock()
+        item = _Outgoing(bot, send, kwargs, now)
+        if not self._is_running:
+            self._deliver_now(item)
+            return
+
+        with self._cond:
+            lane = self._lanes.get(chat_id)
+            if lane is None:
+                lane = _Lane(now)
+                self._lanes[chat_id] = lane
+            lane.queue.append(item)
+            self._depth += 1
+            if not lane.is_busy:
+                self._schedule(chat_id, lane, now)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {'depth': self._depth,
+                    'chats': len(self._lanes),
+                    'sent': self._sent,
+                    'failed': self._failed,
+                    'retried': self._retried,
+                    'latency_avg': self._latency_sum / self._sent if self._sent else 0.0,
+                    'latency_max': self._latency_max}
+
+    def _schedule(self, chat_id, lane: _Lane, due: float):
+        lane.is_busy = True
+        heapq.heappush(self._ready, (due, next(self._seq), chat_id))
+        self._cond.notify()
+
+    def _next(self):
+        # Wait for the next lane allowed to send. Return (chat_id, lane) or None when stopped.
+        with self._cond:
+            while True:
+                now = self._clock()
+                if self._ready and self._ready[0][0] <= now:
+                    wait_sec = self._bucket.take(now)
+                    if wait_sec:
+                        self._cond.wait(wait_sec)
+                        continue
+                    _, _, chat_id = heapq.heappop(self._ready)
+                    lane = self._lanes[chat_id]
+                    wait_sec = lane.bucket.take(now)
+                    if wait_sec:
+                        self._bucket.refund()
+                        heapq.heappush(self._ready, (now + wait_sec, next(self._seq), chat_id))
+                        continue
+                    return chat_id, lane
+                if not self._is_running and not self._ready:
+                    return None
+                self._cond.wait(self._ready[0][0] - now if self._ready else None)
+
+    def _work(self):
+        while True:
+            picked = self._next()
+            if picked is None:
+                return
+            chat_id, lane = picked
+            item = lane.queue[0]
+            retry_sec = None
+            try:
+                retry_sec = self._attempt(item)
+            finally:
+                # Whatever happened, release the lane or schedule its retry, or the chat never sends again.
+                with self._cond:
+                    now = self._clock()
+                    if retry_sec is None:  # Done, successfully or not.
+                        lane.queue.popleft()
+                        self._depth -= 1
+                        if lane.queue:
+                            self._schedule(chat_id, lane, now)
+                        else:
+                            lane.is_busy = False
+                    else:
+                        self._retried += 1
+                        self._schedule(chat_id, lane, now + retry_sec)
+                    if now >= self._next_sweep:
+                        self._sweep(now)
+
+    def _sweep(self, now: float):
+        # Drop the lanes with nothing to send whose bucket refilled: a new lane starts as full.
+        self._next_sweep = now + SWEEP_INTERVAL_SEC
+        idle = [chat_id for chat_id, lane in self._lanes.items()
+                if not lane.is_busy and not lane.queue and lane.bucket.is_full(now)]
+        for chat_id in idle:
+            del self._lanes[chat_id]
+
+    def _attempt(self, item: _Outgoing):
+        # Send the message. Return the seconds to wait before a retry, or None if it is done with.
+        item.attempts += 1
+        try:
+            item.send(item.bot, **item.kwargs)
+        except RetryAfter as e:
+            logger.warning('Flood control in {}: retry in {}s'.format(item.kwargs['chat_id'], e.retry_after))
+            return self._give_up(item, e) if item.attempts >= MAX_ATTEMPTS else float(e.retry_after)
+        except BadRequest as e:
+            return self._give_up(item, e)
+        except NetworkError as e:
+            backoff_sec = min(BACKOFF_MAX_SEC, BACKOFF_BASE_SEC * 2 ** (item.attempts - 1))
+            return self._give_up(item, e) if item.attempts >= MAX_ATTEMPTS else backoff_sec
+        except TelegramError as e:
+            return self._give_up(item, e)
+        except Exception as e:  # Not from the Bot API, e.g. a bug: not retried.
+            logger.exception('Sending to {} failed.'.format(item.kwargs['chat_id']))
+            return self._give_up(item, e)
+        self._record_sent(item)
+        return None
+
+    def _give_up(self, item: _Outgoing, e: Exception):
+        logger.warning('Message to {} dropped after {:d} attempt(s): {}'.format(item.kwargs['chat_id'], item.attempts, e))
+        with self._cond:
+            self._failed += 1
+        return None
+
+    def _deliver_now(self, item: _Outgoing):
+        item.send(item.bot, **item.kwargs)
+        self._record_sent(item)
+
+    def _record_sent(self, item: _Outgoing):
+        latency = self._clock() - item.enqueued
+        metrics.recorder.observe(metrics.SEND_SECONDS, latency)
+        with self._cond:
+            self._sent += 1
+            self._latency_sum += latency
+            self._latency_max = max(self._latency_max, latency)
+
+
+# The outbox shared by the handlers.
+outbox = Outbox()
+
+
+def send_message(bot, chat_id, **kwargs):
+    outbox.send_message(bot, chat_id, **kwargs)
@@ -0,0 +1,78 @@
+import random
+import time
+
+from telegram.ext import CallbackContext
+
+import common
+import jobs
+import media
+import metrics
+import outbound
+
+JOB_SCRIPT = 'script'
+
+
+def _send_message(context: CallbackContext, chat_id, text: str, **kwargs):
+    outbound.send_message(context.bot, chat_id, text=text, **kwargs)
+
+
+def _send_voice(context: CallbackContext, chat_id, path: str, **kwargs):
+    media.registry.send_voice(context.bot, chat_id, path, **kwargs)
+
+
+class Script:
+    # A sequence of messages and actions separated by randomized gaps.
+    # Instead of sleeping in a handler, each gap becomes a one-off job on the JobQueue,
+    # so the calling thread is released as soon as the script is started. The gaps, and the lines picked
+    # for the script, are drawn from rng: the generator of the chat's session.
+    def __init__(self, chat_id, rng=random):
+        self.chat_id = chat_id
+        self.rng = rng
+        self._steps = []  # (delay_sec, callback, args, kwargs)
+        self._delay = 0.0
+        self._started = None
+
+    def pause(self, min_sec: float = 1.8, max_sec: float = 2.4) -> 'Script':
+        # The same jitter as common.sleep_random_seconds.
+        self._delay += common.random_seconds(min_sec, max_sec, self.rng)
+        return self
+
+    def wait(self, sec: float) -> 'Script':
+        self._delay += sec
+        return self
+
+    def call(self, callback, *args, **kwargs) -> 'Script':
+        # callback(context, *args, **kwargs) runs once the accumulated gap has passed.
+        self._steps.append((self._delay, callback, args, kwargs))
+        self._delay = 0.0
+        return self
+
+    def send(self, text: str, **kwargs) -> 'Script':
+        return self.call(_send_message, self.chat_id, text, **kwargs)
+
+    def send_voice(self, path: str, **kwargs) -> 'Script':
+        return self.call(_send_voice, self.chat_id, path, **kwargs)
+
+    def start(self, context: CallbackContext):
+        self._started = time.monotonic()
+        self._run(context, 0, is_due=False)
+
+    def _run(self, context: CallbackContext, index: int, is_due: bool):
+        # Run the steps from the index inline until the next one that has to wait.
+        while index < len(self._steps):
+            delay, callback, args, kwargs = self._steps[index]
+            if delay > 0 and not is_due:
+                jobs.registry.run_once(context, _resume_script, delay, self.chat_id, JOB_SCRIPT, data=(self, index))
+                return
+            is_due = False
+            callback(context, *args, **kwargs)
+            index += 1
+        metrics.recorder.observe(metrics.SCRIPT_SECONDS, time.monotonic() - self._started)
+
+    def __len__(self):
+        return len(self._steps)
+
+
+def _resume_script(context: CallbackContext):
+    script, index = context.job.context
+    script._run(context, index, is_due=True)
@@ -0,0 +1,108 @@
+import json
+import logging
+import sqlite3
+import threading
+
+FLUSH_INTERVAL_SEC = 1.0
+
+logger = logging.getLogger(__name__)
+
+
+class Persistence:
+    # Snapshots of the sessions, their cycle plans and pending timers in SQLite.
+    # Changed chats are marked by touch() and written in batches by a background thread,
+    # so that handlers never wait for the disk.
+    def __init__(self, path: str, snapshot):
+        # snapshot(chat_id) returns (session dict or None, plan list or None, {kind: due epoch seconds}).
+        self._snapshot = snapshot
+        self._dirty = set()
+        self._values = {}  # Changed values of the meta table.
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        with self._connection:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS sessions '
+                                     '(chat_id INTEGER PRIMARY KEY, session TEXT NOT NULL, plan TEXT)')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS timers '
+                                     '(chat_id INTEGER, kind TEXT, due REAL, PRIMARY KEY (chat_id, kind))')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+
+    def touch(self, chat_id):
+        with self._lock:
+            self._dirty.add(chat_id)
+
+    def set_value(self, key: str, value):
+        # Persisted with the next batch, as JSON.
+        with self._lock:
+            self._values[key] = value
+
+    def get_value(self, key: str, default=None):
+        row = self._connection.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='persistence', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+        self.flush()
+        self._connection.close()
+
+    def _run(self):
+        while not self._stopped.wait(FLUSH_INTERVAL_SEC):
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                logger.warning('Failed to persist sessions: {}'.format(e))
+
+    def flush(self) -> int:
+        # Write the chats changed since the last flush in one transaction. Returns the number of chats.
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            values, self._values = self._values, {}
+        if not dirty and not values:
+            return 0
+
+        upserted, deleted, timers = [], [], []
+        for chat_id in dirty:
+            session, plan, due_times = self._snapshot(chat_id)
+            deleted.append((chat_id,))
+            if session is None:
+                continue
+            upserted.append((chat_id, json.dumps(session), json.dumps(plan) if plan else None))
+            timers.extend((chat_id, kind, due) for kind, due in due_times.items())
+
+        try:
+            with self._connection:
+                self._connection.executemany('DELETE FROM timers WHERE chat_id = ?', deleted)
+                self._connection.executemany('DELETE FROM sessions WHERE chat_id = ?', deleted)
+                self._connection.executemany('INSERT INTO sessions VALUES (?, ?, ?)', upserted)
+                self._connection.executemany('INSERT INTO timers VALUES (?, ?, ?)', timers)
+                self._connection.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                                             [(key, json.dumps(value)) for key, value in values.items()])
+        except sqlite3.Error:
+            # Rolled back: write them with the next batch. Values set meanwhile are newer.
+            with self._lock:
+                self._dirty |= dirty
+                values.update(self._values)
+                self._values = values
+            raise
+        return len(dirty)
+
+    def load(self) -> list:
+        # Return [(chat_id, session dict, plan list or None, {kind: due})] of every persisted chat.
+        timers = {}
+        for chat_id, kind, due in self._connection.execute('SELECT chat_id, kind, due FROM timers'):
+            timers.setdefault(chat_id, {})[kind] = due
+
+        loaded = []
+        for chat_id, session, plan in self._connection.execute('SELECT chat_id, session, plan FROM sessions'):
+            loaded.append((chat_id, json.loads(session), json.loads(plan) if plan else None, timers.get(chat_id, {})))
+        return loaded
@@ -0,0 +1,95 @@
+# Recordings of the sessions, replayed by replay.py. Each line of the file is a JSON object: an event of a chat
+# at t, time.time(). The events are the state of a session when it is first seen, restored or reset, with the
+# seed of its random draws, the updates admitted for the chat, and the messages queued to it. The lines are
+# written by a thread of their own.
+import json
+import logging
+import queue
+import threading
+import time
+
+SESSION_NEW = 'new'
+SESSION_RESTORED = 'restored'
+SESSION_RESET = 'reset'
+
+logger = logging.getLogger(__name__)
+
+
+def describe(kwargs: dict) -> dict:
+    # What is recorded of a send queued in the outbox: the text of a message, or the path of a voice file.
+    return {key: kwargs[key] for key in ('text', 'path') if key in kwargs}
+
+
+class Recorder:
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        self._lines = None  # Queue of the writer thread while recording.
+        self._thread = None
+        self._chats = set()  # Chats whose session was recorded.
+
+    @property
+    def is_recording(self) -> bool:
+        return self._lines is not None
+
+    def start(self, path: str):
+        # Append to the file at path.
+        self._lines = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._write, args=(open(path, 'a', encoding='utf-8'), self._lines),
+                                        name='recording', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._lines is None:
+            return
+        self._lines.put(None)
+        self._thread.join()
+        self._lines = None
+        self._thread = None
+
+    def has_session(self, chat_id) -> bool:
+        return chat_id in self._chats
+
+    def session(self, chat_id, kind: str, chat_state: tuple):
+        # chat_state as snapshot_chat returns it: (session snapshot, cycle plan, due times of the jobs).
+        self._chats.add(chat_id)
+        self._put(chat_id, 'session', {'kind': kind, 'state': chat_state})
+
+    def update(self, chat_id, data: dict):
+        self._put(chat_id, 'update', data)
+
+    def sent(self, chat_id, kwargs: dict):
+        # The listener of the outbox.
+        self._put(chat_id, 'sent', describe(kwargs))
+
+    def _put(self, chat_id, key: str, value):
+        lines = self._lines
+        if lines is not None:
+            lines.put({'t': self._clock(), 'chat_id': chat_id, key: value})
+
+    def _write(self, file, lines: queue.SimpleQueue):
+        with file:
+            while True:
+                event = lines.get()
+                if event is None:
+                    return
+                try:
+                    file.write(json.dumps(event, ensure_ascii=False) + '\n')
+                except (TypeError, ValueError) as e:
+                    logger.warning('Event of chat {} not recorded: {}'.format(event['chat_id'], e))
+                if lines.empty():
+                    file.flush()
+
+
+def read(path: str) -> dict:
+    # The events of the recording at path, by chat_id, in the order they were recorded.
+    events = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                event = json.loads(line)
+                events.setdefault(event['chat_id'], []).append(event)
+    return events
+
+
+# The recorder of the bot, off until started.
+recorder = Recorder()
@@ -0,0 +1,47 @@
+# Messages rendered once and then looked up: the command menus of the corpus, rebuilt when a new
+# corpus version replaces their file, and the MarkdownV2 of the informative messages.
+import re
+
+import common
+
+# Rendered informative templates kept. Texts formatted before being passed are cached too, up to this.
+MAX_TEMPLATES = 512
+
+# Characters to escape inside a code span of MarkdownV2. Any other character is taken literally there.
+# https://core.telegram.org/bots/api#markdownv2-style
+_RESERVED_IN_CODE = re.compile(r'([`\\])')
+
+_menus = {}  # filename -> (rows it was rendered from, text)
+_templates = {}  # (template, is_parenthesis) -> MarkdownV2
+
+
+def escape_code(text: str) -> str:
+    return _RESERVED_IN_CODE.sub(r'\\\1', text)
+
+
+def menu(filename: str) -> str:
+    # "/command<tab>description" lines of the rows of the file.
+    rows = common.build_tuple_of_tuples(filename)
+    cached = _menus.get(filename)
+    if cached is not None and cached[0] is rows:
+        return cached[1]
+    text = '\n'.join('/{}\t{}'.format(command, desc) for command, desc in rows)
+    _menus[filename] = (rows, text)
+    return text
+
+
+def informative(template: str, args: tuple = (), is_parenthesis: bool = True) -> str:
+    # The template formatted with the args, in a code span and in parentheses if is_parenthesis.
+    # Without args, the template is the text itself.
+    key = (template, is_parenthesis)
+    rendered = _templates.get(key)
+    if rendered is None:
+        # Braces are not escaped: they are the fields of the template.
+        rendered = ('`({})`' if is_parenthesis else '`{}`').format(escape_code(template))
+        if len(_templates) < MAX_TEMPLATES:
+            _templates[key] = rendered
+    for arg in args:
+        if isinstance(arg, str):
+            args = tuple(escape_code(arg) if isinstance(arg, str) else arg for arg in args)
+            break
+    return rendered.format(*args) if args else rendered
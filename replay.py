@@ -0,0 +1,118 @@
+# Replays the sessions of a recording (see recording.py) through the handlers, against the virtual clock and
+# fake bot of simulator.py at full speed, and compares the messages with the recorded ones: what was sent,
+# and when. Run `python replay.py <recording> [chat_id ...]` where the bot ran, for its corpus.
+import argparse
+import difflib
+import json
+import sys
+import time
+
+from telegram import Update
+from telegram.ext import CallbackContext
+
+import csbt
+import inbound
+import jobs
+import outbound
+import pacing
+import recording
+import simulator
+
+# Messages sent this much earlier or later than recorded are reported.
+TIMING_TOLERANCE_SEC = 0.5
+
+
+def _restore(sim: simulator.Simulator, chat_id, at: float, chat_state: list):
+    # As the bot restarting at the time: the jobs of the chat due while it was stopped never ran and the
+    # others are lost, then its session and timers are restored.
+    sim.clock.now = max(sim.clock.now, at)
+    jobs.registry.cancel(chat_id, csbt.Constants.SESSION_JOBS + (csbt.Constants.JOB_RENEW, pacing.JOB_SCRIPT))
+    jobs.registry.pop_plan(chat_id)
+    data, plan, due_times = chat_state
+    csbt.restore_sessions(CallbackContext(sim.dispatcher), [(chat_id, data, plan, due_times)])
+
+
+def replay(chat_id, events: list) -> dict:
+    # Replay the events of the chat from its first recorded session. Returns the comparison.
+    start = next(i for i, event in enumerate(events) if 'session' in event)
+    events = events[start:]
+    sim = simulator.Simulator()
+    inbound.admission = inbound.Admission(coalesce_sec=0, max_pending=None, clock=sim.clock)  # Admitted already.
+    produced = []
+    outbound.outbox.listener = lambda _, kwargs: produced.append((sim.clock.now, recording.describe(kwargs)))
+
+    expected = []
+    seeds = []  # (recorded, replayed) seeds of the sessions started during the replay.
+    updates = 0
+    sim.clock.now = events[0]['t']
+    started = time.perf_counter()
+    for event in events:
+        if 'session' in event and event['session']['kind'] != recording.SESSION_RESET:
+            # The bot started: nothing ran since the previous event.
+            _restore(sim, chat_id, event['t'], event['session']['state'])
+            continue
+        sim.job_queue.run_until(event['t'])
+        if 'session' in event:
+            seeds.append((event['session']['state'][0]['seed'], csbt.get_session(chat_id).seed))
+        elif 'update' in event:
+            sim.process(Update.de_json(event['update'], sim.bot))
+            updates += 1
+        elif 'sent' in event:
+            expected.append((event['t'], event['sent']))
+    wall_sec = time.perf_counter() - started
+
+    recorded_lines = [json.dumps(sent, ensure_ascii=False) for _, sent in expected]
+    replayed_lines = [json.dumps(sent, ensure_ascii=False) for _, sent in produced]
+    matcher = difflib.SequenceMatcher(None, recorded_lines, replayed_lines, autojunk=False)
+    deltas = []  # (offset from the start, replayed - recorded seconds, message)
+    for block in matcher.get_matching_blocks():
+        for i in range(block.size):
+            at = expected[block.a + i][0]
+            deltas.append((at - events[0]['t'], produced[block.b + i][0] - at, recorded_lines[block.a + i]))
+    return {'chat_id': chat_id,
+            'updates': updates,
+            'recorded': len(expected),
+            'replayed': len(produced),
+            'matched': len(deltas),
+            'diff': list(difflib.unified_diff(recorded_lines, replayed_lines, 'recorded', 'replayed', lineterm='')),
+            'mistimed': [delta for delta in deltas if abs(delta[1]) > TIMING_TOLERANCE_SEC],
+            'max_delta': max((abs(delta) for _, delta, _ in deltas), default=0.0),
+            'reseeded': [pair for pair in seeds if pair[0] != pair[1]],
+            'errors': len(sim.errors) + len(sim.job_queue.errors),
+            'virtual_sec': sim.clock.now - events[0]['t'],
+            'wall_sec': wall_sec}
+
+
+def is_identical(report: dict) -> bool:
+    return not (report['diff'] or report['mistimed'] or report['reseeded'] or report['errors'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded sessions and compare their messages.')
+    parser.add_argument('path', help='Recording, the record_path of config.pv')
+    parser.add_argument('chats', nargs='*', type=int, metavar='chat_id', help='Chats to replay (default: all)')
+    args = parser.parse_args()
+
+    events = recording.read(args.path)
+    differing = 0
+    for chat_id in args.chats or sorted(events):
+        if not any('session' in event for event in events.get(chat_id, ())):
+            print('chat {}: no session recorded'.format(chat_id))
+            differing += 1
+            continue
+        report = replay(chat_id, events[chat_id])
+        print('chat {chat_id}: {updates:d} updates, {recorded:d} messages recorded, {replayed:d} replayed, '
+              '{matched:d} alike, timing off by up to {max_delta:.3f} s, {errors:d} errors, '
+              '{virtual_sec:.0f} s replayed in {wall_sec:.3f} s'.format(**report))
+        for recorded, replayed in report['reseeded']:
+            print('  session seeded {} instead of {}'.format(replayed, recorded))
+        for offset, delta, line in report['mistimed']:
+            print('  {:+10.3f} s sent {:+.3f} s off: {}'.format(offset, delta, line))
+        for line in report['diff']:
+            print('  ' + line)
+        differing += not is_identical(report)
+    sys.exit(1 if differing else 0)
+
+
+if __name__ == '__main__':
+    main()
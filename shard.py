@@ -0,0 +1,205 @@
+# Horizontal sharding: one ingress process receives the updates and hands each to the worker process
+# owning its chat, chosen by a hash of chat_id. A worker owns the sessions, timers and state database
+# of its chats. The updates of a shard are sent in the order they arrived through one pipe, and the
+# lanes of the worker run those of a chat in that order. Workers are restarted one at a time: the
+# updates of a restarting shard wait in the ingress for the new process, and the other shards keep running.
+import logging
+import multiprocessing
+import queue
+import threading
+import zlib
+
+from telegram import Update
+from telegram.ext import CallbackContext
+
+# Seconds between two checks of the workers by the supervisor.
+SUPERVISE_INTERVAL_SEC = 1.0
+
+# Seconds for a worker to handle the updates sent to it and exit, then to exit once terminated, before it is killed.
+STOP_TIMEOUT_SEC = 30.0
+TERMINATE_TIMEOUT_SEC = 5.0
+
+CONTROL_CHECK = 'check'  # Replace the worker if it died.
+CONTROL_RESTART = 'restart'  # Replace the worker once it handled the updates sent so far.
+CONTROL_STOP = 'stop'  # Stop the worker once it handled the updates sent so far.
+
+logger = logging.getLogger(__name__)
+
+
+def shard_of(chat_id, shards: int) -> int:
+    # Stable across processes and runs, unlike hash(). Keep the number of shards when restarting,
+    # or the chats move away from their persisted sessions.
+    return zlib.crc32(str(chat_id).encode('utf-8')) % shards
+
+
+def receive(connection):
+    # The updates sent to a worker, until the ingress stops it or goes away.
+    while True:
+        try:
+            data = connection.recv()
+        except EOFError:
+            return
+        if data is None:
+            return
+        yield data
+
+
+def _get_context(target) -> multiprocessing.context.BaseContext:
+    # The ingress runs threads: don't fork it. Where possible, fork the workers from a server that
+    # imported the module of the target once, instead of importing it again in every new process.
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('spawn')
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload([target.__module__])
+    return context
+
+
+class _Control:
+    __slots__ = ('kind', 'done')
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.done = threading.Event()
+
+
+class _Shard:
+    __slots__ = ('index', 'pending', 'connection', 'process', 'sender', 'routed', 'restarts')
+
+    def __init__(self, index: int):
+        self.index = index
+        self.pending = queue.SimpleQueue()  # Updates and controls, sent in order by the sender thread.
+        self.connection = None
+        self.process = None
+        self.sender = None
+        self.routed = 0
+        self.restarts = 0
+
+
+class ShardRouter:
+    # Starts the worker processes and routes the updates to them.
+    # target(index, shards, connection, *args) runs a worker in a new process: it handles the
+    # JSON-serialized updates of receive(connection), then returns.
+    def __init__(self, shards: int, target, args: tuple = ()):
+        self.shards = shards
+        self._target = target
+        self._args = args
+        self._context = _get_context(target)
+        self._shards = [_Shard(index) for index in range(shards)]
+        self._stopped = threading.Event()
+        self._supervisor = None
+
+    def start(self):
+        for shard in self._shards:
+            self._spawn(shard)
+            shard.sender = threading.Thread(target=self._send, args=(shard,), name='shard-{:d}'.format(shard.index),
+                                            daemon=True)
+            shard.sender.start()
+        self._supervisor = threading.Thread(target=self._supervise, name='shards', daemon=True)
+        self._supervisor.start()
+
+    def stop(self):
+        # Let every worker handle the updates routed so far, then wait for it to exit.
+        self._stopped.set()
+        controls = [self._control(shard, CONTROL_STOP) for shard in self._shards]
+        for control in controls:
+            control.done.wait()
+
+    def restart(self, index: int):
+        # Replace a worker once it handled the updates routed so far, e.g. to load new code.
+        self._control(self._shards[index], CONTROL_RESTART).done.wait()
+
+    def restart_all(self):
+        # One worker at a time, so that only the chats of one shard wait.
+        for index in range(self.shards):
+            self.restart(index)
+
+    def route(self, chat_id, data: str):
+        shard = self._shards[shard_of(chat_id, self.shards) if chat_id is not None else 0]
+        shard.routed += 1
+        shard.pending.put(data)
+
+    def handle(self, update: Update, context: CallbackContext):
+        # The ingress' only handler.
+        chat = update.effective_chat
+        self.route(chat.id if chat else None, update.to_json())
+
+    def stats(self) -> dict:
+        return {'routed': [shard.routed for shard in self._shards],
+                'restarts': [shard.restarts for shard in self._shards],
+                'alive': sum(1 for shard in self._shards if shard.process.is_alive())}
+
+    def collect_metrics(self) -> list:
+        samples = []
+        for shard in self._shards:
+            labels = {'shard': shard.index}
+            samples.append(('csbt_shard_updates_total', 'counter', 'Updates routed to a shard.', labels, shard.routed))
+            samples.append(('csbt_shard_restarts_total', 'counter', 'Restarts of a shard.', labels, shard.restarts))
+        return samples
+
+    def _control(self, shard: _Shard, kind: str) -> _Control:
+        control = _Control(kind)
+        shard.pending.put(control)
+        return control
+
+    def _spawn(self, shard: _Shard):
+        reader, writer = self._context.Pipe(duplex=False)
+        shard.process = self._context.Process(target=self._target, name='shard-{:d}'.format(shard.index),
+                                              args=(shard.index, self.shards, reader) + self._args)
+        shard.process.start()
+        reader.close()
+        shard.connection = writer
+
+    def _replace(self, shard: _Shard, graceful: bool):
+        try:
+            if graceful:
+                shard.connection.send(None)
+        except OSError:
+            pass
+        shard.connection.close()
+        shard.process.join(STOP_TIMEOUT_SEC)
+        if shard.process.is_alive():
+            logger.warning('Shard {:d} did not exit in {:.0f} s: terminating it.'.format(shard.index, STOP_TIMEOUT_SEC))
+            shard.process.terminate()
+            shard.process.join(TERMINATE_TIMEOUT_SEC)
+        if shard.process.is_alive():
+            logger.warning('Shard {:d} did not exit once terminated: killing it.'.format(shard.index))
+            shard.process.kill()
+            shard.process.join()
+        if not self._stopped.is_set():
+            shard.restarts += 1
+            self._spawn(shard)
+
+    def _send(self, shard: _Shard):
+        while True:
+            item = shard.pending.get()
+            if isinstance(item, _Control):
+                if item.kind == CONTROL_CHECK and not shard.process.is_alive():
+                    logger.warning('Shard {:d} exited with {}: restarting it.'.format(shard.index, shard.process.exitcode))
+                    self._replace(shard, graceful=False)
+                elif item.kind in (CONTROL_RESTART, CONTROL_STOP):
+                    self._replace(shard, graceful=True)
+                    if item.kind == CONTROL_RESTART:
+                        logger.info('Shard {:d} restarted.'.format(shard.index))
+                item.done.set()
+                if item.kind == CONTROL_STOP:
+                    return
+                continue
+
+            # A worker that died takes the updates it was handling, and those left in the pipe, with it.
+            # Those still waiting here go to the new worker.
+            while True:
+                try:
+                    shard.connection.send(item)
+                    break
+                except OSError:
+                    logger.warning('Shard {:d} exited with {}: restarting it.'.format(shard.index, shard.process.exitcode))
+                    self._replace(shard, graceful=False)
+                    if self._stopped.is_set():
+                        break
+
+    def _supervise(self):
+        # Replace the workers that died while no update was sent to them.
+        while not self._stopped.wait(SUPERVISE_INTERVAL_SEC):
+            for shard in self._shards:
+                if not shard.process.is_alive():
+                    self._control(shard, CONTROL_CHECK)
@@ -0,0 +1,543 @@
+# Drives csbt's handlers with synthetic updates against a recording bot and a virtual clock,
+# so that thousands of paced sessions run in seconds without Telegram.
+import datetime
+import heapq
+import http.server
+import itertools
+import json
+import multiprocessing
+import queue
+import random
+import threading
+import time
+import tracemalloc
+
+from telegram import Message, Update
+from telegram.error import BadRequest
+from telegram.ext import CallbackContext, Dispatcher
+
+import common
+import csbt
+import inbound
+import jobs
+import media
+import outbound
+import recording
+import shard
+import state
+
+
+class VirtualClock:
+    # Seconds since the epoch, as time.time() would return.
+    def __init__(self, now: float = 0.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class VirtualJob:
+    __slots__ = ('callback', 'context', 'name', 'due', 'interval', 'removed')
+
+    def __init__(self, callback, context, name: str, due: float, interval: float = None):
+        self.callback = callback
+        self.context = context
+        self.name = name
+        self.due = due
+        self.interval = interval
+        self.removed = False
+
+    def schedule_removal(self):
+        self.removed = True
+
+
+class VirtualJobQueue:
+    # The part of telegram.ext.JobQueue the bot uses, run by a virtual clock.
+    # Jobs may be scheduled from any thread; they are fired by the thread calling run_until.
+    def __init__(self, clock: VirtualClock):
+        self.clock = clock
+        self.errors = []
+        self.latencies = []
+        self._heap = []
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        self._dispatcher = None
+
+    def set_dispatcher(self, dispatcher: Dispatcher):
+        self._dispatcher = dispatcher
+
+    def run_once(self, callback, when: float, context: object = None, name: str = None) -> VirtualJob:
+        job = VirtualJob(callback, context, name, self.clock.now + when)
+        self._push(job)
+        return job
+
+    def run_daily(self, callback, time: datetime.time, days: tuple = tuple(range(7)),
+                  context: object = None, name: str = None) -> VirtualJob:
+        # Every day at the time, in the time zone of the time (UTC if naive).
+        tz = time.tzinfo or datetime.timezone.utc
+        now = datetime.datetime.fromtimestamp(self.clock.now, tz)
+        first = datetime.datetime.combine(now.date(), time.replace(tzinfo=None))
+        first = tz.localize(first) if hasattr(tz, 'localize') else first.replace(tzinfo=tz)
+        if first <= now:
+            first += datetime.timedelta(days=1)
+        job = VirtualJob(callback, context, name, first.timestamp(), interval=24 * 3600)
+        self._push(job)
+        return job
+
+    def _push(self, job: VirtualJob):
+        with self._lock:
+            heapq.heappush(self._heap, (job.due, next(self._seq), job))
+
+    def jobs(self) -> tuple:
+        with self._lock:
+            return tuple(job for _, _, job in self._heap if not job.removed)
+
+    def next_due(self):
+        with self._lock:
+            while self._heap and self._heap[0][2].removed:
+                heapq.heappop(self._heap)
+            return self._heap[0][0] if self._heap else None
+
+    def _pop_due(self, deadline: float):
+        with self._lock:
+            while self._heap and self._heap[0][2].removed:
+                heapq.heappop(self._heap)
+            if not self._heap or self._heap[0][0] > deadline:
+                return None
+            _, _, job = heapq.heappop(self._heap)
+            self.clock.now = max(self.clock.now, job.due)
+            if job.interval:
+                job.due += job.interval
+                heapq.heappush(self._heap, (job.due, next(self._seq), job))
+            return job
+
+    def run_until(self, deadline: float) -> int:
+        # Fire the jobs due until the deadline in order, moving the clock along. Returns the number fired.
+        fired = 0
+        while True:
+            job = self._pop_due(deadline)
+            if job is None:
+                break
+            started = time.perf_counter()
+            try:
+                job.callback(CallbackContext.from_job(job, self._dispatcher))
+            except Exception as e:
+                self.errors.append((job.name, e))
+            self.latencies.append(time.perf_counter() - started)
+            fired += 1
+        self.clock.now = max(self.clock.now, deadline)
+        return fired
+
+    def __len__(self):
+        return len(self.jobs())
+
+
+class SentMessage:
+    __slots__ = ('time', 'chat_id', 'text', 'kwargs')
+
+    def __init__(self, time_sec: float, chat_id, text: str, kwargs: dict):
+        self.time = time_sec
+        self.chat_id = chat_id
+        self.text = text
+        self.kwargs = kwargs
+
+    def __repr__(self):
+        return 'SentMessage({:.1f}, {}, {!r})'.format(self.time, self.chat_id, self.text)
+
+
+class FakeBot:
+    # Records what would have been sent.
+    id = 1
+    first_name = 'csbt'
+    username = 'csbt_bot'
+    defaults = None
+
+    def __init__(self, clock: VirtualClock):
+        self.clock = clock
+        self.sent = []
+        self.uploads = {}  # file_id -> bytes uploaded
+        self._message_ids = itertools.count(1)
+
+    def send_message(self, chat_id, text: str, **kwargs):
+        self.sent.append(SentMessage(self.clock.now, chat_id, text, kwargs))
+        return next(self._message_ids)
+
+    def send_voice(self, chat_id, voice, **kwargs):
+        # Issues a fake file_id for uploaded bytes, and accepts only the file_ids it issued.
+        if isinstance(voice, str):
+            if voice not in self.uploads:
+                raise BadRequest('Wrong file identifier/http url specified')
+            file_id = voice
+        else:
+            file_id = 'voice-{:d}'.format(len(self.uploads) + 1)
+            self.uploads[file_id] = voice
+        self.sent.append(SentMessage(self.clock.now, chat_id, '', dict(kwargs, voice=file_id)))
+        return Message.de_json({'message_id': next(self._message_ids), 'date': int(self.clock.now),
+                                'chat': {'id': chat_id, 'type': 'private'},
+                                'voice': {'file_id': file_id, 'file_unique_id': file_id, 'duration': 1}}, self)
+
+
+def make_update_data(update_id: int, time_sec: float, chat_id, text: str, chat_type: str = 'private') -> dict:
+    # A message update as Telegram serializes it.
+    data = {'update_id': update_id,
+            'message': {'message_id': update_id, 'date': int(time_sec),
+                        'chat': {'id': chat_id, 'type': chat_type},
+                        'from': {'id': chat_id, 'is_bot': False, 'first_name': 'user'},
+                        'text': text}}
+    if text.startswith('/'):
+        data['message']['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return data
+
+
+class Simulator:
+    # Replaces csbt's shared state with fresh instances bound to the virtual clock.
+    def __init__(self, workers: int = 4):
+        self.clock = VirtualClock()
+        self.bot = FakeBot(self.clock)
+        self.job_queue = VirtualJobQueue(self.clock)
+        self.dispatcher = Dispatcher(self.bot, queue.Queue(), workers=workers, job_queue=self.job_queue)
+        self.job_queue.set_dispatcher(self.dispatcher)
+        self.errors = []
+        self.latencies = []
+        self.touched = set()  # Chats whose jobs ran or changed since last cleared.
+        self._update_ids = itertools.count(1)
+
+        csbt.sessions = state.SessionStore()
+        csbt.state_store = None
+        jobs.registry = jobs.JobRegistry(clock=self.clock)
+        jobs.registry.listener = self.touched.add
+        jobs.registry.guard = csbt.chat_lock
+        inbound.lanes = inbound.ChatLanes()  # Not started: handlers run on the calling thread.
+        inbound.admission = inbound.Admission(clock=self.clock)
+        outbound.outbox = outbound.Outbox(clock=self.clock)  # Not started: sends immediately.
+        media.registry = media.MediaRegistry()
+        common.CORPUS_CHECK_INTERVAL_SEC = float('inf')
+
+        csbt.add_command_handlers(self.dispatcher)
+        self.dispatcher.add_error_handler(self._record_error)
+
+    def _record_error(self, update: Update, context: CallbackContext):
+        self.errors.append((update, context.error))
+
+    def make_update(self, chat_id, text: str, chat_type: str = 'private') -> Update:
+        data = make_update_data(next(self._update_ids), self.clock.now, chat_id, text, chat_type)
+        return Update.de_json(data, self.bot)
+
+    def process(self, update: Update):
+        started = time.perf_counter()
+        self.dispatcher.process_update(update)
+        self.latencies.append(time.perf_counter() - started)
+
+    def send(self, chat_id, text: str, chat_type: str = 'private') -> Update:
+        update = self.make_update(chat_id, text, chat_type)
+        self.process(update)
+        return update
+
+    def advance(self, seconds: float) -> int:
+        return self.job_queue.run_until(self.clock.now + seconds)
+
+    def run_until_idle(self, limit_sec: float = 7 * 24 * 3600) -> int:
+        return self.job_queue.run_until(self.clock.now + limit_sec)
+
+
+class StubBotApi:
+    # A local HTTP server answering the Bot API methods the bot calls, for base_url in config.pv.
+    # Records the time of each call. getUpdates waits a little and returns nothing, as long polling would.
+    # Each response waits latency_sec, and each new connection handshake_sec first, as the round trips
+    # to Telegram and its TLS handshake would.
+    def __init__(self, port: int = 0, poll_sec: float = 0.05, latency_sec: float = 0.0, handshake_sec: float = 0.0):
+        stub = self
+        self.calls = []  # (time.monotonic(), method)
+        self.connections = 0
+        self.poll_sec = poll_sec
+        self.latency_sec = latency_sec
+        self.handshake_sec = handshake_sec
+        self._message_ids = itertools.count(1)
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True  # The headers and the body are written apart: don't delay the body.
+
+            def setup(self):
+                stub.connections += 1
+                time.sleep(stub.handshake_sec)
+                super().setup()
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                method = self.path.rsplit('/', 1)[-1]
+                stub.calls.append((time.monotonic(), method))
+                time.sleep(stub.latency_sec)
+                body = json.dumps({'ok': True, 'result': stub.result(method)}).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name='stub-api', daemon=True).start()
+
+    @property
+    def base_url(self) -> str:
+        return 'http://127.0.0.1:{:d}/bot'.format(self.server.server_address[1])
+
+    def result(self, method: str):
+        if method == 'getMe':
+            return {'id': FakeBot.id, 'is_bot': True, 'first_name': FakeBot.first_name, 'username': FakeBot.username}
+        if method == 'getUpdates':
+            time.sleep(self.poll_sec)
+            return []
+        if method.startswith('send'):
+            return {'message_id': next(self._message_ids), 'date': int(time.time()),
+                    'chat': {'id': 1, 'type': 'private'}}
+        return True
+
+    def first_call(self, method: str):
+        # time.monotonic() of the first call of the method, or None.
+        return next((at for at, called in list(self.calls) if called == method), None)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def _percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def _answer_when_asked(simulator: Simulator, pending: set, names: dict, success_rate: float):
+    # Report success or failure as soon as each chat is asked.
+    while pending:
+        due = simulator.job_queue.next_due()
+        if due is None:
+            break
+        simulator.touched.clear()
+        simulator.job_queue.run_until(due)
+        for chat_id in simulator.touched & pending:
+            session = csbt.sessions.get(chat_id)
+            if session.is_s_listening and session.is_f_listening:
+                if random.random() < success_rate:
+                    simulator.send(chat_id, '/' + names['s'])
+                else:
+                    simulator.send(chat_id, '/' + names['f'])
+                pending.discard(chat_id)
+            elif not session.is_active:
+                pending.discard(chat_id)
+
+
+def run_load(chats: int, seed: int = 0, success_rate: float = 0.5, record_path: str = None) -> dict:
+    # Each chat asks for a duration (/2) within the first minute, follows the whole cycle and
+    # reports success or failure when asked. Returns the measurements. The sessions are recorded
+    # at record_path if given, see replay.py.
+    random.seed(seed)
+    tracemalloc.start()
+    simulator = Simulator()
+    if record_path:
+        recording.recorder = recording.Recorder(clock=simulator.clock)
+        recording.recorder.start(record_path)
+        outbound.outbox.listener = recording.recorder.sent
+    names = csbt.corpus_command_names()
+    baseline = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+
+    arrivals = sorted((random.uniform(0, 60), chat_id) for chat_id in range(1, chats + 1))
+    for arrival, chat_id in arrivals:
+        simulator.job_queue.run_until(arrival)
+        simulator.send(chat_id, '/' + names['2'])
+    active_memory = tracemalloc.get_traced_memory()[0] - baseline
+
+    _answer_when_asked(simulator, set(range(1, chats + 1)), names, success_rate)
+    simulator.run_until_idle()
+
+    elapsed = time.perf_counter() - started
+    tracemalloc.stop()
+    recording.recorder.stop()
+    return {'chats': chats,
+            'messages': len(simulator.bot.sent),
+            'updates': len(simulator.latencies),
+            'jobs': len(simulator.job_queue.latencies),
+            'errors': len(simulator.errors) + len(simulator.job_queue.errors),
+            'virtual_sec': simulator.clock.now,
+            'wall_sec': elapsed,
+            'messages_per_sec': len(simulator.bot.sent) / elapsed,
+            'handler_avg': sum(simulator.latencies) / max(1, len(simulator.latencies)),
+            'handler_p95': _percentile(simulator.latencies, 0.95),
+            'job_avg': sum(simulator.job_queue.latencies) / max(1, len(simulator.job_queue.latencies)),
+            'job_p95': _percentile(simulator.job_queue.latencies, 0.95),
+            'bytes_per_session': active_memory / chats}
+
+
+def run_stress(chats: int, updates_per_chat: int = 20, senders: int = 8, workers: int = 8, seed: int = 0) -> dict:
+    # Updates of all the chats arrive at once from several threads, as from a webhook under load, and go
+    # through the dispatcher's queue and workers while jobs fire on another thread. Every chat keeps asking
+    # for a direction (/1). Checks that a chat is answered in the order it asked, that only its first
+    # request is accepted, and that no denial of a chat that is not allowed is lost.
+    random.seed(seed)
+    simulator = Simulator(workers=workers)
+    simulator.clock.now = 3 * 3600  # Noon in Seoul: the daily renewal doesn't reset the denials during the run.
+    names = csbt.corpus_command_names()
+    denied = set(range(2, chats + 1, 2))
+    for chat_id in denied:
+        csbt.sessions.get(chat_id).is_allowed = False
+    inbound.admission = inbound.Admission(coalesce_sec=0, max_pending=None)  # Every update reaches its lane.
+
+    inbound.lanes.start(simulator.dispatcher)
+    dispatcher_thread = threading.Thread(target=simulator.dispatcher.start, name='dispatcher')
+    dispatcher_thread.start()
+    stopped = threading.Event()
+    update_ids = {chat_id: [] for chat_id in range(1, chats + 1)}
+
+    def send_updates(own_chats: list):
+        for _ in range(updates_per_chat):
+            for chat_id in own_chats:
+                update = simulator.make_update(chat_id, '/' + names['1'], chat_type='group')
+                update_ids[chat_id].append(update.update_id)
+                simulator.dispatcher.update_queue.put(update)
+
+    def fire_jobs():
+        # Only the first minute: the sessions are not reactivated during the run.
+        while not stopped.is_set():
+            if simulator.clock.now < 3 * 3600 + 60:
+                simulator.advance(0.1)
+            time.sleep(0.001)
+
+    started = time.perf_counter()
+    job_thread = threading.Thread(target=fire_jobs, name='jobs')
+    job_thread.start()
+    sender_threads = [threading.Thread(target=send_updates, args=(list(range(i + 1, chats + 1, senders)),))
+                      for i in range(senders)]
+    for thread in sender_threads:
+        thread.start()
+    for thread in sender_threads:
+        thread.join()
+    total = chats * updates_per_chat
+    while inbound.lanes.stats()['done'] < total:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    stopped.set()
+    job_thread.join()
+    simulator.dispatcher.stop()
+    dispatcher_thread.join()
+    inbound.lanes.stop()
+
+    replies = {chat_id: [] for chat_id in update_ids}
+    accepted = {chat_id: [] for chat_id in update_ids}
+    for sent in simulator.bot.sent:
+        message_id = sent.kwargs.get('reply_to_message_id')
+        if message_id is not None:
+            replies[sent.chat_id].append(message_id)
+            if '명령어 생성을 시작합니다' in sent.text:
+                accepted[sent.chat_id].append(message_id)
+    out_of_order = sum(1 for chat_id, ids in replies.items() if ids != sorted(ids))
+    wrongly_accepted = sum(1 for chat_id in update_ids
+                           if chat_id not in denied and accepted[chat_id] != update_ids[chat_id][:1])
+    lost_denials = sum(updates_per_chat - csbt.sessions.get(chat_id).denial_count for chat_id in denied)
+    return {'chats': chats,
+            'updates': total,
+            'wall_sec': elapsed,
+            'updates_per_sec': total / elapsed,
+            'errors': len(simulator.errors) + len(simulator.job_queue.errors),
+            'out_of_order': out_of_order,
+            'wrongly_accepted': wrongly_accepted,
+            'lost_denials': lost_denials}
+
+
+def run_flood(chats: int, flood: int = 2000, workers: int = 4, admit: bool = True) -> dict:
+    # One chat floods the bot with /1 and chatter, each update delivered twice, ahead of one /1 of every other chat.
+    # Measures how long the others wait for their direction and how many handler calls the flood takes,
+    # with the default admission or, if not admit, with every update reaching its lane.
+    simulator = Simulator(workers=workers)
+    if not admit:
+        inbound.admission = inbound.Admission(coalesce_sec=0, max_pending=None, max_seen=0)
+    names = csbt.corpus_command_names()
+    noisy, quiet = 1, range(2, chats + 2)
+
+    inbound.lanes.start(simulator.dispatcher)
+    dispatcher_thread = threading.Thread(target=simulator.dispatcher.start, name='dispatcher')
+    dispatcher_thread.start()
+    started = time.perf_counter()
+    for i in range(flood):
+        update = simulator.make_update(noisy, '/' + names['1'] if i % 2 else 'ㅋㅋㅋ {:d}'.format(i))
+        simulator.dispatcher.update_queue.put(update)
+        simulator.dispatcher.update_queue.put(update)
+    for chat_id in quiet:
+        simulator.dispatcher.update_queue.put(simulator.make_update(chat_id, '/' + names['1']))
+    while not all(csbt.sessions.get(chat_id).is_direction_given for chat_id in quiet):
+        time.sleep(0.001)
+    quiet_sec = time.perf_counter() - started
+    while (not simulator.dispatcher.update_queue.empty() or
+           inbound.lanes.stats()['done'] < inbound.lanes.stats()['submitted']):
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - started
+    simulator.dispatcher.stop()
+    dispatcher_thread.join()
+    inbound.lanes.stop()
+
+    return {'chats': chats,
+            'updates': 2 * flood + chats,
+            'quiet_sec': quiet_sec,
+            'wall_sec': elapsed,
+            'handled': inbound.lanes.stats()['done'],
+            'dropped': {verdict: count for verdict, count in inbound.admission.stats().items()
+                        if verdict != inbound.ADMITTED},
+            'notified': sum(1 for sent in simulator.bot.sent if sent.chat_id == noisy and '건너뜁니다' in sent.text),
+            'errors': len(simulator.errors)}
+
+
+def _run_shard(index: int, shards: int, connection, results, seed: int, success_rate: float):
+    # A worker of run_sharded, in a process of its own: the load of run_load on the chats routed to it.
+    random.seed(seed * shards + index)
+    simulator = Simulator()
+    names = csbt.corpus_command_names()
+    results.put((index, None))
+    chats = set()
+    for data in shard.receive(connection):
+        update = Update.de_json(json.loads(data), simulator.bot)
+        simulator.job_queue.run_until(update.message.date.timestamp())
+        chats.add(update.effective_chat.id)
+        simulator.process(update)
+    _answer_when_asked(simulator, set(chats), names, success_rate)
+    simulator.run_until_idle()
+    results.put((index, {'chats': len(chats),
+                         'messages': len(simulator.bot.sent),
+                         'updates': len(simulator.latencies),
+                         'jobs': len(simulator.job_queue.latencies),
+                         'errors': len(simulator.errors) + len(simulator.job_queue.errors)}))
+
+
+def run_sharded(chats: int, shards: int, seed: int = 0, success_rate: float = 0.5) -> dict:
+    # The load of run_load, routed by shard.ShardRouter to worker processes as the ingress would.
+    # The time is measured from when every worker is ready, without the start of the processes.
+    random.seed(seed)
+    results = multiprocessing.get_context('spawn').Queue()
+    router = shard.ShardRouter(shards, _run_shard, args=(results, seed, success_rate))
+    router.start()
+    for _ in range(shards):
+        results.get()
+    started = time.perf_counter()
+
+    names = csbt.corpus_command_names()
+    arrivals = sorted((random.uniform(0, 60), chat_id) for chat_id in range(1, chats + 1))
+    for update_id, (arrival, chat_id) in enumerate(arrivals, 1):
+        router.route(chat_id, json.dumps(make_update_data(update_id, arrival, chat_id, '/' + names['2'])))
+    router.stop()
+    reports = [results.get()[1] for _ in range(shards)]
+    elapsed = time.perf_counter() - started
+
+    totals = {key: sum(report[key] for report in reports) for key in ('messages', 'updates', 'jobs', 'errors')}
+    totals.update({'chats': chats,
+                   'shards': shards,
+                   'wall_sec': elapsed,
+                   'messages_per_sec': totals['messages'] / elapsed,
+                   'chats_per_shard': [report['chats'] for report in reports]})
+    return totals
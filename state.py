@@ -0,0 +1,102 @@
+import datetime
+import random
+import threading
+
+# Fields that are not part of a snapshot.
+_UNSAVED = ('chat_id', 'lock', 'rng')
+
+
+class Session:
+    # Per-chat state of a conversation. Slotted to keep thousands of chats cheap.
+    __slots__ = ('chat_id', 'lock', 'seed', 'rng',
+                 'is_allowed', 'denial_count',
+                 'is_direction_given', 'is_to_suppress', 'is_sup_inter_recording',
+                 'is_s_listening', 'is_f_listening', 'is_duration_successful',
+                 'is_active', 'reactivated_time', 'timezone', 'serial',
+                 'rubbing_min', 'pause_min', 'repeat', 'cycle_number')
+
+    def __init__(self, chat_id: int, timezone: str = 'Asia/Seoul'):
+        self.chat_id = chat_id
+        # Held by whoever reads and changes the session: a handler of the chat or one of its jobs.
+        self.lock = threading.RLock()
+        self.timezone = timezone  # Name in the tz database, for the daily renewal.
+        self.serial: int = 0  # Counts the sessions of the chat: increased whenever it is reset.
+        self.reseed(random.getrandbits(64))
+
+        # Whether to allow rubbing or not: refreshed daily.
+        self.is_allowed: bool = True
+        self.denial_count: int = 0
+
+        # Specifying behavior of rubbing
+        self.is_direction_given: bool = False
+        self.is_to_suppress: bool = True
+        self.is_sup_inter_recording: bool = False
+
+        self.is_active: bool = True
+        self.reactivated_time: datetime.datetime = datetime.datetime.now()
+        self.reset_activity()
+
+    def reset_activity(self):
+        # Activity sf handlers
+        self.is_s_listening: bool = False
+        self.is_f_listening: bool = False
+        self.is_duration_successful: bool = False
+
+        self.rubbing_min: int = 0
+        self.pause_min: int = 0
+        self.repeat: int = 0
+        self.cycle_number: int = 0
+
+    def reseed(self, seed: int):
+        # Every random draw of the session is made by its own generator, so that the session can be replayed
+        # from the seed. A restored session draws from the seed again.
+        self.seed = seed
+        self.rng = random.Random(seed)
+
+    def snapshot(self) -> dict:
+        # Plain values of the fields, e.g. to persist the session.
+        data = {key: getattr(self, key) for key in self.__slots__ if key not in _UNSAVED}
+        data['reactivated_time'] = self.reactivated_time.timestamp()
+        return data
+
+    def restore(self, data: dict):
+        for key, value in data.items():
+            if key == 'reactivated_time':
+                value = datetime.datetime.fromtimestamp(value)
+            if key in self.__slots__ and key not in _UNSAVED:
+                setattr(self, key, value)
+        self.reseed(self.seed)
+
+    def __repr__(self):
+        return 'Session({})'.format(', '.join('{}={!r}'.format(key, getattr(self, key)) for key in self.__slots__))
+
+
+class SessionStore:
+    # Sessions keyed by chat_id, created on first access.
+    def __init__(self, timezone: str = 'Asia/Seoul'):
+        self.timezone = timezone  # Of the new sessions.
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, chat_id: int) -> Session:
+        session = self._sessions.get(chat_id)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(chat_id)
+                if session is None:
+                    session = Session(chat_id, self.timezone)
+                    self._sessions[chat_id] = session
+        return session
+
+    def discard(self, chat_id: int):
+        with self._lock:
+            self._sessions.pop(chat_id, None)
+
+    def __contains__(self, chat_id: int) -> bool:
+        return chat_id in self._sessions
+
+    def __iter__(self):
+        return iter(list(self._sessions.values()))
+
+    def __len__(self):
+        return len(self._sessions)
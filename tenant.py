@@ -0,0 +1,129 @@
+# Several bots in one process. A tenant is a directory with the token.pv of its bot, its .pv corpus
+# and optionally a config.pv of its own, whose rows override those of the main config.pv. Its sessions,
+# state database and recordings are kept there too.
+# The handlers keep their state in module-level singletons (csbt.sessions, jobs.registry, inbound.lanes,
+# outbound.outbox, ...), so each tenant imports its own copy of the modules holding state. The other
+# modules, and the libraries, are imported once and shared. The tenants share the HTTP connection pool
+# of their bots and the scheduler of their jobs.
+import importlib
+import logging
+import os
+import sys
+
+import pytz
+from apscheduler.events import EVENT_JOB_ERROR
+from apscheduler.schedulers.background import BackgroundScheduler
+
+import aio
+import common
+
+# The modules each tenant imports a copy of, in which the modules of the list import each other.
+# A copy is in sys.modules only while import_modules runs: an import resolved later, e.g. `import csbt`
+# in a tool, or unpickling, gets the process' copy, never a tenant's. So these modules only import each
+# other at the top, and the code of a tenant reaches its copies through Tenant.modules.
+TENANT_MODULES = ('common', 'metrics', 'corpus', 'render', 'jobs', 'inbound', 'outbound', 'media', 'pacing',
+                  'recording', 'csbt')
+
+# Config keys that are the process', not a tenant's: their rows in the config.pv of a tenant are ignored.
+PROCESS_KEYS = ('shards', 'tenants_dir', 'runtime', 'workers', 'con_pool_size', 'metrics_port', 'metrics_listen',
+                'log_level', 'log_format', 'log_sample')
+
+logger = logging.getLogger(__name__)
+
+
+def import_modules() -> dict:
+    # Import a new copy of TENANT_MODULES. Returns {name: module}. Not thread-safe: call it before the
+    # tenants start.
+    saved = {name: sys.modules.pop(name) for name in TENANT_MODULES if name in sys.modules}
+    try:
+        for name in TENANT_MODULES:
+            importlib.import_module(name)
+        return {name: sys.modules[name] for name in TENANT_MODULES}
+    finally:
+        for name in TENANT_MODULES:
+            sys.modules.pop(name, None)
+        sys.modules.update(saved)
+
+
+class Tenant:
+    def __init__(self, name: str, dir_path: str, config: dict):
+        self.name = name
+        self.dir_path = dir_path
+        self.config = config
+        self.modules = import_modules()
+        self.updater = None
+        self.watcher = None
+
+        # The files of the tenant are in its directory, unless given by an absolute path,
+        # its records are logged by loggers named after it, e.g. csbt.<name>, and its metrics are labelled with it.
+        self.modules['common'].CORPUS_DIR = dir_path
+        self.metrics.labels = {'tenant': name}
+        for module in self.modules.values():
+            if hasattr(module, 'logger'):
+                module.logger = logging.getLogger('{}.{}'.format(module.__name__, name))
+        constants = self.bot.Constants
+        constants.TOKEN_PATH = os.path.join(dir_path, constants.TOKEN_PATH)
+        paths = {'state_db': constants.STATE_DB_PATH, 'media_db': constants.MEDIA_DB_PATH,
+                 'corpus_bundle': constants.CORPUS_BUNDLE_PATH, 'voice_dir': self.modules['media'].VOICE_DIR,
+                 'record_path': ''}
+        for key, default in paths.items():
+            path = config.get(key, default)
+            if path:  # Empty turns the file off.
+                config[key] = os.path.join(dir_path, path)
+
+    @property
+    def bot(self):
+        # The tenant's copy of csbt.
+        return self.modules['csbt']
+
+    @property
+    def metrics(self):
+        # The recorder of the tenant's handlers, jobs and sends, served by the process' one.
+        return self.modules['metrics'].recorder
+
+
+def read_tenants(dir_path: str, config: dict) -> list:
+    # A Tenant for every subdirectory holding a token.pv, by name.
+    tenants = []
+    for name in sorted(os.listdir(dir_path)):
+        tenant_dir = os.path.join(dir_path, name)
+        if not os.path.isfile(os.path.join(tenant_dir, 'token.pv')):
+            continue
+        tenant_config = dict(config)
+        for key, value in common.read_config(os.path.join(tenant_dir, 'config.pv')).items():
+            if key in PROCESS_KEYS:
+                logger.warning('Tenant {}: {} is set for the process, not per tenant.'.format(name, key))
+            else:
+                tenant_config[key] = value
+        tenant_config.pop('metrics_port', None)  # Served once by the process, labelled with the tenant.
+        tenants.append(Tenant(name, tenant_dir, tenant_config))
+    return tenants
+
+
+def _log_job_error(event):
+    logger.error('Job {} failed.'.format(event.job_id), exc_info=event.exception)
+
+
+class Shared:
+    # What the bots of the tenants share: the pool of HTTP connections to the Bot API, and the scheduler
+    # of their jobs, the scheduler of telegram.ext.JobQueue or the event loop of the asyncio runtime.
+    def __init__(self, request, is_asyncio: bool):
+        self.request = request
+        self.runtime = None
+        self.scheduler = None
+        if is_asyncio:
+            self.runtime = aio.AsyncJobQueue()
+        else:
+            # Started by the first job queue to start. Stopped here, before the job queues would.
+            self.scheduler = BackgroundScheduler(timezone=pytz.utc)
+            self.scheduler.add_listener(_log_job_error, EVENT_JOB_ERROR)
+
+    def start(self):
+        if self.runtime is not None:
+            self.runtime.start()
+
+    def stop(self):
+        if self.runtime is not None:
+            self.runtime.stop()
+        elif self.scheduler.running:
+            self.scheduler.shutdown()
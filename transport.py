@@ -0,0 +1,57 @@
+# The HTTP connections of the bots to the Bot API. Every thread calling the API at once needs a connection
+# of its own: the one polling for updates, the dispatcher's workers and the outbox's. The pool is not
+# blocking, so a thread finding it empty opens a new connection (a new TLS handshake with Telegram) and
+# closes it afterwards if the pool is full. Sized for all of them, the connections are kept alive and reused.
+# HTTP/2 is not offered: the urllib3 vendored by python-telegram-bot 13 only speaks HTTP/1.1.
+from telegram.utils.request import Request
+
+import outbound
+
+# Seconds to wait for a connection to the Bot API, and between two reads of its response. The bot methods
+# override the read timeout of getUpdates with the polling timeout.
+CONNECT_TIMEOUT_SEC = 5.0
+READ_TIMEOUT_SEC = 5.0
+
+# Connections beyond the threads, e.g. for getMe and the webhook registration.
+SPARE_CONNECTIONS = 2
+
+
+def pool_size(workers: int, bots: int = 1) -> int:
+    # A connection for every thread of the bots that may call the Bot API at once.
+    return bots * (1 + workers + outbound.outbox.workers) + SPARE_CONNECTIONS
+
+
+def create_request(config: dict, workers: int, bots: int = 1) -> Request:
+    # The pool of keep-alive connections of config.pv, con_pool_size connections of pool_size() by default.
+    return Request(con_pool_size=int(config.get('con_pool_size', pool_size(workers, bots))),
+                   connect_timeout=float(config.get('connect_timeout', CONNECT_TIMEOUT_SEC)),
+                   read_timeout=float(config.get('read_timeout', READ_TIMEOUT_SEC)))
+
+
+def stats(request: Request) -> dict:
+    # Requests sent and connections opened for them. Reused are the requests sent on an open connection.
+    pools = getattr(request._con_pool, 'pools', None)  # Absent from the App Engine manager.
+    requests = connections = idle = 0
+    if pools is not None:
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            requests += pool.num_requests
+            connections += pool.num_connections
+            if pool.pool is not None:  # Holds None for every connection not opened yet.
+                idle += sum(1 for connection in list(pool.pool.queue) if connection is not None)
+    return {'size': request.con_pool_size,
+            'requests': requests,
+            'connections': connections,
+            'reused': max(0, requests - connections),
+            'idle': idle}
+
+
+def collect_metrics(request: Request) -> list:
+    transport_stats = stats(request)
+    return [('csbt_http_requests_total', 'counter', 'Requests sent to the Bot API.', {}, transport_stats['requests']),
+            ('csbt_http_connections_total', 'counter', 'Connections opened to the Bot API.', {},
+             transport_stats['connections']),
+            ('csbt_http_connections_idle', 'gauge', 'Open connections waiting in the pool.', {}, transport_stats['idle']),
+            ('csbt_http_pool_size', 'gauge', 'Connections kept open.', {}, transport_stats['size'])]
@@ -0,0 +1,128 @@
+# Serving updates through the library's webhook server.
+# To try it locally without Telegram, leave webhook_url unset, point base_url at a local Bot API stub
+# and post recorded updates:
+#   python webhook.py http://127.0.0.1:8443/csbt update.json --secret <webhook_secret>
+import argparse
+import hmac
+import logging
+import ssl
+import urllib.request
+
+import tornado.web
+from telegram.error import TelegramError, Unauthorized
+from telegram.ext import Updater
+from telegram.ext.utils.webhookhandler import WebhookAppClass, WebhookHandler, WebhookServer
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+logger = logging.getLogger(__name__)
+
+
+class SecretWebhookHandler(WebhookHandler):
+    # Reject requests that don't carry the secret token given to set_webhook.
+    def initialize(self, bot, update_queue, secret_token: str = None) -> None:
+        super().initialize(bot, update_queue)
+        self.secret_token = secret_token
+
+    def prepare(self) -> None:
+        if self.secret_token:
+            received = self.request.headers.get(SECRET_TOKEN_HEADER, '')
+            if not hmac.compare_digest(received, self.secret_token):
+                raise tornado.web.HTTPError(403)
+
+
+class SecretWebhookAppClass(WebhookAppClass):
+    def __init__(self, webhook_path: str, bot, update_queue, secret_token: str = None):
+        self.shared_objects = {'bot': bot, 'update_queue': update_queue, 'secret_token': secret_token}
+        handlers = [(rf'{webhook_path}/?', SecretWebhookHandler, self.shared_objects)]
+        tornado.web.Application.__init__(self, handlers)
+
+
+class WebhookUpdater(Updater):
+    # An Updater whose webhook checks a secret token, and which only registers the webhook
+    # with Telegram when a public webhook_url is given.
+    def __init__(self, *args, secret_token: str = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.secret_token = secret_token
+
+    def _start_webhook(self, listen, port, url_path, cert, key, bootstrap_retries, drop_pending_updates,
+                       webhook_url, allowed_updates, ready=None, ip_address=None, max_connections: int = 40):
+        if not url_path.startswith('/'):
+            url_path = '/' + url_path
+        app = SecretWebhookAppClass(url_path, self.bot, self.update_queue, self.secret_token)
+
+        if cert is not None and key is not None:
+            try:
+                ssl_ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+                ssl_ctx.load_cert_chain(cert, key)
+            except ssl.SSLError as exc:
+                raise TelegramError('Invalid SSL Certificate') from exc
+        else:
+            ssl_ctx = None
+        self.httpd = WebhookServer(listen, port, app, ssl_ctx)
+
+        if webhook_url:
+            cert_file = open(cert, 'rb') if cert is not None else None
+            try:
+                self._bootstrap(max_retries=bootstrap_retries, drop_pending_updates=drop_pending_updates,
+                                webhook_url=webhook_url, allowed_updates=allowed_updates, cert=cert_file,
+                                ip_address=ip_address, max_connections=max_connections)
+            finally:
+                if cert_file is not None:
+                    cert_file.close()
+        else:
+            logger.info('No webhook URL: serving {}:{}{} without registering it.'.format(listen, port, url_path))
+
+        self.httpd.serve_forever(ready=ready)
+
+    def _bootstrap(self, max_retries, drop_pending_updates, webhook_url, allowed_updates, cert=None,
+                   bootstrap_interval=5, ip_address=None, max_connections: int = 40):
+        # As Updater._bootstrap, retrying up to max_retries times (forever if negative), but set_webhook also
+        # gets the secret token, which python-telegram-bot 13 only passes through api_kwargs. Pending updates
+        # are dropped by set_webhook itself.
+        retries = [0]
+        api_kwargs = {'secret_token': self.secret_token} if self.secret_token else None
+
+        def set_webhook():
+            self.bot.set_webhook(url=webhook_url, certificate=cert, allowed_updates=allowed_updates,
+                                 ip_address=ip_address, drop_pending_updates=drop_pending_updates,
+                                 max_connections=max_connections, api_kwargs=api_kwargs)
+            return False
+
+        def on_error(exc):
+            if not isinstance(exc, Unauthorized) and (max_retries < 0 or retries[0] < max_retries):
+                retries[0] += 1
+                logger.warning('Setting the webhook failed, try {} of {}: {}'.format(retries[0], max_retries, exc))
+            else:
+                logger.error('Setting the webhook failed after {} retries: {}'.format(retries[0], exc))
+                raise exc
+
+        self._network_loop_retry(set_webhook, on_error, 'bootstrap set webhook', bootstrap_interval)
+
+
+def post_update(url: str, body: bytes, secret_token: str = None) -> int:
+    # POST a JSON-serialized Update to the webhook as Telegram would. Returns the status code.
+    request = urllib.request.Request(url, data=body, method='POST', headers={'Content-Type': 'application/json'})
+    if secret_token:
+        request.add_header(SECRET_TOKEN_HEADER, secret_token)
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Post recorded updates to a local webhook.')
+    parser.add_argument('url', help='e.g. http://127.0.0.1:8443/csbt')
+    parser.add_argument('paths', nargs='+', help='Files with a JSON-serialized Update each')
+    parser.add_argument('--secret', help='The webhook_secret of config.pv')
+    args = parser.parse_args()
+
+    for path in args.paths:
+        with open(path, 'rb') as f:
+            print('{}: {:d}'.format(path, post_update(args.url, f.read(), args.secret)))
+
+
+if __name__ == '__main__':
+    main()